@@ -1,6 +1,5 @@
 """Admin settings for the static media management application."""
 
-import os
 from functools import partial
 
 from django.contrib import admin
@@ -11,8 +10,8 @@ from django.utils.text import Truncator
 
 import optimizations
 
-from cms import permalinks, externals
-from cms.apps.media.models import Label, File
+from cms import permalinks, externals, thumbnails
+from cms.apps.media.models import Label, File, get_labels, ADMIN_PREVIEW_SIZE, FILE_KIND_AUDIO, FILE_KIND_DOCUMENT, FILE_KIND_SPREADSHEET, FILE_KIND_TEXT, FILE_KIND_IMAGE, FILE_KIND_MOVIE
 
 
 class LabelAdmin(admin.ModelAdmin):
@@ -27,7 +26,7 @@ class LabelAdmin(admin.ModelAdmin):
 admin.site.register(Label, LabelAdmin)
     
        
-# Different types of file.
+# The icon for each kind of file.
 AUDIO_FILE_ICON = "media/img/audio-x-generic.png"
 DOCUMENT_FILE_ICON = "media/img/x-office-document.png"
 SPREADSHEET_FILE_ICON = "media/img/x-office-spreadsheet.png"
@@ -36,28 +35,20 @@ IMAGE_FILE_ICON = "media/img/image-x-generic.png"
 MOVIE_FILE_ICON = "media/img/video-x-generic.png"
 UNKNOWN_FILE_ICON = "media/img/text-x-generic-template.png"
 
-# Different types of recognised file extensions.
 FILE_ICONS = {
-    "mp3": AUDIO_FILE_ICON,
-    "m4a": AUDIO_FILE_ICON,
-    "wav": AUDIO_FILE_ICON,
-    "doc": DOCUMENT_FILE_ICON,
-    "odt": DOCUMENT_FILE_ICON,
-    "pdf": DOCUMENT_FILE_ICON,
-    "xls": SPREADSHEET_FILE_ICON,
-    "txt": TEXT_FILE_ICON,
-    "png": IMAGE_FILE_ICON,
-    "gif": IMAGE_FILE_ICON,
-    "jpg": IMAGE_FILE_ICON,
-    "jpeg": IMAGE_FILE_ICON,
-    "swf": MOVIE_FILE_ICON,
-    "flv": MOVIE_FILE_ICON,
-    "mp4": MOVIE_FILE_ICON,
-    "mov": MOVIE_FILE_ICON,
-    "wmv": MOVIE_FILE_ICON,
+    FILE_KIND_AUDIO: AUDIO_FILE_ICON,
+    FILE_KIND_DOCUMENT: DOCUMENT_FILE_ICON,
+    FILE_KIND_SPREADSHEET: SPREADSHEET_FILE_ICON,
+    FILE_KIND_TEXT: TEXT_FILE_ICON,
+    FILE_KIND_IMAGE: IMAGE_FILE_ICON,
+    FILE_KIND_MOVIE: MOVIE_FILE_ICON,
 }
     
     
+# The number of label links inserted in each query.
+LABEL_BATCH_SIZE = 400
+
+
 class FileAdminBase(admin.ModelAdmin):
     
     """Admin settings for File models."""
@@ -85,41 +76,62 @@ class FileAdminBase(admin.ModelAdmin):
     # Customizations.
     
     def lookup_allowed(self, lookup, *args, **kwargs):
-        """Allows the file iregex lookup needed by TinyMCE integration."""
-        if lookup == "file__iregex":
+        """Allows the file kind lookups needed by TinyMCE integration."""
+        if lookup in ("kind", "kind__in", "file__iregex",):
             return True
         return super(FileAdminBase, self).lookup_allowed(lookup, *args, **kwargs)
     
     # Custom actions.
     
-    def add_label_action(self, request, queryset, label):
-        """Adds the label on the given queryset."""
-        for file in queryset:
-            file.labels.add(label)
-            
-    def remove_label_action(self, request, queryset, label):
-        """Removes the label on the given queryset."""
-        for file in queryset:
-            file.labels.remove(label)
+    def add_label_action(self, request, queryset, label_id, label_name):
+        """Adds the label to the given queryset, in a few queries."""
+        through = File.labels.through
+        labelled_file_ids = set(through.objects.filter(
+            label = label_id,
+            file__in = queryset,
+        ).values_list("file_id", flat=True))
+        new_labels = [
+            through(file_id=file_id, label_id=label_id)
+            for file_id
+            in queryset.values_list("id", flat=True)
+            if not file_id in labelled_file_ids
+        ]
+        for start in xrange(0, len(new_labels), LABEL_BATCH_SIZE):
+            through.objects.bulk_create(new_labels[start:start+LABEL_BATCH_SIZE])
+        self.message_user(request, u"Added label {label_name} to {count} {verbose_name}.".format(
+            label_name = label_name,
+            count = len(new_labels),
+            verbose_name = len(new_labels) == 1 and self.model._meta.verbose_name or self.model._meta.verbose_name_plural,
+        ))
+    
+    def remove_label_action(self, request, queryset, label_id, label_name):
+        """Removes the label from the given queryset, in a few queries."""
+        File.labels.through.objects.filter(
+            label = label_id,
+            file__in = queryset,
+        ).delete()
+        self.message_user(request, u"Removed label {label_name} from the selected {verbose_name_plural}.".format(
+            label_name = label_name,
+            verbose_name_plural = self.model._meta.verbose_name_plural,
+        ))
     
     def get_actions(self, request):
-        """Generates the actions for assigning categories."""
+        """Generates the actions for assigning labels."""
         if IS_POPUP_VAR in request.GET:
             return []
-        opts = self.model._meta
-        verbose_name_plural = opts.verbose_name_plural
+        verbose_name_plural = self.model._meta.verbose_name_plural
         actions = super(FileAdminBase, self).get_actions(request)
         # Add the dynamic labels.
-        for label in Label.objects.all():
+        for label_id, label_name in get_labels():
             # Add action.
-            action_function = partial(self.__class__.add_label_action, label=label)
-            action_description = u'Remove label %s from selected %s"' % (label.name, verbose_name_plural)
-            action_name = action_description.lower().replace(" ", "_")
+            action_function = partial(self.__class__.add_label_action, label_id=label_id, label_name=label_name)
+            action_name = "add_label_{label_id}".format(label_id=label_id)
+            action_description = u"Add label %s to selected %s" % (label_name, verbose_name_plural)
             actions[action_name] = (action_function, action_name, action_description)
             # Remove action.
-            action_function = partial(self.__class__.remove_label_action, label=label)
-            action_description = u'Remove label %s from selected %s"' % (label.name, verbose_name_plural)
-            action_name = action_description.lower().replace(" ", "_")
+            action_function = partial(self.__class__.remove_label_action, label_id=label_id, label_name=label_name)
+            action_name = "remove_label_{label_id}".format(label_id=label_id)
+            action_description = u"Remove label %s from selected %s" % (label_name, verbose_name_plural)
             actions[action_name] = (action_function, action_name, action_description)
         return actions
     
@@ -139,24 +151,19 @@ class FileAdminBase(admin.ModelAdmin):
     
     def get_size(self, obj):
         """Returns the size of the media in a human-readable format."""
-        try:
-            return filesizeformat(obj.file.size)
-        except OSError:
-            return "0 bytes"
+        return filesizeformat(obj.size)
     get_size.short_description = "size"
+    get_size.admin_order_field = "size"
     
     def get_preview(self, obj):
         """Generates a thumbnail of the image."""
-        _, extension = os.path.splitext(obj.file.name)
-        extension = extension.lower()[1:]
-        icon = FILE_ICONS.get(extension, UNKNOWN_FILE_ICON)
+        icon = FILE_ICONS.get(obj.kind, UNKNOWN_FILE_ICON)
         permalink = permalinks.create(obj)
         if icon == IMAGE_FILE_ICON:
-            try:
-                thumbnail = optimizations.get_thumbnail(obj.file, 100, 66)
-            except IOError:
-                pass
-            else:
+            # Usually generated in the background when the image was uploaded.
+            width, height, method = ADMIN_PREVIEW_SIZE
+            thumbnail = thumbnails.get_thumbnail(obj.file, width, height, method, block=True)
+            if thumbnail:
                 return '<img cms:permalink="%s" src="%s" width="%s" height="%s" alt="" title="%s"/>' % (permalink, thumbnail.url, thumbnail.width, thumbnail.height, obj.title)
         else:
             icon = optimizations.get_url(icon)
@@ -0,0 +1,75 @@
+"""Generates the configured thumbnails of every image in the media library."""
+
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from cms import thumbnails
+from cms.apps.media.models import File, IMAGE_FILTER, get_thumbnail_sizes
+
+
+def generate_batch(file_ids):
+    """
+    Generates the thumbnails of a batch of files. Returns the number of
+    generated thumbnails, and the number that could not be generated.
+    """
+    generated_count = 0
+    failed_count = 0
+    sizes = get_thumbnail_sizes()
+    for obj in File.objects.filter(id__in=file_ids).iterator():
+        for width, height, method in sizes:
+            if thumbnails.generate_thumbnail(obj.file, width, height, method):
+                generated_count += 1
+            else:
+                failed_count += 1
+    return generated_count, failed_count
+
+
+class Command(NoArgsCommand):
+    
+    help = "Generates the configured thumbnails of every image in the media library, in parallel."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--processes",
+            action = "store",
+            type = "int",
+            default = None,
+            dest = "processes",
+            help = "The number of worker processes. Defaults to the number of CPUs. Use 1 to work in this process.",
+        ),
+        make_option("--batch-size",
+            action = "store",
+            type = "int",
+            default = 20,
+            dest = "batch_size",
+            help = "The number of files sent to a worker process at a time.",
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        processes = options["processes"] or multiprocessing.cpu_count()
+        batch_size = options["batch_size"]
+        file_ids = list(File.objects.filter(**IMAGE_FILTER).values_list("id", flat=True))
+        batches = [file_ids[start:start+batch_size] for start in xrange(0, len(file_ids), batch_size)]
+        if processes > 1:
+            # Worker processes must open their own database connections.
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = list(pool.imap_unordered(generate_batch, batches))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(generate_batch, batches)
+        generated_count = sum(result[0] for result in results)
+        failed_count = sum(result[1] for result in results)
+        if verbosity >= 1:
+            self.stdout.write("Generated {generated_count} thumbnail(s) for {file_count} image(s), with {failed_count} failure(s).\n".format(
+                generated_count = generated_count,
+                file_count = len(file_ids),
+                failed_count = failed_count,
+            ))
@@ -0,0 +1,55 @@
+"""Reads the size, kind, MIME type and dimensions of every file in the media library."""
+
+from __future__ import with_statement
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from cms.apps.media.models import File
+
+
+class Command(NoArgsCommand):
+    
+    help = "Reads the size, kind, MIME type and dimensions of every file in the media library from storage."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--missing",
+            action = "store_true",
+            default = False,
+            dest = "missing",
+            help = "Only update files with no recorded size.",
+        ),
+        make_option("--batch-size",
+            action = "store",
+            type = "int",
+            default = 100,
+            dest = "batch_size",
+            help = "The number of files to update in each transaction.",
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        batch_size = options["batch_size"]
+        queryset = File.objects.all()
+        if options["missing"]:
+            queryset = queryset.filter(size=0)
+        file_ids = list(queryset.values_list("id", flat=True))
+        for start in xrange(0, len(file_ids), batch_size):
+            with transaction.commit_on_success():
+                for obj in File.objects.filter(id__in=file_ids[start:start+batch_size]).iterator():
+                    obj.update_metadata()
+                    # Update the columns directly, to avoid the side effects of saving.
+                    File.objects.filter(id=obj.id).update(
+                        size = obj.size,
+                        kind = obj.kind,
+                        mime_type = obj.mime_type,
+                        width = obj.width,
+                        height = obj.height,
+                    )
+        if verbosity >= 1:
+            self.stdout.write("Updated the metadata of {count} file(s).\n".format(
+                count = len(file_ids),
+            ))
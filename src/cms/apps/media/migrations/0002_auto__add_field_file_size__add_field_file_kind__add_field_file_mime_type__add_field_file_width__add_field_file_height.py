@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'File.size'
+        db.add_column('media_file', 'size',
+                      self.gf('django.db.models.fields.BigIntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding field 'File.kind'
+        db.add_column('media_file', 'kind',
+                      self.gf('django.db.models.fields.CharField')(default='other', max_length=20, db_index=True),
+                      keep_default=False)
+
+        # Adding field 'File.mime_type'
+        db.add_column('media_file', 'mime_type',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=100, blank=True),
+                      keep_default=False)
+
+        # Adding field 'File.width'
+        db.add_column('media_file', 'width',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'File.height'
+        db.add_column('media_file', 'height',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+    def backwards(self, orm):
+        # Deleting field 'File.size'
+        db.delete_column('media_file', 'size')
+
+        # Deleting field 'File.kind'
+        db.delete_column('media_file', 'kind')
+
+        # Deleting field 'File.mime_type'
+        db.delete_column('media_file', 'mime_type')
+
+        # Deleting field 'File.width'
+        db.delete_column('media_file', 'width')
+
+        # Deleting field 'File.height'
+        db.delete_column('media_file', 'height')
+
+    models = {
+        'media.file': {
+            'Meta': {'ordering': "('title',)", 'object_name': 'File'},
+            'file': ('django.db.models.fields.files.FileField', [], {'max_length': '250'}),
+            'height': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kind': ('django.db.models.fields.CharField', [], {'default': "'other'", 'max_length': '20', 'db_index': 'True'}),
+            'labels': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['media.Label']", 'symmetrical': 'False', 'blank': 'True'}),
+            'mime_type': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'size': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'width': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'media.label': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'Label'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        }
+    }
+
+    complete_apps = ['media']
\ No newline at end of file
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Set the kind and MIME type of the existing files from their extensions."
+        # Their sizes and dimensions are read by the updatefilemetadata command.
+        import mimetypes, os
+        from cms.apps.media.models import get_file_kind
+        extensions = set()
+        for name in orm['media.File'].objects.values_list('file', flat=True).iterator():
+            root, extension = os.path.splitext(name.lower())
+            # Compressed files are typed by their inner extension too.
+            if extension in mimetypes.encodings_map:
+                extension = os.path.splitext(root)[1] + extension
+            if extension:
+                extensions.add(extension)
+        # Update the files with each extension together, the longest last, so
+        # that .tar.gz files are not left typed as .gz files.
+        for extension in sorted(extensions, key=lambda extension: (len(extension), extension)):
+            name = u"file" + extension
+            orm['media.File'].objects.filter(file__iendswith=extension).update(
+                kind = get_file_kind(name),
+                mime_type = mimetypes.guess_type(name)[0] or '',
+            )
+
+    def backwards(self, orm):
+        "The kinds and MIME types are removed along with their columns."
+
+    models = {
+        'media.file': {
+            'Meta': {'ordering': "('title',)", 'object_name': 'File'},
+            'file': ('cms.apps.media.models.SharedFileField', [], {'max_length': '250'}),
+            'height': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kind': ('django.db.models.fields.CharField', [], {'default': "'other'", 'max_length': '20', 'db_index': 'True'}),
+            'labels': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['media.Label']", 'symmetrical': 'False', 'blank': 'True'}),
+            'mime_type': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'size': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'width': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'media.label': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'Label'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        }
+    }
+
+    complete_apps = ['media']
\ No newline at end of file
@@ -1,9 +1,69 @@
 """Models used by the static media management application."""
 
+import mimetypes, os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.images import get_image_dimensions
 from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib import admin
 from django.contrib.admin.widgets import ForeignKeyRawIdWidget
 
+from cms import thumbnails
+from cms.apps.media.storage import SharedFieldFile, get_file_storage
+from cms.models.fields import rerender_html_references
+
+
+# Different kinds of file.
+FILE_KIND_AUDIO = "audio"
+FILE_KIND_DOCUMENT = "document"
+FILE_KIND_SPREADSHEET = "spreadsheet"
+FILE_KIND_TEXT = "text"
+FILE_KIND_IMAGE = "image"
+FILE_KIND_MOVIE = "movie"
+FILE_KIND_OTHER = "other"
+
+FILE_KIND_CHOICES = (
+    (FILE_KIND_AUDIO, "Audio"),
+    (FILE_KIND_DOCUMENT, "Document"),
+    (FILE_KIND_SPREADSHEET, "Spreadsheet"),
+    (FILE_KIND_TEXT, "Text"),
+    (FILE_KIND_IMAGE, "Image"),
+    (FILE_KIND_MOVIE, "Movie"),
+    (FILE_KIND_OTHER, "Other"),
+)
+
+# The kind of file for each recognised file extension.
+FILE_KINDS = {
+    "mp3": FILE_KIND_AUDIO,
+    "m4a": FILE_KIND_AUDIO,
+    "wav": FILE_KIND_AUDIO,
+    "doc": FILE_KIND_DOCUMENT,
+    "odt": FILE_KIND_DOCUMENT,
+    "pdf": FILE_KIND_DOCUMENT,
+    "xls": FILE_KIND_SPREADSHEET,
+    "txt": FILE_KIND_TEXT,
+    "png": FILE_KIND_IMAGE,
+    "gif": FILE_KIND_IMAGE,
+    "jpg": FILE_KIND_IMAGE,
+    "jpeg": FILE_KIND_IMAGE,
+    "swf": FILE_KIND_MOVIE,
+    "flv": FILE_KIND_MOVIE,
+    "mp4": FILE_KIND_MOVIE,
+    "mov": FILE_KIND_MOVIE,
+    "wmv": FILE_KIND_MOVIE,
+}
+
+
+def get_file_kind(name):
+    """Returns the kind of file for the given file name."""
+    return FILE_KINDS.get(os.path.splitext(name)[1].lower()[1:], FILE_KIND_OTHER)
+
+
+# The size of the image previews in the admin changelist.
+ADMIN_PREVIEW_SIZE = (100, 66, "proportional")
+
 
 class Label(models.Model):
     
@@ -21,8 +81,37 @@ class Label(models.Model):
     
     class Meta:
         ordering = ("name",)
+
+
+LABELS_CACHE_KEY = "cms.apps.media.labels"
+
+
+def get_labels():
+    """Returns the ids and names of all labels, in order, caching them between requests."""
+    labels = cache.get(LABELS_CACHE_KEY)
+    if labels is None:
+        labels = list(Label.objects.values_list("id", "name"))
+        cache.set(LABELS_CACHE_KEY, labels, getattr(settings, "MEDIA_LABELS_CACHE_TIMEOUT", 60*60))
+    return labels
+
+
+def label_changed(sender, instance, **kwargs):
+    """Removes the cached labels when a label is saved or deleted."""
+    cache.delete(LABELS_CACHE_KEY)
+
+
+post_save.connect(label_changed, sender=Label)
+
+post_delete.connect(label_changed, sender=Label)
+    
+    
+class SharedFileField(models.FileField):
     
+    """A file field whose stored files can be shared by several objects."""
     
+    attr_class = SharedFieldFile
+
+
 class File(models.Model):
     
     """A static file."""
@@ -36,15 +125,74 @@ class File(models.Model):
         help_text = "Labels are used to help organise your media. They are not visible to users on your website.",
     )
     
-    file = models.FileField(
+    file = SharedFileField(
         upload_to = "uploads/files",
         max_length = 250,
+        storage = get_file_storage(),
+    )
+    
+    # Metadata read from the file when it is uploaded.
+    size = models.BigIntegerField(
+        default = 0,
+        editable = False,
+        help_text = "The size of the file, in bytes.",
+    )
+    
+    kind = models.CharField(
+        max_length = 20,
+        choices = FILE_KIND_CHOICES,
+        default = FILE_KIND_OTHER,
+        db_index = True,
+        editable = False,
+    )
+    
+    mime_type = models.CharField(
+        "MIME type",
+        max_length = 100,
+        blank = True,
+        editable = False,
+    )
+    
+    width = models.PositiveIntegerField(
+        blank = True,
+        null = True,
+        editable = False,
+    )
+    
+    height = models.PositiveIntegerField(
+        blank = True,
+        null = True,
+        editable = False,
     )
     
     def get_absolute_url(self):
         """Generates the absolute URL of the image."""
         return self.file.url
     
+    def is_image(self):
+        """Returns whether the file is an image that can be thumbnailed."""
+        return self.kind == FILE_KIND_IMAGE
+    
+    def update_metadata(self):
+        """Reads the size, kind, MIME type and dimensions of the file."""
+        name = self.file.name
+        self.kind = get_file_kind(name)
+        self.mime_type = mimetypes.guess_type(name)[0] or ""
+        self.width = None
+        self.height = None
+        try:
+            self.size = self.file.size
+            if self.kind == FILE_KIND_IMAGE:
+                try:
+                    # Images that cannot be read have no dimensions.
+                    self.width, self.height = get_image_dimensions(self.file) or (None, None)
+                finally:
+                    # Leave new uploads open, so that they can be saved.
+                    if self.file._committed:
+                        self.file.close()
+        except (IOError, OSError):
+            self.size = 0
+    
     def __unicode__(self):
         """Returns the title of the media."""
         return self.title
@@ -53,6 +201,62 @@ class File(models.Model):
         ordering = ("title",)
 
 
+def get_thumbnail_sizes():
+    """
+    Returns the thumbnails to generate for each uploaded image, as (width,
+    height, method) tuples. The admin preview is always included, followed by
+    any sizes in the MEDIA_THUMBNAIL_SIZES setting.
+    """
+    return (ADMIN_PREVIEW_SIZE,) + tuple(getattr(settings, "MEDIA_THUMBNAIL_SIZES", ()))
+
+
+def pregenerate_thumbnails(obj, block=False):
+    """
+    Generates the configured thumbnails of the given image file. Unless block
+    is True, the thumbnails are generated by background workers.
+    """
+    for width, height, method in get_thumbnail_sizes():
+        if block:
+            thumbnails.generate_thumbnail(obj.file, width, height, method)
+        else:
+            thumbnails.thumbnail_queue.queue(obj.file, width, height, method)
+
+
+def file_pre_save(sender, instance, raw=False, **kwargs):
+    """Records whether a new file has been uploaded, and reads its metadata."""
+    instance._file_uploaded = False
+    if raw or not instance.file:
+        return
+    stored_names = []
+    if instance.pk is not None:
+        stored_names = list(File.objects.filter(pk=instance.pk).values_list("file", flat=True))
+    if not instance.file._committed or stored_names != [instance.file.name]:
+        instance._file_uploaded = True
+        instance.update_metadata()
+
+
+def file_post_save(sender, instance, created, raw=False, **kwargs):
+    """Re-renders any HTML linking to a changed file, and thumbnails new uploads."""
+    if raw:
+        return
+    if not created:
+        rerender_html_references((instance,))
+    if getattr(instance, "_file_uploaded", False) and instance.is_image():
+        pregenerate_thumbnails(instance)
+
+
+def file_post_delete(sender, instance, **kwargs):
+    """Re-renders any HTML linking to a deleted file."""
+    rerender_html_references((instance,))
+
+
+pre_save.connect(file_pre_save, sender=File)
+
+post_save.connect(file_post_save, sender=File)
+
+post_delete.connect(file_post_delete, sender=File)
+
+
 class FileRefField(models.ForeignKey):
     
     """A foreign key to a File, constrained to only select image files."""
@@ -70,7 +274,7 @@ class FileRefField(models.ForeignKey):
         return super(FileRefField, self).formfield(**defaults)
 
 
-IMAGE_FILTER = {"file__iregex": ur"\.(png|gif|jpg|jpeg)$"} 
+IMAGE_FILTER = {"kind": FILE_KIND_IMAGE}
         
 class ImageRefField(FileRefField):
     
@@ -88,5 +292,6 @@ try:
 except ImportError:
     pass
 else:
+    add_introspection_rules((), ("^cms\.apps\.media\.models\.SharedFileField",))
     add_introspection_rules((), ("^cms\.apps\.media\.models\.FileRefField",))
     add_introspection_rules((), ("^cms\.apps\.media\.models\.ImageRefField",))
\ No newline at end of file
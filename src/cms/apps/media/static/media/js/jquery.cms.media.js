@@ -50,10 +50,10 @@
     $.fn.cms.htmlWidget.extensions.file_browser_callback = function(field_name, url, type, win) {
         var browserURL = "/admin/media/file/?pop=1";
         if (type == "image") {
-            browserURL = browserURL + '&file__iregex=\x5C.(png|gif|jpg|jpeg)$';
+            browserURL = browserURL + '&kind=image';
         }
         if (type == "media") {
-            browserURL = browserURL + '&file__iregex=\x5C.(swf|flv|m4a|mov|wmv)$';
+            browserURL = browserURL + '&kind__in=movie,audio';
         }
         tinyMCE.activeEditor.windowManager.open({
             file: browserURL,
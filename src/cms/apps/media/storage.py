@@ -0,0 +1,121 @@
+"""
+Content-addressed storage for uploaded media.
+
+Files are stored under the hash of their contents, so identical uploads share
+a single stored file, and its thumbnails. As the name of a stored file changes
+whenever its contents change, the URLs of stored files can be served with
+far-future cache headers.
+
+Enable it for media files with the MEDIA_CONTENT_HASH_STORAGE setting.
+"""
+
+from __future__ import with_statement
+
+import hashlib, os, posixpath, tempfile
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db.models.fields.files import FieldFile
+
+
+# The umask of the process, read once, as it can only be read by changing it.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class ContentHashStorage(FileSystemStorage):
+
+    """
+    A file system storage that names files by the SHA-1 hash of their contents.
+
+    The contents are hashed while being streamed to a temporary file, which is
+    then renamed to its final name, or discarded if a file with the same
+    contents has already been stored. As stored files can be shared by many
+    objects, they should only be deleted when no longer referenced.
+    """
+
+    def get_available_name(self, name):
+        """Returns the name unchanged, as the final name depends on the contents."""
+        return name
+
+    def _save(self, name, content):
+        """Saves the content under its hash, unless it is already stored."""
+        directory, file_name = posixpath.split(name)
+        extension = os.path.splitext(file_name)[1].lower()
+        directory_path = self.path(directory)
+        if not os.path.isdir(directory_path):
+            try:
+                os.makedirs(directory_path)
+            except OSError:
+                # Another process may have created it.
+                if not os.path.isdir(directory_path):
+                    raise
+        # Stream the content to a temporary file, hashing it on the way.
+        hash = hashlib.sha1()
+        handle, temp_path = tempfile.mkstemp(suffix=".upload", dir=directory_path)
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                for chunk in content.chunks():
+                    hash.update(chunk)
+                    temp_file.write(chunk)
+            name = posixpath.join(directory, hash.hexdigest() + extension)
+            path = self.path(name)
+            if os.path.exists(path):
+                # The same content is already stored.
+                os.unlink(temp_path)
+            else:
+                os.rename(temp_path, path)
+                # Temporary files are only readable by their owner, so give
+                # the file the permissions of a normal upload.
+                if settings.FILE_UPLOAD_PERMISSIONS is None:
+                    os.chmod(path, 0666 & ~UMASK)
+                else:
+                    os.chmod(path, settings.FILE_UPLOAD_PERMISSIONS)
+        except:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return name
+
+
+class SharedFieldFile(FieldFile):
+
+    """
+    A stored file that can be shared by several objects, as identical uploads
+    are in a ContentHashStorage.
+    """
+
+    def delete(self, save=True):
+        """
+        Deletes the file from storage, unless another object of the same model
+        still refers to it, in which case it is only removed from this object.
+        """
+        if self.name:
+            queryset = self.instance.__class__._default_manager.filter(**{self.field.name: self.name})
+            if self.instance.pk is not None:
+                queryset = queryset.exclude(pk=self.instance.pk)
+            shared = queryset.exists()
+        else:
+            shared = False
+        if not shared:
+            super(SharedFieldFile, self).delete(save)
+            return
+        # Forget the file, but leave it in storage.
+        if hasattr(self, "_file"):
+            self.close()
+            del self.file
+        self.name = None
+        setattr(self.instance, self.field.name, self.name)
+        if hasattr(self, "_size"):
+            del self._size
+        self._committed = False
+        if save:
+            self.instance.save()
+    delete.alters_data = True
+
+
+def get_file_storage():
+    """Returns the storage used for media files."""
+    if getattr(settings, "MEDIA_CONTENT_HASH_STORAGE", False):
+        return ContentHashStorage()
+    return default_storage
@@ -0,0 +1,163 @@
+"""Tests for the media app."""
+
+import hashlib, os, shutil, tempfile
+from StringIO import StringIO
+
+from PIL import Image
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.contrib import admin
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from cms import thumbnails
+from cms.apps.media.models import File, Label, ADMIN_PREVIEW_SIZE, IMAGE_FILTER
+from cms.apps.media.storage import ContentHashStorage, UMASK
+
+
+def get_thumbnail_paths():
+    """Returns the paths of all generated thumbnail files."""
+    return set(
+        os.path.join(dirpath, name)
+        for dirpath, _, names
+        in os.walk(default_storage.path("assets"))
+        for name in names
+    )
+
+
+class MediaTestCase(TestCase):
+    
+    def setUp(self):
+        cache.clear()
+        self.thumbnail_paths = get_thumbnail_paths()
+        image_data = StringIO()
+        Image.new("RGB", (200, 100)).save(image_data, "PNG")
+        self.image = File(title="Image")
+        self.image.file.save("media-test.png", ContentFile(image_data.getvalue()))
+    
+    def tearDown(self):
+        thumbnails.thumbnail_queue.wait()
+        self.image.file.delete()
+        for path in get_thumbnail_paths() - self.thumbnail_paths:
+            os.unlink(path)
+
+
+class ThumbnailPregenerationTest(MediaTestCase):
+    
+    def testUploadPregeneratesThumbnails(self):
+        thumbnails.thumbnail_queue.wait()
+        width, height, method = ADMIN_PREVIEW_SIZE
+        self.assertTrue(cache.get(thumbnails.get_cache_key(self.image.file, width, height, method)))
+    
+    def testGenerateThumbnailsCommand(self):
+        output = StringIO()
+        call_command("generatethumbnails", processes=1, stdout=output)
+        self.assertEqual(output.getvalue(), "Generated 1 thumbnail(s) for 1 image(s), with 0 failure(s).\n")
+
+
+class FileMetadataTest(MediaTestCase):
+    
+    def testUploadReadsMetadata(self):
+        image = File.objects.get(id=self.image.id)
+        self.assertEqual(image.kind, "image")
+        self.assertEqual(image.mime_type, "image/png")
+        self.assertEqual((image.width, image.height), (200, 100))
+        self.assertEqual(image.size, self.image.file.size)
+        self.assertEqual(list(File.objects.filter(**IMAGE_FILTER)), [image])
+    
+    def testUnreadableImage(self):
+        broken_image = File(title="Broken image")
+        broken_image.file.save("media-test.png", ContentFile("Not an image"))
+        try:
+            self.assertEqual((broken_image.kind, broken_image.width, broken_image.height), ("image", None, None))
+        finally:
+            broken_image.file.delete()
+    
+    def testUpdateFileMetadataCommand(self):
+        File.objects.filter(id=self.image.id).update(size=0, kind="other", width=None, height=None)
+        call_command("updatefilemetadata", missing=True, verbosity=0)
+        image = File.objects.get(id=self.image.id)
+        self.assertEqual((image.kind, image.width, image.height), ("image", 200, 100))
+        self.assertTrue(image.size > 0)
+
+
+class LabelActionsTest(MediaTestCase):
+    
+    def setUp(self):
+        super(LabelActionsTest, self).setUp()
+        self.label = Label.objects.create(name="Logos")
+        self.files = [self.image] + [
+            File.objects.create(title=u"Document {index}".format(index=index), file=u"uploads/files/document-{index}.pdf".format(index=index))
+            for index in xrange(3)
+        ]
+        self.image.labels.add(self.label)
+        self.model_admin = admin.site._registry[File]
+        self.request = RequestFactory().get("/admin/media/file/")
+        self.request._messages = CookieStorage(self.request)
+    
+    def testGetActions(self):
+        self.model_admin.get_actions(self.request)
+        # The labels are cached.
+        with self.assertNumQueries(0):
+            actions = self.model_admin.get_actions(self.request)
+        add_action = "add_label_{id}".format(id=self.label.id)
+        remove_action = "remove_label_{id}".format(id=self.label.id)
+        self.assertEqual(actions[add_action][2], u"Add label Logos to selected files")
+        self.assertEqual(actions[remove_action][2], u"Remove label Logos from selected files")
+        # Changing a label clears the cache.
+        self.label.name = "Icons"
+        self.label.save()
+        self.assertEqual(self.model_admin.get_actions(self.request)[add_action][2], u"Add label Icons to selected files")
+    
+    def testBulkLabelActions(self):
+        actions = self.model_admin.get_actions(self.request)
+        queryset = File.objects.all()
+        with self.assertNumQueries(3):
+            actions["add_label_{id}".format(id=self.label.id)][0](self.model_admin, self.request, queryset)
+        self.assertEqual(self.label.file_set.count(), 4)
+        actions["remove_label_{id}".format(id=self.label.id)][0](self.model_admin, self.request, queryset.exclude(id=self.image.id))
+        self.assertEqual(list(self.label.file_set.all()), [self.image])
+
+
+class ContentHashStorageTest(TestCase):
+    
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = ContentHashStorage(location=self.location, base_url="/media/")
+    
+    def tearDown(self):
+        shutil.rmtree(self.location)
+    
+    def testIdenticalContentIsShared(self):
+        content_hash = hashlib.sha1("Hello world").hexdigest()
+        name = self.storage.save("uploads/files/hello.TXT", ContentFile("Hello world"))
+        self.assertEqual(name, u"uploads/files/{hash}.txt".format(hash=content_hash))
+        self.assertEqual(self.storage.url(name), u"/media/uploads/files/{hash}.txt".format(hash=content_hash))
+        # The same content is stored once, whatever its original name.
+        self.assertEqual(self.storage.save("uploads/files/greeting.txt", ContentFile("Hello world")), name)
+        self.assertEqual(os.listdir(self.storage.path("uploads/files")), [os.path.basename(name)])
+        # Different content gets a different name.
+        other_name = self.storage.save("uploads/files/hello.txt", ContentFile("Goodbye world"))
+        self.assertNotEqual(other_name, name)
+        self.assertEqual(self.storage.open(other_name).read(), "Goodbye world")
+    
+    @override_settings(FILE_UPLOAD_PERMISSIONS=None)
+    def testDefaultPermissions(self):
+        name = self.storage.save("uploads/files/hello.txt", ContentFile("Hello world"))
+        self.assertEqual(os.stat(self.storage.path(name)).st_mode & 0777, 0666 & ~UMASK)
+
+
+class SharedFileTest(MediaTestCase):
+    
+    def testSharedFileIsKept(self):
+        copy = File.objects.create(title="Copy", file=self.image.file.name)
+        path = self.image.file.path
+        # Another file still refers to the stored file.
+        copy.file.delete()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(File.objects.get(id=copy.id).file.name, "")
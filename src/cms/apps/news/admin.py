@@ -1,9 +1,11 @@
 """Admin settings for the CMS news app."""
 
+from __future__ import with_statement
+
 from django.contrib import admin
 
 from cms.admin import PageBaseAdmin
-from cms.apps.news.models import Category, Article
+from cms.apps.news.models import Category, Article, rebuild_archive, invalidate_feed_cache, related_articles_updater
 
 
 class CategoryAdmin(PageBaseAdmin):
@@ -56,11 +58,33 @@ class ArticleAdmin(PageBaseAdmin):
     filter_horizontal = ("categories", "authors",)
     
     def save_related(self, request, form, formsets, change):
-        """Saves the author of the article."""
-        super(ArticleAdmin, self).save_related(request, form, formsets, change)
+        """Saves the author of the article, and updates its related articles once."""
+        with related_articles_updater.defer():
+            super(ArticleAdmin, self).save_related(request, form, formsets, change)
         # For new articles, add in the current author.
         if not change and not form.cleaned_data["authors"]:
             form.instance.authors.add(request.user)
     
+    # Custom admin actions.
+    
+    def _update_selected_news_feeds(self, queryset):
+        """Rebuilds the archive summary and feed of the news feeds of the selected articles."""
+        news_feed_ids = set(queryset.values_list("news_feed_id", flat=True))
+        rebuild_archive(news_feed_ids)
+        for news_feed_id in news_feed_ids:
+            invalidate_feed_cache(news_feed_id)
+    
+    def publish_selected(self, request, queryset):
+        """Publishes the selected articles, and updates their news feeds."""
+        super(ArticleAdmin, self).publish_selected(request, queryset)
+        self._update_selected_news_feeds(queryset)
+    publish_selected.short_description = PageBaseAdmin.publish_selected.short_description
+    
+    def unpublish_selected(self, request, queryset):
+        """Unpublishes the selected articles, and updates their news feeds."""
+        super(ArticleAdmin, self).unpublish_selected(request, queryset)
+        self._update_selected_news_feeds(queryset)
+    unpublish_selected.short_description = PageBaseAdmin.unpublish_selected.short_description
+    
     
 admin.site.register(Article, ArticleAdmin)
\ No newline at end of file
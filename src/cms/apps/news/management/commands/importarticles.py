@@ -0,0 +1,304 @@
+"""Imports news articles in bulk from NDJSON or CSV files."""
+
+from __future__ import with_statement
+
+import csv, datetime, os
+from itertools import islice
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import LabelCommand, CommandError
+from django.db import transaction
+from django.db.models import FieldDoesNotExist
+from django.db.models.signals import post_save
+from django.template.defaultfilters import slugify
+from django.utils import simplejson as json
+
+from cms import externals
+from cms.apps.media.models import File
+from cms.models.managers import publication_manager
+from cms.apps.news.models import Article, Category, get_default_news_page, update_article_summaries, rebuild_archive, rebuild_related_articles, invalidate_feed_cache
+
+
+# Fields that are resolved by name, rather than set directly.
+RELATION_FIELDS = ("news_feed", "image", "categories", "authors",)
+
+
+def read_ndjson(handle):
+    """Yields the records of an NDJSON file, one JSON object per line."""
+    for line in handle:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(handle):
+    """
+    Yields the records of a CSV file with a header row. Multiple categories or
+    authors are separated by commas within their cell.
+    """
+    for row in csv.DictReader(handle):
+        # Cells beyond the header are collected under a None name, and cells
+        # missing from short rows are None, so both are left out.
+        record = dict(
+            (name.decode("utf-8"), value.decode("utf-8"))
+            for name, value
+            in row.iteritems()
+            if name is not None and value
+        )
+        for name in ("categories", "authors",):
+            if name in record:
+                record[name] = [value.strip() for value in record[name].split(",") if value.strip()]
+        yield record
+
+
+READERS = {
+    "ndjson": read_ndjson,
+    "csv": read_csv,
+}
+
+
+class Command(LabelCommand):
+    
+    help = (
+        "Imports news articles from NDJSON or CSV files, in batches. "
+        "Categories are matched by URL title or title, and created if missing. "
+        "Authors are matched by username. Images are matched by file name or id."
+    )
+    
+    args = "<file file ...>"
+    
+    label = "file"
+    
+    option_list = LabelCommand.option_list + (
+        make_option("--format",
+            action = "store",
+            default = None,
+            dest = "format",
+            choices = sorted(READERS),
+            help = "The format of the files. Defaults to the file extension.",
+        ),
+        make_option("--news-feed",
+            action = "store",
+            type = "int",
+            default = None,
+            dest = "news_feed",
+            help = "The page id of the news feed to import articles without a news_feed into. Defaults to the default news feed.",
+        ),
+        make_option("--batch-size",
+            action = "store",
+            type = "int",
+            default = 500,
+            dest = "batch_size",
+            help = "The number of articles to insert in each query.",
+        ),
+    )
+    
+    def handle(self, *labels, **options):
+        """Imports the files, then rebuilds the derived article data once."""
+        self.verbosity = int(options.get("verbosity", 1))
+        self.batch_size = options["batch_size"]
+        self.imported_ids = []
+        self.news_feed_ids = set()
+        with publication_manager.select_published(False):
+            self.load_lookups(options["news_feed"])
+            output = super(Command, self).handle(*labels, **options)
+            self.finish()
+        return output
+    
+    def load_lookups(self, news_feed_id):
+        """Loads the lookup maps used to resolve related objects."""
+        if news_feed_id is None:
+            page = get_default_news_page()
+            news_feed_id = page and page.id
+        self.default_news_feed_id = news_feed_id
+        # Categories are matched by URL title or title.
+        self.category_ids = {}
+        for category_id, title, url_title in Category.objects.values_list("id", "title", "url_title").iterator():
+            self.category_ids.setdefault(title.lower(), category_id)
+            self.category_ids[url_title.lower()] = category_id
+        # Authors are matched by username.
+        self.author_ids = dict(User.objects.values_list("username", "id").iterator())
+        # Images are matched by id, full file name or base file name.
+        self.image_ids = {}
+        for file_id, file_name in File.objects.values_list("id", "file").iterator():
+            self.image_ids[unicode(file_id)] = file_id
+            self.image_ids.setdefault(os.path.basename(file_name), file_id)
+            self.image_ids[file_name] = file_id
+        # Unique keys of articles imported so far.
+        self.seen_keys = set()
+    
+    def warn(self, message):
+        """Reports a skipped value."""
+        if self.verbosity >= 1:
+            self.stderr.write(message.encode("utf-8") + "\n")
+    
+    def handle_label(self, file_name, **options):
+        """Imports the articles in the given file."""
+        format = options["format"] or os.path.splitext(file_name)[1].lstrip(".").lower()
+        if not format in READERS:
+            raise CommandError("Unknown format for {file_name!r}. Use --format to specify one of {formats}.".format(
+                file_name = file_name,
+                formats = ", ".join(sorted(READERS)),
+            ))
+        imported_count = 0
+        skipped_count = 0
+        with open(file_name, "rb") as handle:
+            records = enumerate(READERS[format](handle), 1)
+            while True:
+                batch = list(islice(records, self.batch_size))
+                if not batch:
+                    break
+                batch_imported_count = self.import_batch(file_name, batch)
+                imported_count += batch_imported_count
+                skipped_count += len(batch) - batch_imported_count
+        if self.verbosity >= 1:
+            self.stdout.write("Imported {imported_count} article(s) from {file_name}, skipping {skipped_count}.\n".format(
+                imported_count = imported_count,
+                skipped_count = skipped_count,
+                file_name = file_name,
+            ))
+    
+    def get_category_id(self, value):
+        """
+        Returns the id of the named category, creating it if needed. Returns
+        None if the name has no URL title.
+        """
+        key = value.lower()
+        category_id = self.category_ids.get(key)
+        if category_id is None:
+            url_title = slugify(value)
+            if not url_title:
+                return None
+            # Names that differ only in punctuation share a URL title.
+            category_id = self.category_ids.get(url_title)
+            if category_id is None:
+                category_id = self.category_ids[url_title] = Category.objects.create(
+                    title = value,
+                    url_title = url_title,
+                ).id
+            self.category_ids[key] = category_id
+        return category_id
+    
+    def build_article(self, file_name, line_number, record):
+        """
+        Returns an unsaved article and its category and author ids for the given
+        record, or None if it cannot be imported.
+        """
+        location = u"{file_name}:{line_number}".format(file_name=file_name, line_number=line_number)
+        article = Article(news_feed_id=record.get("news_feed", self.default_news_feed_id))
+        if article.news_feed_id is None:
+            self.warn(u"{location}: Skipped an article with no news feed.".format(location=location))
+            return None
+        for name, value in record.iteritems():
+            if name in RELATION_FIELDS:
+                continue
+            try:
+                field = Article._meta.get_field(name)
+            except FieldDoesNotExist:
+                raise CommandError(u"{location}: Articles have no field {name!r}.".format(location=location, name=name).encode("utf-8"))
+            setattr(article, field.attname, field.to_python(value))
+        if not article.url_title:
+            article.url_title = slugify(article.title)
+        if isinstance(article.date, datetime.datetime):
+            article.date = article.date.date()
+        # Resolve the image.
+        image = record.get("image")
+        if image:
+            article.image_id = self.image_ids.get(unicode(image))
+            if article.image_id is None:
+                self.warn(u"{location}: Unknown image {image!r}.".format(location=location, image=image))
+        # Check for duplicates.
+        key = (int(article.news_feed_id), article.date, article.url_title)
+        if key in self.seen_keys:
+            self.warn(u"{location}: Skipped a duplicate article {url_title!r}.".format(location=location, url_title=article.url_title))
+            return None
+        self.seen_keys.add(key)
+        # Resolve the categories and authors.
+        category_ids = []
+        for value in record.get("categories", ()):
+            category_id = self.get_category_id(value)
+            if category_id is None:
+                self.warn(u"{location}: Skipped a category with no URL title {value!r}.".format(location=location, value=value))
+            else:
+                category_ids.append(category_id)
+        author_ids = []
+        for username in record.get("authors", ()):
+            author_id = self.author_ids.get(username)
+            if author_id is None:
+                self.warn(u"{location}: Unknown author {username!r}.".format(location=location, username=username))
+            else:
+                author_ids.append(author_id)
+        update_article_summaries(article)
+        return key, article, category_ids, author_ids
+    
+    def import_batch(self, file_name, batch):
+        """Imports a batch of records. Returns the number of imported articles."""
+        with transaction.commit_on_success():
+            items = [
+                item
+                for item
+                in (self.build_article(file_name, line_number, record) for line_number, record in batch)
+                if item is not None
+            ]
+            if not items:
+                return 0
+            # Skip articles that already exist.
+            news_feed_ids = set(key[0] for key, _, _, _ in items)
+            url_titles = set(key[2] for key, _, _, _ in items)
+            existing_keys = set(Article.objects.filter(
+                news_feed__in = news_feed_ids,
+                url_title__in = url_titles,
+            ).values_list("news_feed_id", "date", "url_title").iterator())
+            items = [item for item in items if not item[0] in existing_keys]
+            if not items:
+                return 0
+            # Insert the articles, and look up their ids.
+            Article.objects.bulk_create([article for _, article, _, _ in items])
+            article_ids = dict(
+                ((news_feed_id, date, url_title), article_id)
+                for article_id, news_feed_id, date, url_title
+                in Article.objects.filter(
+                    news_feed__in = news_feed_ids,
+                    url_title__in = url_titles,
+                ).values_list("id", "news_feed_id", "date", "url_title").iterator()
+            )
+            # Insert the category and author links.
+            Article.categories.through.objects.bulk_create([
+                Article.categories.through(article_id=article_ids[key], category_id=category_id)
+                for key, _, category_ids, _ in items
+                for category_id in set(category_ids)
+            ])
+            Article.authors.through.objects.bulk_create([
+                Article.authors.through(article_id=article_ids[key], user_id=author_id)
+                for key, _, _, author_ids in items
+                for author_id in set(author_ids)
+            ])
+        self.imported_ids.extend(article_ids[key] for key, _, _, _ in items)
+        self.news_feed_ids.update(news_feed_ids)
+        return len(items)
+    
+    def finish(self):
+        """Rebuilds the data derived from the imported articles."""
+        if not self.imported_ids:
+            return
+        rebuild_archive(self.news_feed_ids)
+        rebuild_related_articles()
+        for news_feed_id in self.news_feed_ids:
+            invalidate_feed_cache(news_feed_id)
+        # Register the articles with the search index and history links, as if
+        # they had been loaded from a fixture. Search index updates are written
+        # once per batch.
+        for start in xrange(0, len(self.imported_ids), self.batch_size):
+            with externals.watson.context_manager("update_index")():
+                for article in Article.objects.filter(id__in=self.imported_ids[start:start+self.batch_size]).iterator():
+                    post_save.send(
+                        sender = Article,
+                        instance = article,
+                        created = True,
+                        raw = True,
+                    )
+        if self.verbosity >= 1:
+            self.stdout.write("Imported {count} article(s) in total.\n".format(
+                count = len(self.imported_ids),
+            ))
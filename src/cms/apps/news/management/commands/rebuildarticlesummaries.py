@@ -0,0 +1,18 @@
+"""Regenerates the stored excerpts and summaries of news articles."""
+
+from django.core.management.base import NoArgsCommand
+
+from cms.apps.news.models import rebuild_article_summaries
+
+
+class Command(NoArgsCommand):
+    
+    help = "Regenerates the stored excerpt and summary HTML of every news article from its content."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        updated_count = rebuild_article_summaries()
+        if verbosity >= 1:
+            self.stdout.write("Updated the summaries of {count} article(s).\n".format(
+                count = updated_count,
+            ))
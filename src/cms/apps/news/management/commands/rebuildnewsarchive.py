@@ -0,0 +1,16 @@
+"""Rebuilds the news archive summary."""
+
+from django.core.management.base import NoArgsCommand
+
+from cms.apps.news.models import rebuild_archive
+
+
+class Command(NoArgsCommand):
+    
+    help = "Rebuilds the monthly and category article counts of every news feed from the articles."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        rebuild_archive()
+        if verbosity >= 1:
+            self.stdout.write("Rebuilt the news archive summary.\n")
@@ -0,0 +1,18 @@
+"""Recomputes the stored related articles of news articles."""
+
+from django.core.management.base import NoArgsCommand
+
+from cms.apps.news.models import rebuild_related_articles
+
+
+class Command(NoArgsCommand):
+    
+    help = "Recomputes the related articles of every news article from their shared categories."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        updated_count = rebuild_related_articles()
+        if verbosity >= 1:
+            self.stdout.write("Updated the related articles of {count} article(s).\n".format(
+                count = updated_count,
+            ))
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ArchiveMonth'
+        db.create_table('news_archivemonth', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('news_feed', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['news.NewsFeed'])),
+            ('year', self.gf('django.db.models.fields.PositiveSmallIntegerField')()),
+            ('month', self.gf('django.db.models.fields.PositiveSmallIntegerField')()),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('news', ['ArchiveMonth'])
+
+        # Adding unique constraint on 'ArchiveMonth', fields ['news_feed', 'year', 'month']
+        db.create_unique('news_archivemonth', ['news_feed_id', 'year', 'month'])
+
+        # Adding model 'ArchiveCategory'
+        db.create_table('news_archivecategory', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('news_feed', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['news.NewsFeed'])),
+            ('category', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['news.Category'])),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('news', ['ArchiveCategory'])
+
+        # Adding unique constraint on 'ArchiveCategory', fields ['news_feed', 'category']
+        db.create_unique('news_archivecategory', ['news_feed_id', 'category_id'])
+
+        if not db.dry_run:
+            # Count the existing online articles by month.
+            month_counts = {}
+            for news_feed_id, date in orm['news.Article'].objects.filter(is_online=True).values_list('news_feed_id', 'date').iterator():
+                key = (news_feed_id, date.year, date.month)
+                month_counts[key] = month_counts.get(key, 0) + 1
+            orm['news.ArchiveMonth'].objects.bulk_create([
+                orm['news.ArchiveMonth'](news_feed_id=news_feed_id, year=year, month=month, count=count)
+                for (news_feed_id, year, month), count in month_counts.iteritems()
+            ])
+            # Count the existing online articles by category.
+            category_counts = {}
+            for news_feed_id, category_id in orm['news.Article'].objects.filter(is_online=True).values_list('news_feed_id', 'categories').iterator():
+                if category_id is not None:
+                    key = (news_feed_id, category_id)
+                    category_counts[key] = category_counts.get(key, 0) + 1
+            orm['news.ArchiveCategory'].objects.bulk_create([
+                orm['news.ArchiveCategory'](news_feed_id=news_feed_id, category_id=category_id, count=count)
+                for (news_feed_id, category_id), count in category_counts.iteritems()
+            ])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'ArchiveCategory', fields ['news_feed', 'category']
+        db.delete_unique('news_archivecategory', ['news_feed_id', 'category_id'])
+
+        # Removing unique constraint on 'ArchiveMonth', fields ['news_feed', 'year', 'month']
+        db.delete_unique('news_archivemonth', ['news_feed_id', 'year', 'month'])
+
+        # Deleting model 'ArchiveMonth'
+        db.delete_table('news_archivemonth')
+
+        # Deleting model 'ArchiveCategory'
+        db.delete_table('news_archivecategory')
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'media.file': {
+            'Meta': {'ordering': "('title',)", 'object_name': 'File'},
+            'file': ('django.db.models.fields.files.FileField', [], {'max_length': '250'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'labels': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['media.Label']", 'symmetrical': 'False', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'media.label': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'Label'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'news.archivecategory': {
+            'Meta': {'unique_together': "(('news_feed', 'category'),)", 'object_name': 'ArchiveCategory'},
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['news.Category']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'news_feed': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['news.NewsFeed']"})
+        },
+        'news.archivemonth': {
+            'Meta': {'ordering': "('-year', '-month')", 'unique_together': "(('news_feed', 'year', 'month'),)", 'object_name': 'ArchiveMonth'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'month': ('django.db.models.fields.PositiveSmallIntegerField', [], {}),
+            'news_feed': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['news.NewsFeed']"}),
+            'year': ('django.db.models.fields.PositiveSmallIntegerField', [], {})
+        },
+        'news.article': {
+            'Meta': {'ordering': "('-date', '-id')", 'unique_together': "(('news_feed', 'date', 'url_title'),)", 'object_name': 'Article'},
+            'authors': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.User']", 'symmetrical': 'False', 'blank': 'True'}),
+            'browser_title': ('django.db.models.fields.CharField', [], {'max_length': '1000', 'blank': 'True'}),
+            'categories': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['news.Category']", 'symmetrical': 'False', 'blank': 'True'}),
+            'content': ('cms.models.fields.HtmlField', [], {'blank': 'True'}),
+            'date': ('django.db.models.fields.DateField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('cms.apps.media.models.ImageRefField', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.PROTECT', 'to': "orm['media.File']"}),
+            'is_online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'meta_description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'meta_keywords': ('django.db.models.fields.CharField', [], {'max_length': '1000', 'blank': 'True'}),
+            'news_feed': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['news.NewsFeed']"}),
+            'robots_archive': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'robots_follow': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'robots_index': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'short_title': ('django.db.models.fields.CharField', [], {'max_length': '200', 'blank': 'True'}),
+            'sitemap_changefreq': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'sitemap_priority': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'summary': ('cms.models.fields.HtmlField', [], {'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '1000'}),
+            'url_title': ('django.db.models.fields.SlugField', [], {'max_length': '50'})
+        },
+        'news.category': {
+            'Meta': {'ordering': "('title',)", 'unique_together': "(('url_title',),)", 'object_name': 'Category'},
+            'browser_title': ('django.db.models.fields.CharField', [], {'max_length': '1000', 'blank': 'True'}),
+            'content_primary': ('cms.models.fields.HtmlField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'meta_description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'meta_keywords': ('django.db.models.fields.CharField', [], {'max_length': '1000', 'blank': 'True'}),
+            'robots_archive': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'robots_follow': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'robots_index': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'short_title': ('django.db.models.fields.CharField', [], {'max_length': '200', 'blank': 'True'}),
+            'sitemap_changefreq': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'sitemap_priority': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '1000'}),
+            'url_title': ('django.db.models.fields.SlugField', [], {'max_length': '50'})
+        },
+        'news.newsfeed': {
+            'Meta': {'object_name': 'NewsFeed'},
+            'content_primary': ('cms.models.fields.HtmlField', [], {'blank': 'True'}),
+            'page': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'+'", 'unique': 'True', 'primary_key': 'True', 'to': "orm['pages.Page']"}),
+            'per_page': ('django.db.models.fields.IntegerField', [], {'default': '5', 'null': 'True', 'blank': 'True'})
+        },
+        'pages.page': {
+            'Meta': {'ordering': "('left',)", 'unique_together': "(('parent', 'url_title'),)", 'object_name': 'Page'},
+            'browser_title': ('django.db.models.fields.CharField', [], {'max_length': '1000', 'blank': 'True'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'expiry_date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'in_navigation': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'left': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'meta_description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'meta_keywords': ('django.db.models.fields.CharField', [], {'max_length': '1000', 'blank': 'True'}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'child_set'", 'null': 'True', 'to': "orm['pages.Page']"}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'publication_date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'right': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'robots_archive': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'robots_follow': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'robots_index': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'short_title': ('django.db.models.fields.CharField', [], {'max_length': '200', 'blank': 'True'}),
+            'sitemap_changefreq': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'sitemap_priority': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '1000'}),
+            'url_title': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['news']
\ No newline at end of file
@@ -1,14 +1,30 @@
 """Models used by the CMS news app."""
 
+from __future__ import with_statement
+
+import contextlib, datetime, threading
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
-from django.db import models
+from django.utils.html import strip_tags
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 
 from cms import sitemaps, externals
 from cms.apps.media.models import ImageRefField
 from cms.apps.pages.models import ContentBase, Page
-from cms.models import PageBase, OnlineBaseManager, HtmlField, PageBaseSearchAdapter
+from cms.models import PageBase, OnlineBaseManager, HtmlField, PageBaseSearchAdapter, ResolveUrlsQuerySet
+from cms.models.managers import publication_manager
+from cms.models.fields import rerender_html_references, register_prerendered_html, render_html
+from cms.html import process as process_html
+from cms.templatetags.html import truncate_paragraphs
 
 
 class NewsFeed(ContentBase):
@@ -25,7 +41,8 @@ class NewsFeed(ContentBase):
     
     content_primary = HtmlField(
         "primary content",
-        blank = True
+        blank = True,
+        prerender = True,
     )
     
     per_page = models.IntegerField(
@@ -36,14 +53,15 @@ class NewsFeed(ContentBase):
     )
 
 
-def get_default_news_page():
-    """Returns the default news page."""
-    try:
-        return Page.objects.filter(
-            content_type = ContentType.objects.get_for_model(NewsFeed),
-        ).order_by("left")[0]
-    except IndexError:
-        return None
+def get_default_news_page(request=None):
+    """
+    Returns the default news page.
+    
+    If a request is given, the page is only looked up once for that request.
+    """
+    if request is not None and hasattr(request, "pages"):
+        return request.pages.get_default_page(NewsFeed)
+    return Page.objects.get_default_page(NewsFeed)
     
     
 def get_default_news_feed():
@@ -60,7 +78,8 @@ class Category(PageBase):
     
     content_primary = HtmlField(
         "primary content",
-        blank = True
+        blank = True,
+        prerender = True,
     )
     
     def _get_permalink_for_page(self, page):
@@ -99,10 +118,27 @@ class CategoryHistoryLinkAdapter(externals.historylinks.HistoryLinkAdapter):
 externals.historylinks("register", Category, CategoryHistoryLinkAdapter)
 
 
+class ArticleQuerySet(ResolveUrlsQuerySet):
+    
+    """Queryset for Article models, able to resolve article URLs in bulk."""
+    
+    def prepare_urls(self, articles):
+        """Resolves the URLs of the given articles in bulk."""
+        resolve_article_urls(articles)
+
+
 class ArticleManager(OnlineBaseManager):
     
     """Manager for Article models."""
     
+    def get_query_set(self):
+        """Returns an ArticleQuerySet."""
+        return super(ArticleManager, self).get_query_set()._clone(klass=ArticleQuerySet)
+    
+    def resolve_urls(self):
+        """Returns a queryset that resolves the URLs of its articles in bulk."""
+        return self.get_query_set().resolve_urls()
+    
     def select_published(self, queryset):
         queryset = super(ArticleManager, self).select_published(queryset)
         queryset = queryset.filter(
@@ -134,12 +170,25 @@ class Article(PageBase):
     
     content = HtmlField(
         blank = True,
+        prerender = True,
     )
     
     summary = HtmlField(
         blank = True,
     )
     
+    excerpt = models.TextField(
+        blank = True,
+        editable = False,
+        help_text = "A plain-text excerpt of the first paragraph of the content.",
+    )
+    
+    summary_html = models.TextField(
+        blank = True,
+        editable = False,
+        help_text = "The processed HTML of the summary, or the content if there is no summary.",
+    )
+    
     categories = models.ManyToManyField(
         Category,
         blank = True,
@@ -150,28 +199,878 @@ class Article(PageBase):
         blank = True,
     )
     
-    def _get_permalink_for_page(self, page):
-        """Returns the URL of this article for the given news feed page."""
-        return page.reverse("article_detail", kwargs={
+    view_count = models.PositiveIntegerField(
+        default = 0,
+        db_index = True,
+        editable = False,
+        help_text = "The number of times this article has been viewed. This is updated in batches by cms.counters.",
+    )
+    
+    related_ids = models.CommaSeparatedIntegerField(
+        max_length = 255,
+        blank = True,
+        editable = False,
+        help_text = "The ids of the most closely related articles, by shared categories and then by date.",
+    )
+    
+    def _get_permalink_kwargs(self):
+        """Returns the URL arguments of the article detail view for this article."""
+        return {
             "year": self.date.year,
             "month": self.date.strftime("%b").lower(),
             "day": self.date.day,
             "url_title": self.url_title,
-        })
+        }
+    
+    def _get_permalink_for_page(self, page):
+        """Returns the URL of this article for the given news feed page."""
+        return page.reverse("article_detail", kwargs=self._get_permalink_kwargs())
+    
+    def get_related_ids(self):
+        """Returns the ids of the related articles, most closely related first."""
+        return [int(article_id) for article_id in self.related_ids.split(",") if article_id]
+    
+    def get_feed_page(self):
+        """Returns the page of the news feed of this article."""
+        page = getattr(self, "_feed_page", None)
+        if page is None:
+            page = self.news_feed.page
+        return page
     
     def get_absolute_url(self):
         """Returns the URL of the article."""
-        return self._get_permalink_for_page(self.news_feed.page)
+        url = getattr(self, "_absolute_url", None)
+        if url is None:
+            url = self._get_permalink_for_page(self.get_feed_page())
+        return url
+    
+    def get_summary_html(self):
+        """
+        Returns the processed HTML of the summary. Articles whose summary has
+        not been stored yet, such as after an upgrade, are processed on the fly.
+        """
+        if self.summary_html:
+            return self.summary_html
+        return process_html(self.summary or self.content)
+    
+    def save(self, *args, **kwargs):
+        """
+        Saves the article, updating its excerpt and summary HTML.
+        
+        The view count and related articles are reloaded first, as they are
+        updated in the background, and would otherwise be overwritten.
+        """
+        update_article_summaries(self)
+        if self.pk is not None:
+            with publication_manager.select_published(False):
+                try:
+                    self.view_count, self.related_ids = Article.objects.filter(pk=self.pk).values_list("view_count", "related_ids")[0]
+                except IndexError:
+                    pass
+        super(Article, self).save(*args, **kwargs)
     
     class Meta:
         unique_together = (("news_feed", "date", "url_title",),)
-        ordering = ("-date",)
+        ordering = ("-date", "-id",)
         
         
 externals.historylinks("register", Article)
 
 
-sitemaps.register(Article)
+def resolve_article_urls(articles):
+    """
+    Resolves the URLs of the given articles in bulk.
+    
+    The pages of all their news feeds are loaded in two queries, and the URL of
+    each news feed page is only resolved once. The resolved URL and feed page
+    are cached on each article, so that get_absolute_url() and get_feed_page()
+    need no further queries.
+    """
+    pages = Page.objects.get_with_ancestors(set(
+        article.news_feed_id
+        for article
+        in articles
+    ))
+    prefixes = {}
+    for article in articles:
+        page = pages.get(article.news_feed_id)
+        if page is None:
+            continue
+        prefix = prefixes.get(page.id)
+        if prefix is None:
+            prefix = prefixes[page.id] = page.get_absolute_url()
+        article._feed_page = page
+        article._absolute_url = prefix + urlresolvers.reverse(
+            "article_detail",
+            kwargs = article._get_permalink_kwargs(),
+            urlconf = NewsFeed.urlconf,
+            prefix = "",
+        )
+    return articles
+
+
+def render_article_summary(summary, content):
+    """Returns the processed HTML of the summary of an article, or of its content if it has no summary."""
+    return render_html(summary or content)
+
+
+def update_article_summaries(article):
+    """Updates the stored excerpt and summary HTML of the given article from its content."""
+    article.excerpt = strip_tags(truncate_paragraphs(article.content, 1)).strip()
+    article.summary_html = render_article_summary(article.summary, article.content)
+
+
+# Re-render the stored summaries when the objects they link to change.
+register_prerendered_html(Article, ("summary", "content"), "summary_html", render_article_summary)
+    
+    
+def rebuild_article_summaries(batch_size=100):
+    """Regenerates the stored excerpts and summary HTML of all articles. Returns the number of updated articles."""
+    updated_count = 0
+    updated_news_feed_ids = set()
+    with publication_manager.select_published(False):
+        article_ids = list(Article.objects.values_list("id", flat=True))
+        for start in xrange(0, len(article_ids), batch_size):
+            with transaction.commit_on_success():
+                for article in Article.objects.filter(id__in=article_ids[start:start+batch_size]).only("id", "news_feed", "content", "summary", "excerpt", "summary_html"):
+                    old_values = (article.excerpt, article.summary_html)
+                    update_article_summaries(article)
+                    if (article.excerpt, article.summary_html) != old_values:
+                        Article.objects.filter(id=article.id).update(
+                            excerpt = article.excerpt,
+                            summary_html = article.summary_html,
+                        )
+                        updated_news_feed_ids.add(article.news_feed_id)
+                        updated_count += 1
+    for news_feed_id in updated_news_feed_ids:
+        invalidate_feed_cache(news_feed_id)
+    return updated_count
+
+
+# Related articles.
+
+# The number of characters stored for each related article id, allowing for
+# ten-digit ids and their separators.
+RELATED_ID_LENGTH = 11
+
+
+def get_related_articles_count():
+    """
+    Returns the number of related articles stored for each article.
+    
+    Raises ImproperlyConfigured if that many ids might not fit in the
+    related_ids column.
+    """
+    count = getattr(settings, "NEWS_RELATED_ARTICLES_COUNT", 5)
+    max_count = Article._meta.get_field("related_ids").max_length // RELATED_ID_LENGTH
+    if count > max_count:
+        raise ImproperlyConfigured("NEWS_RELATED_ARTICLES_COUNT cannot be more than {max_count}.".format(max_count=max_count))
+    return count
+
+
+def _rank_related_articles(article_id, date, candidates, count):
+    """
+    Returns the ids of the given (id, date, shared_category_count) candidates
+    most closely related to the given article, by the number of shared
+    categories, and then by closeness in date.
+    """
+    return [
+        candidate_id
+        for candidate_id, _, _
+        in sorted(
+            (
+                candidate
+                for candidate
+                in candidates
+                if candidate[0] != article_id
+            ),
+            key = lambda (candidate_id, candidate_date, shared_count): (-shared_count, abs((candidate_date - date).days), -candidate_id),
+        )[:count]
+    ]
+
+
+def _format_related_ids(related_ids):
+    """Formats the given related article ids for storage."""
+    return u",".join(unicode(article_id) for article_id in related_ids)
+
+
+def _store_related_articles(article_ids, dates, article_category_ids, category_article_ids, old_values, count):
+    """
+    Ranks the related articles of the given articles from in-memory indexes of
+    the article categories, and stores any that have changed. Returns the
+    number of updated articles.
+    """
+    updated_count = 0
+    for article_id in article_ids:
+        shared_counts = defaultdict(int)
+        for category_id in article_category_ids.get(article_id, ()):
+            for candidate_id in category_article_ids[category_id]:
+                shared_counts[candidate_id] += 1
+        related_ids_value = _format_related_ids(_rank_related_articles(article_id, dates[article_id], (
+            (candidate_id, dates[candidate_id], shared_count)
+            for candidate_id, shared_count
+            in shared_counts.iteritems()
+        ), count))
+        if related_ids_value != old_values.get(article_id):
+            Article.objects.filter(id=article_id).update(related_ids=related_ids_value)
+            updated_count += 1
+    return updated_count
+
+
+def _find_related_ids(article_id, date, category_ids, count):
+    """
+    Returns the ids of the articles most closely related to the given article,
+    using a few limited queries for each possible number of shared categories,
+    rather than loading every article in its categories.
+    """
+    related_ids = []
+    candidates = Article.objects.filter(categories__in=category_ids).exclude(id=article_id)
+    for shared_count in xrange(len(category_ids), 0, -1):
+        level = candidates.annotate(shared=Count("categories")).filter(shared=shared_count)
+        # The closest articles in date are among the closest on either side.
+        rows = list(level.filter(date__gte=date).order_by("date", "-id").values_list("id", "date")[:count])
+        rows.extend(level.filter(date__lt=date).order_by("-date", "-id").values_list("id", "date")[:count])
+        related_ids.extend(_rank_related_articles(article_id, date, (
+            (candidate_id, candidate_date, shared_count)
+            for candidate_id, candidate_date
+            in rows
+        ), count - len(related_ids)))
+        if len(related_ids) >= count:
+            break
+    return related_ids
+
+
+def _refresh_related_articles(article_ids):
+    """
+    Recomputes and stores the related articles of the given articles. Returns a
+    dictionary of the old and new related article ids of each article.
+    """
+    count = get_related_articles_count()
+    results = {}
+    for article_id, date, old_value in Article.objects.filter(id__in=article_ids).values_list("id", "date", "related_ids"):
+        related_ids = _find_related_ids(article_id, date, _get_category_ids(article_id), count)
+        related_ids_value = _format_related_ids(related_ids)
+        if related_ids_value != old_value:
+            Article.objects.filter(id=article_id).update(related_ids=related_ids_value)
+        results[article_id] = ([int(related_id) for related_id in old_value.split(",") if related_id], related_ids)
+    return results
+
+
+def update_related_articles(article_ids):
+    """
+    Recomputes the related articles of the given articles after their
+    categories have changed.
+    
+    Articles are related by the number of categories they share and their
+    closeness in date, which is symmetric. So the articles that listed a
+    changed article, and the articles that it now lists, are the ones whose own
+    lists are affected, and are recomputed too. The work done is bounded by the
+    number of related articles, not the size of the categories. The
+    rebuildrelatedarticles command recomputes every article exactly.
+    """
+    article_ids = set(article_ids)
+    if not article_ids:
+        return
+    with publication_manager.select_published(False):
+        affected_ids = set()
+        for old_ids, new_ids in _refresh_related_articles(article_ids).itervalues():
+            affected_ids.update(old_ids)
+            affected_ids.update(new_ids)
+        affected_ids.difference_update(article_ids)
+        if affected_ids:
+            _refresh_related_articles(affected_ids)
+
+
+class RelatedArticlesUpdater(threading.local):
+    
+    """
+    Tracks a thread-local block in which related article updates are collected,
+    so that they can be run once at the end, rather than on every change.
+    """
+    
+    def __init__(self):
+        """Initializes the RelatedArticlesUpdater."""
+        super(RelatedArticlesUpdater, self).__init__()
+        self._pending = None
+    
+    def queue(self, article_ids):
+        """
+        Updates the related articles of the given articles, or queues them until
+        the end of the current deferred block.
+        """
+        if self._pending is None:
+            update_related_articles(article_ids)
+        else:
+            self._pending.update(article_ids)
+    
+    @contextlib.contextmanager
+    def defer(self):
+        """Marks a block in which related article updates are deferred."""
+        if self._pending is not None:
+            yield
+            return
+        self._pending = set()
+        try:
+            yield
+        except:
+            self._pending = None
+            raise
+        article_ids = self._pending
+        self._pending = None
+        update_related_articles(article_ids)
+
+
+# A single, thread-safe related articles updater.
+related_articles_updater = RelatedArticlesUpdater()
+
+
+def rebuild_related_articles(batch_size=100):
+    """
+    Recomputes the related articles of all articles in memory, from a single
+    scan of the article categories. Returns the number of updated articles.
+    """
+    count = get_related_articles_count()
+    updated_count = 0
+    with publication_manager.select_published(False):
+        dates = dict(Article.objects.values_list("id", "date").iterator())
+        category_article_ids = defaultdict(list)
+        article_category_ids = defaultdict(list)
+        for article_id, category_id in Article.categories.through.objects.values_list("article_id", "category_id").iterator():
+            category_article_ids[category_id].append(article_id)
+            article_category_ids[article_id].append(category_id)
+        article_ids = sorted(dates)
+        for start in xrange(0, len(article_ids), batch_size):
+            batch_ids = article_ids[start:start+batch_size]
+            with transaction.commit_on_success():
+                old_values = dict(Article.objects.filter(id__in=batch_ids).values_list("id", "related_ids"))
+                updated_count += _store_related_articles(batch_ids, dates, article_category_ids, category_article_ids, old_values, count)
+    return updated_count
+
+
+def get_related_articles(article, limit=None, profile="title"):
+    """
+    Returns the published articles related to the given article, most closely
+    related first, loaded with the given article profile in a single query.
+    """
+    related_ids = article.get_related_ids()[:limit]
+    articles = apply_article_profile(Article.objects.all(), profile).in_bulk(related_ids)
+    return [
+        articles[article_id]
+        for article_id
+        in related_ids
+        if article_id in articles
+    ]
+
+
+# Field profiles for loading lists of articles. Each profile can restrict the
+# loaded fields with "only" or "defer", and name the relations to select or
+# prefetch. Extend or override them with the NEWS_ARTICLE_PROFILES setting.
+ARTICLE_PROFILES = {
+    "full": {
+        "select_related": ("image",),
+        "prefetch_related": ("categories", "authors",),
+    },
+    "list": {
+        "defer": ("content",),
+        "select_related": ("image",),
+        "prefetch_related": ("categories",),
+    },
+    "feed": {
+        "defer": ("content", "summary",),
+    },
+    "title": {
+        "only": ("id", "news_feed", "date", "url_title", "title", "short_title",),
+    },
+}
+
+
+def get_article_profile(name):
+    """Returns the named article field profile."""
+    profiles = dict(ARTICLE_PROFILES, **getattr(settings, "NEWS_ARTICLE_PROFILES", {}))
+    try:
+        return profiles[name]
+    except KeyError:
+        raise ValueError("{name!r} is not an article profile.".format(name=name))
+    
+    
+def apply_article_profile(queryset, name):
+    """Restricts the fields and relations loaded by the given article queryset to the named profile."""
+    profile = get_article_profile(name)
+    if profile.get("only"):
+        queryset = queryset.only(*profile["only"])
+    if profile.get("defer"):
+        queryset = queryset.defer(*profile["defer"])
+    if profile.get("select_related"):
+        queryset = queryset.select_related(*profile["select_related"])
+    if profile.get("prefetch_related"):
+        queryset = queryset.prefetch_related(*profile["prefetch_related"])
+    return queryset
+
+
+class ArticleSitemap(sitemaps.PageBaseSitemap):
+    
+    """Sitemap for news articles."""
+    
+    model = Article
+    
+    def items(self):
+        """Lists the indexable articles, resolving their URLs in bulk."""
+        return super(ArticleSitemap, self).items().resolve_urls()
+
+
+sitemaps.register(Article, ArticleSitemap)
+
+
+externals.watson("register", Article, adapter_cls=PageBaseSearchAdapter)
+
+
+# Feed caching.
+
+# How long to remember feed cache versions. If a version is forgotten, a new
+# one is simply created, so this only affects the cache hit rate.
+FEED_CACHE_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_feed_cache_version(news_feed_id):
+    """Returns the current cache version of the RSS feed of the given news feed."""
+    key = "cms.apps.news.feed_version:{id}".format(id=news_feed_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(key, version, FEED_CACHE_VERSION_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+    
+    
+def invalidate_feed_cache(news_feed_id):
+    """Invalidates the cached RSS feed of the given news feed."""
+    cache.set("cms.apps.news.feed_version:{id}".format(id=news_feed_id), uuid.uuid4().hex, FEED_CACHE_VERSION_TIMEOUT)
+
+
+# Most read articles.
+
+def get_most_read_article_ids(news_feed_id, limit):
+    """
+    Returns the ids of the most viewed articles in the given news feed, most
+    viewed first.
+    
+    The ranking is cached for the number of seconds in the
+    NEWS_MOST_READ_CACHE_TIMEOUT setting, rather than sorted on every request.
+    """
+    cache_key = "cms.apps.news.most_read:{news_feed_id}:{limit}:{published}".format(
+        news_feed_id = news_feed_id,
+        limit = limit,
+        published = int(publication_manager.select_published_active()),
+    )
+    article_ids = cache.get(cache_key)
+    if article_ids is None:
+        article_ids = list(Article.objects.filter(
+            news_feed = news_feed_id,
+            view_count__gt = 0,
+        ).order_by("-view_count", "-date", "-id").values_list("id", flat=True)[:limit])
+        cache.set(cache_key, article_ids, getattr(settings, "NEWS_MOST_READ_CACHE_TIMEOUT", 60 * 15))
+    return article_ids
+
+
+def get_most_read_articles(news_feed_id, limit=5, profile="title"):
+    """
+    Returns the most viewed articles in the given news feed, loaded with the
+    given article profile.
+    """
+    article_ids = get_most_read_article_ids(news_feed_id, limit)
+    articles = apply_article_profile(Article.objects.all(), profile).in_bulk(article_ids)
+    return [
+        articles[article_id]
+        for article_id
+        in article_ids
+        if article_id in articles
+    ]
+
+
+# Archive summaries.
+
+class ArchiveCountManager(models.Manager):
+    
+    """Manager for archive count models."""
+    
+    def adjust(self, delta, **lookup):
+        """
+        Adjusts the count of the row matching the given lookup, creating it if
+        needed. Counts are never decremented below zero.
+        """
+        if not delta:
+            return
+        if delta < 0:
+            if not self.filter(count__gte=-delta, **lookup).update(count=F("count") + delta):
+                self.filter(**lookup).update(count=0)
+            return
+        if self.filter(**lookup).update(count=F("count") + delta):
+            return
+        savepoint = transaction.savepoint()
+        try:
+            self.create(count=delta, **lookup)
+        except IntegrityError:
+            # Another process created the row first.
+            transaction.savepoint_rollback(savepoint)
+            self.filter(**lookup).update(count=F("count") + delta)
+        else:
+            transaction.savepoint_commit(savepoint)
+
+
+class ArchiveMonth(models.Model):
+    
+    """The number of online articles in a news feed for a month."""
+    
+    objects = ArchiveCountManager()
+    
+    news_feed = models.ForeignKey(
+        NewsFeed,
+        related_name = "+",
+    )
+    
+    year = models.PositiveSmallIntegerField()
+    
+    month = models.PositiveSmallIntegerField()
+    
+    count = models.PositiveIntegerField(
+        default = 0,
+    )
+    
+    class Meta:
+        unique_together = (("news_feed", "year", "month",),)
+        ordering = ("-year", "-month",)
+
+
+class ArchiveCategory(models.Model):
+    
+    """The number of online articles in a news feed for a category."""
+    
+    objects = ArchiveCountManager()
+    
+    news_feed = models.ForeignKey(
+        NewsFeed,
+        related_name = "+",
+    )
+    
+    category = models.ForeignKey(
+        Category,
+        related_name = "+",
+    )
+    
+    count = models.PositiveIntegerField(
+        default = 0,
+    )
+    
+    class Meta:
+        unique_together = (("news_feed", "category",),)
+
+
+# How long to remember the scheduled article counts of a news feed. They are
+# keyed by day, and by the feed cache version, which changes whenever an
+# article in the feed is saved.
+FUTURE_COUNTS_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _get_future_counts(news_feed_id):
+    """
+    Returns the number of online articles of the given news feed dated after
+    today, as a dictionary mapping each (year, month) to its count, and a
+    dictionary mapping each category id to its count.
+    
+    Articles are published by the passing of their date, so the archive
+    summary counts them as soon as they are saved. These counts are subtracted
+    from it, and cached for the rest of the day.
+    """
+    today = timezone.now().date()
+    cache_key = "cms.apps.news.future_counts:{id}:{version}:{today}".format(
+        id = news_feed_id,
+        version = get_feed_cache_version(news_feed_id),
+        today = today.isoformat(),
+    )
+    counts = cache.get(cache_key)
+    if counts is None:
+        with publication_manager.select_published(False):
+            articles = Article.objects.filter(
+                news_feed = news_feed_id,
+                is_online = True,
+                date__gt = today,
+            )
+            month_counts = defaultdict(int)
+            for date in articles.values_list("date", flat=True).iterator():
+                month_counts[(date.year, date.month)] += 1
+            category_counts = dict(Article.categories.through.objects.filter(
+                article__in = articles.values("id"),
+            ).values_list("category_id").annotate(
+                count = Count("article"),
+            ).order_by())
+        counts = (dict(month_counts), category_counts)
+        cache.set(cache_key, counts, FUTURE_COUNTS_CACHE_TIMEOUT)
+    return counts
+
+
+def get_archive_dates(news_feed_id, year=None):
+    """
+    Returns the first day of every month that contains online articles for the
+    given news feed, newest first, read from the archive summary.
+    
+    Months that only contain articles scheduled for the future are excluded.
+    """
+    queryset = ArchiveMonth.objects.filter(
+        news_feed = news_feed_id,
+        count__gt = 0,
+    )
+    if year is not None:
+        queryset = queryset.filter(year=year)
+    future_counts = _get_future_counts(news_feed_id)[0]
+    return [
+        datetime.date(year, month, 1)
+        for year, month, count
+        in queryset.values_list("year", "month", "count")
+        if count > future_counts.get((year, month), 0)
+    ]
+
+
+def get_archive_categories(news_feed_id):
+    """
+    Returns the categories containing online articles for the given news feed,
+    leaving out categories that only contain articles scheduled for the future.
+    """
+    future_counts = _get_future_counts(news_feed_id)[1]
+    return Category.objects.filter(
+        id__in = [
+            category_id
+            for category_id, count
+            in ArchiveCategory.objects.filter(
+                news_feed = news_feed_id,
+                count__gt = 0,
+            ).values_list("category_id", "count")
+            if count > future_counts.get(category_id, 0)
+        ],
+    )
+
+
+def rebuild_archive(news_feed_ids=None):
+    """
+    Rebuilds the archive summary from the articles, optionally only for the
+    given news feeds.
+    """
+    with publication_manager.select_published(False):
+        with transaction.commit_on_success():
+            articles = Article.objects.filter(is_online=True)
+            month_counts = ArchiveMonth.objects.all()
+            category_counts = ArchiveCategory.objects.all()
+            if news_feed_ids is not None:
+                articles = articles.filter(news_feed__in=news_feed_ids)
+                month_counts = month_counts.filter(news_feed__in=news_feed_ids)
+                category_counts = category_counts.filter(news_feed__in=news_feed_ids)
+            month_counts.delete()
+            category_counts.delete()
+            # Count the articles by month.
+            counts = defaultdict(int)
+            for news_feed_id, date in articles.values_list("news_feed_id", "date").iterator():
+                counts[(news_feed_id, date.year, date.month)] += 1
+            ArchiveMonth.objects.bulk_create([
+                ArchiveMonth(
+                    news_feed_id = news_feed_id,
+                    year = year,
+                    month = month,
+                    count = count,
+                )
+                for (news_feed_id, year, month), count
+                in counts.iteritems()
+            ])
+            # Count the articles by category.
+            ArchiveCategory.objects.bulk_create([
+                ArchiveCategory(
+                    news_feed_id = row["article__news_feed"],
+                    category_id = row["category"],
+                    count = row["count"],
+                )
+                for row
+                in Article.categories.through.objects.filter(
+                    article__in = articles,
+                ).values("article__news_feed", "category").annotate(
+                    count = Count("article"),
+                ).order_by()
+            ])
+
+
+def _get_archive_state(article_id):
+    """Returns the stored news feed, date and online state of the given article."""
+    with publication_manager.select_published(False):
+        try:
+            return Article.objects.filter(id=article_id).values_list("news_feed_id", "date", "is_online")[0]
+        except IndexError:
+            return None
+
+
+def _adjust_archive(state, category_ids, delta):
+    """Adjusts the archive summary for an article with the given state."""
+    if state is None:
+        return
+    news_feed_id, date, is_online = state
+    if not is_online:
+        return
+    ArchiveMonth.objects.adjust(delta,
+        news_feed_id = news_feed_id,
+        year = date.year,
+        month = date.month,
+    )
+    for category_id in category_ids:
+        ArchiveCategory.objects.adjust(delta,
+            news_feed_id = news_feed_id,
+            category_id = category_id,
+        )
+
+
+def _get_category_ids(article_id):
+    """Returns the ids of the categories of the given article."""
+    return list(Article.categories.through.objects.filter(article=article_id).values_list("category_id", flat=True))
+
+
+def _get_link_state(article):
+    """Returns the values of an article that affect links to it."""
+    return (article.news_feed_id, article.date, article.url_title, article.title)
+
+
+def article_pre_save(sender, instance, **kwargs):
+    """Records the stored state of an article before it is saved."""
+    instance._archive_state = None
+    instance._link_state = None
+    if instance.pk is not None:
+        instance._archive_state = _get_archive_state(instance.pk)
+        with publication_manager.select_published(False):
+            try:
+                instance._link_state = Article.objects.filter(pk=instance.pk).values_list("news_feed_id", "date", "url_title", "title")[0]
+            except IndexError:
+                pass
+        
+        
+def article_post_save(sender, instance, raw=False, **kwargs):
+    """Moves a saved article within the archive summary."""
+    if raw:
+        return
+    old_state = getattr(instance, "_archive_state", None)
+    new_state = (instance.news_feed_id, instance.date, instance.is_online)
+    if old_state is not None and old_state[0] == new_state[0] and old_state[2] == new_state[2]:
+        # The categories are unaffected, so only check the month.
+        if (old_state[1].year, old_state[1].month) != (new_state[1].year, new_state[1].month):
+            _adjust_archive(old_state, (), -1)
+            _adjust_archive(new_state, (), 1)
+    elif old_state != new_state:
+        category_ids = _get_category_ids(instance.pk) if old_state is not None else ()
+        _adjust_archive(old_state, category_ids, -1)
+        _adjust_archive(new_state, category_ids, 1)
+    instance._archive_state = new_state
+    # Invalidate the feeds containing the article.
+    invalidate_feed_cache(instance.news_feed_id)
+    if old_state is not None and old_state[0] != new_state[0]:
+        invalidate_feed_cache(old_state[0])
+    # Re-render any HTML linking to the article.
+    old_link_state = getattr(instance, "_link_state", None)
+    if old_link_state is not None and old_link_state != _get_link_state(instance):
+        rerender_html_references((instance,))
+    
+    
+def article_pre_delete(sender, instance, **kwargs):
+    """Records the stored state and categories of an article before it is deleted."""
+    instance._archive_state = _get_archive_state(instance.pk)
+    instance._archive_category_ids = _get_category_ids(instance.pk)
+    
+    
+def article_post_delete(sender, instance, **kwargs):
+    """Removes a deleted article from the archive summary."""
+    _adjust_archive(getattr(instance, "_archive_state", None), getattr(instance, "_archive_category_ids", ()), -1)
+    invalidate_feed_cache(instance.news_feed_id)
+    rerender_html_references((instance,))
+    
+    
+def article_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Updates the category counts of the archive summary."""
+    # Resolve the affected (article, category) pairs.
+    if action == "pre_clear":
+        if reverse:
+            instance._archive_pairs = [
+                (article_id, instance.pk)
+                for article_id
+                in Article.categories.through.objects.filter(category=instance).values_list("article_id", flat=True)
+            ]
+        else:
+            instance._archive_pairs = [
+                (instance.pk, category_id)
+                for category_id
+                in _get_category_ids(instance.pk)
+            ]
+        return
+    elif action == "post_clear":
+        pairs = getattr(instance, "_archive_pairs", ())
+        delta = -1
+    elif action in ("post_add", "post_remove"):
+        if reverse:
+            pairs = [(article_id, instance.pk) for article_id in pk_set]
+        else:
+            pairs = [(instance.pk, category_id) for category_id in pk_set]
+        delta = 1 if action == "post_add" else -1
+    else:
+        return
+    # Adjust the counts of the online articles.
+    article_ids = set(article_id for article_id, _ in pairs)
+    with publication_manager.select_published(False):
+        news_feed_ids = dict(
+            Article.objects.filter(
+                id__in = article_ids,
+                is_online = True,
+            ).values_list("id", "news_feed_id")
+        )
+    for article_id, category_id in pairs:
+        if article_id in news_feed_ids:
+            ArchiveCategory.objects.adjust(delta,
+                news_feed_id = news_feed_ids[article_id],
+                category_id = category_id,
+            )
+    for news_feed_id in set(news_feed_ids.itervalues()):
+        invalidate_feed_cache(news_feed_id)
+
+
+def article_categories_changed_related(sender, instance, action, reverse, pk_set, **kwargs):
+    """Updates the related articles of articles whose categories have changed."""
+    if action == "pre_clear" and reverse:
+        instance._related_article_ids = list(Article.categories.through.objects.filter(category=instance).values_list("article_id", flat=True))
+    elif action == "post_clear":
+        related_articles_updater.queue(getattr(instance, "_related_article_ids", ()) if reverse else (instance.pk,))
+    elif action in ("post_add", "post_remove"):
+        related_articles_updater.queue(pk_set if reverse else (instance.pk,))
+
+
+def category_pre_save(sender, instance, raw=False, **kwargs):
+    """Records the stored title and URL title of a category before it is saved."""
+    instance._link_state = None
+    if instance.pk is not None and not raw:
+        with publication_manager.select_published(False):
+            try:
+                instance._link_state = Category.objects.filter(pk=instance.pk).values_list("url_title", "title")[0]
+            except IndexError:
+                pass
+
+
+def category_post_save(sender, instance, raw=False, **kwargs):
+    """Re-renders any HTML linking to a category whose URL or title has changed."""
+    old_link_state = getattr(instance, "_link_state", None)
+    if old_link_state is not None and old_link_state != (instance.url_title, instance.title):
+        rerender_html_references((instance,))
+
+
+def category_post_delete(sender, instance, **kwargs):
+    """Re-renders any HTML linking to a deleted category."""
+    rerender_html_references((instance,))
 
 
-externals.watson("register", Article, adapter_cls=PageBaseSearchAdapter)
\ No newline at end of file
+pre_save.connect(article_pre_save, sender=Article)
+post_save.connect(article_post_save, sender=Article)
+pre_delete.connect(article_pre_delete, sender=Article)
+post_delete.connect(article_post_delete, sender=Article)
+m2m_changed.connect(article_categories_changed, sender=Article.categories.through)
+m2m_changed.connect(article_categories_changed_related, sender=Article.categories.through)
+pre_save.connect(category_pre_save, sender=Category)
+post_save.connect(category_post_save, sender=Category)
+post_delete.connect(category_post_delete, sender=Category)
@@ -7,7 +7,8 @@ from django.utils.html import escape
 from django.contrib.contenttypes.models import ContentType
 
 from cms.apps.pages.models import Page
-from cms.apps.news.models import Article, NewsFeed, get_default_news_page
+from cms.models.managers import publication_manager
+from cms.apps.news.models import Article, NewsFeed, get_default_news_page, get_archive_dates, apply_article_profile, get_most_read_articles, get_related_articles
 
 
 register = template.Library()
@@ -42,7 +43,7 @@ def get_page_from_context(context, kwargs):
     if isinstance(page, int):
         page = Page.objects.get(id=page)
     if page and page.content_type_id != ContentType.objects.get_for_model(NewsFeed).id:
-        page = get_default_news_page()
+        page = get_default_news_page(context.get("request"))
     # All done.
     return page
     
@@ -53,7 +54,7 @@ def takes_current_page(func):
     def do_takes_current_page(context, *args, **kwargs):
         page = get_page_from_context(context, kwargs)
         if not page:
-            page = get_default_news_page()
+            page = get_default_news_page(context.get("request"))
         if page is None:
             raise template.VariableDoesNotExist("Could not determine the current page from the template context.")
         kwargs["page"] = page
@@ -67,7 +68,7 @@ def takes_article_page(func):
     def do_takes_article_page(context, article, *args, **kwargs):
         page = get_page_from_context(context, kwargs)
         if not page or page.id != article.news_feed_id:
-            page = article.news_feed.page
+            page = article.get_feed_page()
         kwargs["page"] = page
         return func(context, article, *args, **kwargs)
     return do_takes_article_page
@@ -88,7 +89,10 @@ def article_list(context, article_list):
 @takes_article_page
 def article_url(context, article, page):
     """Renders the URL for an article."""
-    return escape(article._get_permalink_for_page(page))
+    url = getattr(article, "_absolute_url", None)
+    if url is None:
+        url = article._get_permalink_for_page(page)
+    return escape(url)
     
     
 @register.inclusion_tag("news/includes/article_list_item.html", takes_context=True)
@@ -180,9 +184,13 @@ def article_meta(context, article):
 @takes_current_page
 def article_date_list(context, page):
     """Renders a list of dates."""
-    date_list = Article.objects.filter(
-        news_feed_id = page.id,
-    ).dates("date", "month").order_by("-date")
+    if publication_manager.select_published_active():
+        date_list = get_archive_dates(page.id)
+    else:
+        # The archive summary only counts online articles, so query them directly in preview mode.
+        date_list = Article.objects.filter(
+            news_feed_id = page.id,
+        ).dates("date", "month").order_by("-date")
     # Resolve the current year.
     current_year = context.get("year", None)
     if current_year is not None:
@@ -209,18 +217,20 @@ def article_date_list(context, page):
 @register.inclusion_tag("news/includes/article_latest_list.html", takes_context=True)
 @page_context
 @takes_current_page
-def article_latest_list(context, page, limit=5):
-    """Renders a widget-style list of latest articles."""
+def article_latest_list(context, page, limit=5, profile="title"):
+    """
+    Renders a widget-style list of latest articles.
+    
+    The profile names the article fields and relations to load. The default
+    only loads what is needed to link to each article.
+    """
     # Load the articles.
-    article_list = Article.objects.filter(
+    article_list = apply_article_profile(Article.objects.filter(
         news_feed__page__id = page.id,
-    ).select_related("image").prefetch_related(
-        "categories",
-        "authors",
-    )[:limit]
+    ), profile)[:limit]
     # Set the page for efficiency.
     for article in article_list:
-        article.page = page
+        article._feed_page = page
     return {
         "article_list": article_list,
         "page": page,
@@ -229,5 +239,50 @@ def article_latest_list(context, page, limit=5):
 
 @register.assignment_tag(takes_context=True)
 @takes_current_page    
-def get_article_latest_list(context, page, limit=5):
-    return article_latest_list(context, page=page, limit=limit)["article_list"]
\ No newline at end of file
+def get_article_latest_list(context, page, limit=5, profile="title"):
+    """
+    Returns the latest articles, loading the same profile as the
+    article_latest_list widget unless another is given.
+    """
+    return article_latest_list(context, page=page, limit=limit, profile=profile)["article_list"]
+
+
+@register.inclusion_tag("news/includes/article_most_read_list.html", takes_context=True)
+@page_context
+@takes_current_page
+def most_read(context, page, limit=5, profile="title"):
+    """
+    Renders a widget-style list of the most read articles.
+    
+    The ranking is read from a periodically refreshed cache, so may lag the
+    view counts by a few minutes.
+    """
+    article_list = get_most_read_articles(page.id, limit, profile)
+    # Set the page for efficiency.
+    for article in article_list:
+        article._feed_page = page
+    return {
+        "article_list": article_list,
+        "page": page,
+    }
+
+
+@register.inclusion_tag("news/includes/article_related_list.html", takes_context=True)
+@page_context
+@takes_article_page
+def related_articles(context, article, page, limit=5, profile="title"):
+    """
+    Renders a widget-style list of articles related to the given article.
+    
+    The related articles are precomputed, so are loaded in a single query.
+    """
+    article_list = get_related_articles(article, limit, profile)
+    # Set the page for efficiency.
+    for related_article in article_list:
+        if related_article.news_feed_id == page.id:
+            related_article._feed_page = page
+    return {
+        "article_list": article_list,
+        "page": page,
+    }
+
@@ -0,0 +1,514 @@
+"""Tests for the news app."""
+
+import datetime, gzip, os, tempfile
+from StringIO import StringIO
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import models
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.contrib.contenttypes.models import ContentType
+
+from cms import externals, permalinks
+from cms.counters import ViewCounter, view_counter
+from cms.models.fields import rerender_html_fields, rerender_queue
+from cms.templatetags.html import html
+from cms.apps.pages.models import Page
+from cms.apps.news.models import NewsFeed, Article, Category, ArchiveMonth, ArchiveCategory, rebuild_archive, get_archive_dates, get_archive_categories, apply_article_profile, rebuild_article_summaries, get_most_read_articles, rebuild_related_articles, get_related_articles, get_related_articles_count, related_articles_updater
+
+
+class NewsTestCase(TestCase):
+
+    def setUp(self):
+        with externals.watson.context_manager("update_index")():
+            self.page = Page.objects.create(
+                title = "News",
+                content_type = ContentType.objects.get_for_model(NewsFeed),
+            )
+            self.news_feed = NewsFeed.objects.create(
+                page = self.page,
+            )
+            self.articles = [
+                Article.objects.create(
+                    news_feed = self.news_feed,
+                    title = title,
+                    url_title = url_title,
+                    date = date,
+                    content = "<p>Article content.</p>",
+                )
+                for title, url_title, date
+                in (
+                    ("First", "first", datetime.date(2012, 1, 1)),
+                    ("Second", "second", datetime.date(2012, 1, 2)),
+                    ("Third", "third", datetime.date(2012, 1, 2)),
+                    ("Fourth", "fourth", datetime.date(2012, 1, 3)),
+                )
+            ]
+
+
+class ArticleDetailViewTest(NewsTestCase):
+
+    def testNeighboursOnSameDate(self):
+        first, second, third, fourth = self.articles
+        response = self.client.get(second.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["next_article"].id, first.id)
+        self.assertEqual(response.context["prev_article"].id, third.id)
+        response = self.client.get(third.get_absolute_url())
+        self.assertEqual(response.context["next_article"].id, second.id)
+        self.assertEqual(response.context["prev_article"].id, fourth.id)
+    
+    def testNoNeighbours(self):
+        first, second, third, fourth = self.articles
+        response = self.client.get(first.get_absolute_url())
+        self.assertEqual(response.context["next_article"], None)
+        response = self.client.get(fourth.get_absolute_url())
+        self.assertEqual(response.context["prev_article"], None)
+
+
+class ArticleCursorPaginationTest(NewsTestCase):
+    
+    def getArticleIds(self, response):
+        return [article.id for article in response.context["article_list"]]
+    
+    @override_settings(NEWS_CURSOR_PAGINATION=True)
+    def testWalkPages(self):
+        first, second, third, fourth = self.articles
+        NewsFeed.objects.filter(page=self.page).update(per_page=3)
+        # Load the first page.
+        response = self.client.get(self.page.get_absolute_url())
+        self.assertEqual(self.getArticleIds(response), [fourth.id, third.id, second.id])
+        page_obj = response.context["page_obj"]
+        self.assertEqual(page_obj.previous_cursor, None)
+        # Load the next page.
+        response = self.client.get(self.page.get_absolute_url(), {"cursor": page_obj.next_cursor})
+        self.assertEqual(self.getArticleIds(response), [first.id])
+        page_obj = response.context["page_obj"]
+        self.assertEqual(page_obj.next_cursor, None)
+        # Go back.
+        response = self.client.get(self.page.get_absolute_url(), {"cursor": page_obj.previous_cursor})
+        self.assertEqual(self.getArticleIds(response), [fourth.id, third.id, second.id])
+        self.assertEqual(response.context["page_obj"].previous_cursor, None)
+        
+    @override_settings(NEWS_CURSOR_PAGINATION=True)
+    def testInvalidCursor(self):
+        response = self.client.get(self.page.get_absolute_url(), {"cursor": "invalid"})
+        self.assertEqual(response.status_code, 404)
+
+
+class ArchiveSummaryTest(NewsTestCase):
+    
+    def getMonths(self):
+        return list(ArchiveMonth.objects.filter(count__gt=0).values_list("year", "month", "count"))
+    
+    def getCategories(self):
+        return list(ArchiveCategory.objects.filter(count__gt=0).values_list("category_id", "count"))
+    
+    def testArticleChanges(self):
+        first, second, third, fourth = self.articles
+        self.assertEqual(self.getMonths(), [(2012, 1, 4)])
+        # Move an article to another month.
+        second.date = datetime.date(2012, 2, 1)
+        second.save()
+        self.assertEqual(self.getMonths(), [(2012, 2, 1), (2012, 1, 3)])
+        # Take an article offline.
+        third.is_online = False
+        third.save()
+        self.assertEqual(self.getMonths(), [(2012, 2, 1), (2012, 1, 2)])
+        # Delete an article.
+        second.delete()
+        self.assertEqual(self.getMonths(), [(2012, 1, 2)])
+        
+    def testCategoryChanges(self):
+        first, second, third, fourth = self.articles
+        category = Category.objects.create(
+            title = "Category",
+            url_title = "category",
+        )
+        first.categories.add(category)
+        category.article_set.add(second, third)
+        self.assertEqual(self.getCategories(), [(category.id, 3)])
+        # Take an article offline.
+        third.is_online = False
+        third.save()
+        self.assertEqual(self.getCategories(), [(category.id, 2)])
+        # Remove the categories.
+        first.categories.clear()
+        self.assertEqual(self.getCategories(), [(category.id, 1)])
+        category.article_set.remove(second)
+        self.assertEqual(self.getCategories(), [])
+        
+    def testRebuild(self):
+        first, second, third, fourth = self.articles
+        category = Category.objects.create(
+            title = "Category",
+            url_title = "category",
+        )
+        first.categories.add(category)
+        months = self.getMonths()
+        categories = self.getCategories()
+        ArchiveMonth.objects.all().delete()
+        ArchiveCategory.objects.all().delete()
+        rebuild_archive()
+        self.assertEqual(self.getMonths(), months)
+        self.assertEqual(self.getCategories(), categories)
+        
+    def testScheduledArticles(self):
+        first, second, third, fourth = self.articles
+        category = Category.objects.create(
+            title = "Category",
+            url_title = "category",
+        )
+        tomorrow = timezone.now().date() + datetime.timedelta(days=1)
+        scheduled = Article.objects.create(
+            news_feed = self.news_feed,
+            title = "Scheduled",
+            url_title = "scheduled",
+            date = tomorrow,
+        )
+        scheduled.categories.add(category)
+        # Scheduled articles are counted, but not listed.
+        self.assertEqual(self.getCategories(), [(category.id, 1)])
+        self.assertEqual(get_archive_dates(self.page.id), [datetime.date(2012, 1, 1)])
+        self.assertEqual(list(get_archive_categories(self.page.id)), [])
+        first.categories.add(category)
+        self.assertEqual(list(get_archive_categories(self.page.id)), [category])
+        # The scheduled counts are cached for the day.
+        with self.assertNumQueries(1):
+            self.assertEqual(get_archive_dates(self.page.id), [datetime.date(2012, 1, 1)])
+        
+    def testCountsNotNegative(self):
+        ArchiveMonth.objects.adjust(-5, news_feed_id=self.page.id, year=2012, month=1)
+        self.assertEqual(self.getMonths(), [])
+        self.assertEqual(ArchiveMonth.objects.get(news_feed=self.page.id, year=2012, month=1).count, 0)
+        
+    def testArchiveDates(self):
+        self.assertEqual(get_archive_dates(self.page.id), [datetime.date(2012, 1, 1)])
+        self.assertEqual(get_archive_dates(self.page.id, year=2011), [])
+        # Check the archive views.
+        response = self.client.get(self.page.get_absolute_url())
+        self.assertEqual(list(response.context["date_list"]), [datetime.date(2012, 1, 1)])
+        response = self.client.get(self.page.reverse("article_year_archive", kwargs={"year": 2012}))
+        self.assertEqual(list(response.context["date_list"]), [datetime.date(2012, 1, 1)])
+
+
+class ArticleProfileTest(NewsTestCase):
+    
+    def testListProfile(self):
+        article = apply_article_profile(Article.objects.filter(id=self.articles[0].id), "list")[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(article.excerpt, "Article content.")
+            
+    def testUnknownProfile(self):
+        self.assertRaises(ValueError, lambda: apply_article_profile(Article.objects.all(), "unknown"))
+
+
+class ArticleSummaryTest(NewsTestCase):
+    
+    def testSummariesUpdatedOnSave(self):
+        article = self.articles[0]
+        article.content = "<p>First <b>paragraph</b>.</p><p>Second paragraph.</p>"
+        article.save()
+        article = Article.objects.get(id=article.id)
+        self.assertEqual(article.excerpt, "First paragraph.")
+        self.assertEqual(article.summary_html, "<p>First <b>paragraph</b>.</p><p>Second paragraph.</p>")
+        article.summary = "<p>Summary.</p>"
+        article.save()
+        self.assertEqual(Article.objects.get(id=article.id).summary_html, "<p>Summary.</p>")
+        
+    def testSummariesFollowLinkedPages(self):
+        with externals.watson.context_manager("update_index")():
+            page = Page.objects.create(
+                parent = self.page,
+                title = "About",
+                url_title = "about",
+                content_type = ContentType.objects.get_for_model(Page),
+            )
+            article = self.articles[0]
+            article.summary = u'<a href="{url}">About</a>'.format(url=permalinks.create(page))
+            article.save()
+            page.url_title = "about-us"
+            page.save()
+        self.assertEqual(Article.objects.get(id=article.id).get_summary_html(), u'<a href="/about-us/" title="About">About</a>')
+        # Summaries that have not been stored yet are processed on the fly.
+        Article.objects.filter(id=article.id).update(summary_html="")
+        self.assertEqual(Article.objects.get(id=article.id).get_summary_html(), u'<a href="/about-us/" title="About">About</a>')
+        
+    def testRebuildSummaries(self):
+        Article.objects.update(excerpt="", summary_html="")
+        self.assertEqual(rebuild_article_summaries(), 4)
+        self.assertEqual(rebuild_article_summaries(), 0)
+        self.assertEqual(Article.objects.get(id=self.articles[0].id).excerpt, "Article content.")
+
+
+class ArticleFeedViewTest(NewsTestCase):
+    
+    def testConditionalFeed(self):
+        feed_url = self.page.reverse("article_feed")
+        response = self.client.get(feed_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("First" in response.content)
+        etag = response["ETag"]
+        # An unchanged feed is not sent again.
+        response = self.client.get(feed_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(feed_url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+        # Weak validators and lists of validators are understood.
+        response = self.client.get(feed_url, HTTP_IF_NONE_MATCH='"other", W/{etag}'.format(etag=etag))
+        self.assertEqual(response.status_code, 304)
+        # Changing an article changes the feed.
+        article = self.articles[0]
+        article.title = "Changed"
+        article.save()
+        response = self.client.get(feed_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("Changed" in response.content)
+        self.assertNotEqual(response["ETag"], etag)
+    
+    def testFeedFollowsTreeChanges(self):
+        content_type = ContentType.objects.get_for_model(NewsFeed)
+        with externals.watson.context_manager("update_index")():
+            section = Page.objects.create(parent=self.page, title="Section", url_title="section", content_type=content_type)
+            NewsFeed.objects.create(page=section)
+            feed_page = Page.objects.create(parent=section, title="Feed", url_title="feed", content_type=content_type)
+            Article.objects.create(
+                news_feed = NewsFeed.objects.create(page=feed_page),
+                title = "Nested",
+                url_title = "nested",
+                date = datetime.date(2012, 1, 1),
+            )
+            response = self.client.get(feed_page.reverse("article_feed"))
+            self.assertTrue("/section/feed/" in response.content)
+            # Renaming an ancestor of the feed page changes the article URLs.
+            section.url_title = "renamed"
+            section.save()
+        response = self.client.get(Page.objects.get(id=feed_page.id).reverse("article_feed"))
+        self.assertTrue("/renamed/feed/" in response.content)
+        
+    def testGzipFeed(self):
+        response = self.client.get(self.page.reverse("article_feed"), HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertTrue("First" in gzip.GzipFile(fileobj=StringIO(response.content)).read())
+
+
+class ArticleUrlResolutionTest(NewsTestCase):
+    
+    def testResolveUrls(self):
+        expected_urls = [article.get_absolute_url() for article in reversed(self.articles)]
+        with self.assertNumQueries(2):
+            articles = list(Article.objects.resolve_urls())
+            self.assertEqual([article.get_absolute_url() for article in articles], expected_urls)
+            self.assertEqual(articles[0].get_feed_page().id, self.page.id)
+        # Cloned querysets keep resolving URLs.
+        with self.assertNumQueries(2):
+            article = Article.objects.resolve_urls().filter(id=self.articles[0].id)[0]
+            self.assertEqual(article.get_absolute_url(), self.articles[0].get_absolute_url())
+
+
+class ArticleViewCountTest(NewsTestCase):
+    
+    def testCountViews(self):
+        first, second, third, fourth = self.articles
+        # Forget views counted by other tests.
+        view_counter.discard()
+        for article, views in ((first, 1), (second, 3), (third, 2)):
+            for _ in xrange(views):
+                self.assertEqual(self.client.get(article.get_absolute_url()).status_code, 200)
+        self.assertEqual(view_counter.get_pending(second), 3)
+        # Views are only written when flushed.
+        self.assertEqual(Article.objects.get(id=second.id).view_count, 0)
+        self.assertEqual(view_counter.flush(), 3)
+        self.assertEqual(Article.objects.get(id=second.id).view_count, 3)
+        # Saving an article keeps its view count.
+        first.title = "Changed"
+        first.save()
+        self.assertEqual(Article.objects.get(id=first.id).view_count, 1)
+        # Check the ranking.
+        self.assertEqual([article.id for article in get_most_read_articles(self.page.id, limit=2)], [second.id, third.id])
+
+
+class MissingCounterModel(models.Model):
+    
+    view_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        app_label = "news"
+        managed = False
+        db_table = "news_missingcountermodel"
+
+
+class ViewCounterErrorTest(NewsTestCase):
+    
+    def testFlushErrorKeepsCounts(self):
+        counter = ViewCounter(max_pending=1)
+        obj = MissingCounterModel(id=1)
+        counter.count(obj)
+        self.assertEqual(counter.get_pending(obj), 1)
+        self.assertTrue(counter.is_due())
+        self.assertEqual(counter.flush(), 0)
+        self.assertEqual(counter.get_pending(obj), 1)
+        # Retries wait for the flush interval.
+        self.assertFalse(counter.is_due())
+        
+    def testFlushErrorDropsFailingCounts(self):
+        counter = ViewCounter()
+        obj = MissingCounterModel(id=1)
+        counter.count(obj)
+        for n in xrange(ViewCounter.max_failures):
+            self.assertEqual(counter.get_pending(obj), 1)
+            self.assertEqual(counter.flush(), 0)
+        self.assertEqual(counter.get_pending(obj), 0)
+        
+    def testFlushErrorKeepsOtherCounts(self):
+        counter = ViewCounter()
+        article = self.articles[0]
+        counter.count(MissingCounterModel(id=1))
+        counter.count(article)
+        self.assertEqual(counter.flush(), 1)
+        self.assertEqual(Article.objects.get(id=article.id).view_count, 1)
+
+
+class RelatedArticlesTest(NewsTestCase):
+    
+    def getRelatedIds(self, article):
+        return Article.objects.get(id=article.id).get_related_ids()
+    
+    def testRelatedArticles(self):
+        first, second, third, fourth = self.articles
+        category_a = Category.objects.create(title="A", url_title="a")
+        category_b = Category.objects.create(title="B", url_title="b")
+        first.categories.add(category_a, category_b)
+        category_a.article_set.add(second, fourth)
+        category_b.article_set.add(third, fourth)
+        self.assertEqual(self.getRelatedIds(first), [fourth.id, third.id, second.id])
+        self.assertEqual(self.getRelatedIds(second), [fourth.id, first.id])
+        # Removing a category updates the articles that listed the article.
+        fourth.categories.clear()
+        self.assertEqual(self.getRelatedIds(first), [third.id, second.id])
+        self.assertEqual(self.getRelatedIds(fourth), [])
+        # Adding a category updates the articles that should now list the article.
+        fourth.categories.add(category_b)
+        self.assertEqual(self.getRelatedIds(third), [fourth.id, first.id])
+        # Deferred updates are run once, at the end of the block.
+        with related_articles_updater.defer():
+            fourth.categories = [category_a]
+            self.assertEqual(self.getRelatedIds(third), [fourth.id, first.id])
+        self.assertEqual(self.getRelatedIds(third), [first.id])
+        self.assertEqual(self.getRelatedIds(second), [fourth.id, first.id])
+        # Rebuilding gives the same results.
+        related_ids = [self.getRelatedIds(article) for article in self.articles]
+        Article.objects.update(related_ids="")
+        self.assertEqual(rebuild_related_articles(), 4)
+        self.assertEqual([self.getRelatedIds(article) for article in self.articles], related_ids)
+        # The related articles are loaded in one query.
+        article = Article.objects.get(id=first.id)
+        with self.assertNumQueries(1):
+            self.assertEqual([related.id for related in get_related_articles(article)], [third.id, second.id, fourth.id])
+    
+    @override_settings(NEWS_RELATED_ARTICLES_COUNT=100)
+    def testRelatedArticlesCountFitsColumn(self):
+        self.assertRaises(ImproperlyConfigured, lambda: get_related_articles_count())
+
+
+class ImportArticlesTest(NewsTestCase):
+    
+    def importArticles(self, suffix, data):
+        handle, file_name = tempfile.mkstemp(suffix=suffix)
+        try:
+            os.write(handle, data)
+            os.close(handle)
+            call_command("importarticles", file_name, verbosity=0, batch_size=2)
+        finally:
+            os.unlink(file_name)
+    
+    def testImportNdjson(self):
+        self.importArticles(".ndjson", "\n".join((
+            '{"title": "Imported", "date": "2011-12-01", "content": "<p>Imported content.</p>", "categories": ["Legacy"]}',
+            '{"title": "Another", "date": "2011-12-02", "categories": ["legacy", "Other"]}',
+            '{"title": "Duplicate", "url_title": "first", "date": "2012-01-01"}',
+        )))
+        article = Article.objects.get(url_title="imported")
+        self.assertEqual(article.news_feed_id, self.page.id)
+        self.assertEqual(article.excerpt, "Imported content.")
+        self.assertEqual(list(article.categories.values_list("url_title", flat=True)), ["legacy"])
+        self.assertEqual(Article.objects.get(url_title="another").categories.count(), 2)
+        self.assertEqual(Article.objects.count(), 6)
+        # The derived data is rebuilt.
+        self.assertEqual(article.get_related_ids(), [Article.objects.get(url_title="another").id])
+        self.assertEqual(get_archive_dates(self.page.id), [datetime.date(2012, 1, 1), datetime.date(2011, 12, 1)])
+        
+    def testImportCsv(self):
+        self.importArticles(".csv", "\n".join((
+            "title,date,categories",
+            'Imported,2011-12-01,"Legacy, Other"',
+            'Extra,2011-12-02,"News & Events, !!!",extra cell',
+            'Short,2011-12-03',
+        )))
+        self.assertEqual(Article.objects.get(url_title="imported").categories.count(), 2)
+        self.assertEqual(list(Article.objects.get(url_title="extra").categories.values_list("url_title", flat=True)), ["news-events"])
+        self.assertEqual(Article.objects.get(url_title="short").categories.count(), 0)
+        
+    def testImportCategoriesSharingUrlTitle(self):
+        self.importArticles(".ndjson", "\n".join((
+            '{"title": "Imported", "date": "2011-12-01", "categories": ["News & Events"]}',
+            '{"title": "Another", "date": "2011-12-02", "categories": ["News Events"]}',
+        )))
+        self.assertEqual(list(Category.objects.values_list("url_title", flat=True)), ["news-events"])
+        self.assertEqual(Article.objects.get(url_title="another").categories.get().url_title, "news-events")
+
+
+class PrerenderedHtmlTest(NewsTestCase):
+    
+    def testPrerenderedContent(self):
+        with externals.watson.context_manager("update_index")():
+            page = Page.objects.create(
+                parent = self.page,
+                title = "About",
+                url_title = "about",
+                content_type = ContentType.objects.get_for_model(Page),
+            )
+            article = self.articles[0]
+            article.content = u'<p><a href="{url}">About</a></p>'.format(url=permalinks.create(page))
+            article.save()
+        # The rendered HTML is stored, and output without further queries.
+        article = Article.objects.get(id=article.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(html(article.content), u'<p><a href="/about/" title="About">About</a></p>')
+        # Changing the linked page re-renders the HTML.
+        with externals.watson.context_manager("update_index")():
+            page.url_title = "about-us"
+            page.save()
+        article = Article.objects.get(id=article.id)
+        self.assertEqual(html(article.content), u'<p><a href="/about-us/" title="About">About</a></p>')
+        # Editing the content discards the stored rendering.
+        article.content = u"<p>Edited.</p>"
+        self.assertEqual(getattr(article.content, "rendered", None), None)
+    
+    def testDeferredRerender(self):
+        with externals.watson.context_manager("update_index")():
+            pages = [
+                Page.objects.create(
+                    parent = self.page,
+                    title = title,
+                    url_title = title.lower(),
+                    content_type = ContentType.objects.get_for_model(Page),
+                )
+                for title in ("About", "Contact")
+            ]
+            article = self.articles[0]
+            article.content = u"".join(u'<a href="{url}">'.format(url=url) for url in permalinks.create_many(pages))
+            article.save()
+            # During a request, the HTML is re-rendered once the response is finished.
+            rerender_queue.begin()
+            pages[1].url_title = "contact-us"
+            pages[1].save()
+            self.assertEqual(html(Article.objects.get(id=article.id).content), u'<a href="/about/" title="About"><a href="/contact/" title="Contact">')
+            rerender_queue.flush()
+        self.assertEqual(html(Article.objects.get(id=article.id).content), u'<a href="/about/" title="About"><a href="/contact-us/" title="Contact">')
+        # References are searched for by content type, and matched exactly.
+        Article.objects.filter(id=article.id).update(content_rendered="")
+        self.assertEqual(rerender_html_fields([permalinks.create(self.page)]), 0)
+        self.assertEqual(rerender_html_fields(permalinks.create_many(pages), batch_size=1), 1)
@@ -1,14 +1,28 @@
 """Views used by the CMS news app."""
 
+import datetime, hashlib, re, time
+
+from django.conf import settings
+from django.core.cache import cache
 from django.views import generic
 from django.views.generic.list import BaseListView
 from django.shortcuts import get_object_or_404
 from django.utils.feedgenerator import DefaultFeed
-from django.http import HttpResponse
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from django.utils.text import compress_string
 
 from cms.views import PageDetailMixin
-from cms.apps.news.models import Article, Category
-from cms.html import process as process_html
+from cms.counters import count_view
+from cms.pagination import CursorPaginator, InvalidCursor
+from cms.models.managers import publication_manager
+from cms.apps.pages.models import get_tree_version
+from cms.apps.news.models import Article, Category, get_archive_dates, get_archive_categories, apply_article_profile, get_feed_cache_version
+
+
+RE_ACCEPTS_GZIP = re.compile(r"\bgzip\b")
 
 
 class ArticleListMixin(object):
@@ -25,27 +39,80 @@ class ArticleListMixin(object):
     
     context_object_name = "article_list"
     
+    # The field profile used to load the articles.
+    article_profile = "list"
+    
+    # Whether to read dates and categories from the archive summary.
+    use_archive_summary = True
+    
+    # The ordering used for cursor pagination. It must uniquely identify each article.
+    cursor_ordering = ("-date", "-id",)
+    
     def get_paginate_by(self, queryset):
         """Returns the number of articles to show per page."""
         return self.request.pages.current.content.per_page
     
+    def get_cursor_pagination(self):
+        """
+        Returns whether to paginate by cursor, rather than by page number.
+        
+        Enable with the NEWS_CURSOR_PAGINATION setting.
+        """
+        return getattr(settings, "NEWS_CURSOR_PAGINATION", False)
+    
+    def paginate_queryset(self, queryset, page_size):
+        """Paginates the queryset, by cursor if enabled."""
+        if not self.get_cursor_pagination():
+            return super(ArticleListMixin, self).paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size, self.cursor_ordering)
+        try:
+            page = paginator.page(self.request.GET.get(paginator.cursor_key))
+        except InvalidCursor, ex:
+            raise Http404(unicode(ex))
+        return (paginator, page, page.object_list, page.has_other_pages())
+    
+    def get_use_archive_summary(self):
+        """
+        Returns whether to read dates and categories from the archive summary.
+        
+        The summary only counts online articles, so live queries are used in
+        preview mode.
+        """
+        return self.use_archive_summary and publication_manager.select_published_active()
+    
+    def get_date_list(self, queryset, date_type):
+        """Returns the list of years or months, read from the archive summary if possible."""
+        if not self.get_use_archive_summary() or not date_type in ("year", "month",):
+            return super(ArticleListMixin, self).get_date_list(queryset, date_type)
+        news_feed_id = self.request.pages.current.id
+        if date_type == "year":
+            date_list = []
+            for date in get_archive_dates(news_feed_id):
+                if not date_list or date_list[-1].year != date.year:
+                    date_list.append(datetime.date(date.year, 1, 1))
+        else:
+            date_list = get_archive_dates(news_feed_id, year=int(self.get_year()))
+        if not date_list and not self.get_allow_empty():
+            raise Http404("No articles available")
+        return date_list
+    
     def get_context_data(self, **kwargs):
         """Returns the context data for the view."""
         context = super(ArticleListMixin, self).get_context_data(**kwargs)
-        category_list = Category.objects.filter(
-            article__news_feed__page = self.request.pages.current,
-        ).distinct()
+        if self.get_use_archive_summary():
+            category_list = get_archive_categories(self.request.pages.current.id)
+        else:
+            category_list = Category.objects.filter(
+                article__news_feed__page = self.request.pages.current,
+            ).distinct()
         context["category_list"] = category_list
         return context
     
     def get_queryset(self):
         """Returns the article queryset."""
-        return super(ArticleListMixin, self).get_queryset().prefetch_related(
-            "categories",
-            "authors",
-        ).select_related("image").filter(
+        return apply_article_profile(super(ArticleListMixin, self).get_queryset(), self.article_profile).filter(
             news_feed__page = self.request.pages.current,
-        ).order_by("-date")
+        ).order_by("-date", "-id")
 
 
 class ArticleArchiveView(ArticleListMixin, generic.ArchiveIndexView):
@@ -55,11 +122,21 @@ class ArticleArchiveView(ArticleListMixin, generic.ArchiveIndexView):
 
 class ArticleFeedView(ArticleListMixin, BaseListView):
     
-    """Generates an RSS feed of articles."""
+    """
+    Generates an RSS feed of articles.
     
-    def get(self, request):
-        """Generates the RSS feed."""
-        page = request.pages.current
+    Published feeds are cached until an article in the feed, the feed page or
+    the page tree changes, along with a gzipped copy. Clients polling with an ETag or
+    modification date receive a 304 response if the feed is unchanged.
+    """
+    
+    article_profile = "feed"
+    
+    # The number of articles in the feed.
+    feed_length = 30
+    
+    def generate_feed(self, page):
+        """Returns the content and mime type of the RSS feed for the given page."""
         # Write the feed headers.
         feed = DefaultFeed(
             title = page.title,
@@ -67,18 +144,75 @@ class ArticleFeedView(ArticleListMixin, BaseListView):
             description = page.meta_description,
         )
         # Write the feed items.
-        for article in self.get_queryset()[:30]:
+        for article in self.get_queryset()[:self.feed_length]:
             feed.add_item(
                 title = article.title,
-                link = article.get_absolute_url(),
-                description = process_html(article.summary or article.content),
+                link = article._get_permalink_for_page(page),
+                description = article.get_summary_html(),
                 pubdate = article.date,
             )
-        # Write the response.
-        content = feed.writeString("utf-8")
-        response = HttpResponse(content)
-        response["Content-Type"] = feed.mime_type
-        response["Content-Length"] = len(content)
+        return feed.writeString("utf-8"), feed.mime_type
+    
+    def get_cached_feed(self, page):
+        """Returns a dictionary describing the RSS feed for the given page, from the cache if possible."""
+        cache_key = "cms.apps.news.feed:{page_id}:{page_version}:{tree_version}:{feed_version}:{date}".format(
+            page_id = page.id,
+            page_version = page.version,
+            # Article URLs depend on the URLs of the ancestors of the page.
+            tree_version = get_tree_version(),
+            feed_version = get_feed_cache_version(page.id),
+            # Articles are published by date, so the feed changes every day.
+            date = timezone.now().date().isoformat(),
+        )
+        feed = cache.get(cache_key)
+        if feed is None:
+            content, mime_type = self.generate_feed(page)
+            etag = hashlib.md5(content).hexdigest()
+            feed = {
+                "content": content,
+                "gzip_content": compress_string(content),
+                "mime_type": mime_type,
+                "etag": etag,
+                "gzip_etag": u"{etag}-gzip".format(etag=etag),
+                "last_modified": int(time.time()),
+            }
+            cache.set(cache_key, feed, getattr(settings, "NEWS_FEED_CACHE_TIMEOUT", 60 * 60 * 24))
+        return feed
+    
+    def get(self, request):
+        """Generates the RSS feed."""
+        page = request.pages.current
+        # Don't cache previews.
+        if not publication_manager.select_published_active():
+            content, mime_type = self.generate_feed(page)
+            response = HttpResponse(content)
+            response["Content-Type"] = mime_type
+            response["Content-Length"] = len(content)
+            return response
+        # Load the feed.
+        feed = self.get_cached_feed(page)
+        use_gzip = RE_ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        etag = feed["gzip_etag"] if use_gzip else feed["etag"]
+        # Check for an unchanged feed.
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            # Weak validators match too, as the comparison is for a GET request.
+            not_modified = if_none_match.strip() == "*" or etag in parse_etags(if_none_match)
+        else:
+            if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+            not_modified = if_modified_since is not None and if_modified_since >= feed["last_modified"]
+        if not_modified:
+            response = HttpResponseNotModified()
+        else:
+            content = feed["gzip_content"] if use_gzip else feed["content"]
+            response = HttpResponse(content)
+            response["Content-Type"] = feed["mime_type"]
+            response["Content-Length"] = len(content)
+            if use_gzip:
+                response["Content-Encoding"] = "gzip"
+        response["ETag"] = quote_etag(etag)
+        response["Last-Modified"] = http_date(feed["last_modified"])
+        response["Vary"] = "Accept-Encoding"
         return response
 
 
@@ -101,22 +235,47 @@ class ArticleDetailView(ArticleListMixin, PageDetailMixin, generic.DateDetailVie
     
     context_object_name = "article"
     
+    article_profile = "full"
+    
+    # The fields loaded for the next and previous articles.
+    neighbour_fields = ("id", "news_feed", "date", "url_title", "title", "short_title",)
+    
+    def get_neighbour_queryset(self):
+        """
+        Returns the queryset used to find the next and previous articles.
+        
+        Only the fields needed to link to the articles are loaded, and
+        neighbours are found by keyset on (date, id), which is supported by
+        the (news_feed, date, id) index.
+        """
+        return Article.objects.filter(
+            news_feed_id = self.object.news_feed_id,
+        ).only(*self.neighbour_fields)
+    
+    def get(self, request, *args, **kwargs):
+        """Renders the article, counting the view."""
+        response = super(ArticleDetailView, self).get(request, *args, **kwargs)
+        if publication_manager.select_published_active():
+            count_view(self.object)
+        return response
+    
     def get_context_data(self, **kwargs):
         """Adds the next and previous articles to the context."""
         context = super(ArticleDetailView, self).get_context_data(**kwargs)
+        queryset = self.get_neighbour_queryset()
         # Get the next article.
         try:
-            next_article = self.get_queryset().filter(
-                date__lt = self.object.date,
-            )[0]
+            next_article = queryset.filter(
+                Q(date__lt=self.object.date) | Q(date=self.object.date, id__lt=self.object.id),
+            ).order_by("-date", "-id")[0]
         except IndexError:
             next_article = None
         context["next_article"] = next_article
         # Get the previous article.
         try:
-            prev_article = self.get_queryset().reverse().filter(
-                date__gt = self.object.date,
-            )[0]
+            prev_article = queryset.filter(
+                Q(date__gt=self.object.date) | Q(date=self.object.date, id__gt=self.object.id),
+            ).order_by("date", "id")[0]
         except IndexError:
             prev_article = None
         context["prev_article"] = prev_article
@@ -130,6 +289,9 @@ class ArticleCategoryArchiveView(PageDetailMixin, ArticleArchiveView):
     
     template_name = "news/article_category_archive.html"
     
+    # The archive summary does not count dates by category.
+    use_archive_summary = False
+    
     def get_queryset(self):
         """Returns the queryset filtered by category."""
         return super(ArticleCategoryArchiveView, self).get_queryset().filter(
@@ -8,6 +8,7 @@ standard implementation.
 
 from __future__ import with_statement
 
+from django.conf import settings
 from django.contrib import admin
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
@@ -15,7 +16,6 @@ from django.conf.urls import patterns, url
 from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction, models
-from django.db.models import F
 from django.http import Http404, HttpResponseRedirect, HttpResponse, HttpResponseForbidden
 from django.shortcuts import render, redirect, get_object_or_404
 from django import forms
@@ -23,7 +23,7 @@ from django.utils import simplejson as json
 
 from cms import debug, externals
 from cms.admin import PageBaseAdmin
-from cms.apps.pages.models import Page, get_registered_content, PageSearchAdapter
+from cms.apps.pages.models import Page, PageConflictError, get_registered_content, PageSearchAdapter, tree_backend, invalidate_tree_version
 
 
 # Used to track references to and from the JS sitemap.
@@ -35,6 +35,13 @@ PAGE_FROM_SITEMAP_VALUE = "sitemap"
 PAGE_TYPE_PARAMETER = "type"
 
 
+# The POST parameter used to submit the version of the edited page.
+PAGE_VERSION_PARAMETER = "_page_version"
+
+# The error shown when the edited page has been saved by another user.
+PAGE_CONFLICT_MESSAGE = "This page has been changed by another user since you started editing it. Please reload the page to see their changes."
+
+
 class PageAdmin(PageBaseAdmin):
 
     """Admin settings for Page models."""
@@ -56,6 +63,10 @@ class PageAdmin(PageBaseAdmin):
 
     search_adapter_cls = PageSearchAdapter
 
+    change_form_template = "admin/pages/page/change_form.html"
+
+    actions = PageBaseAdmin.actions + ("publish_selected_branches", "unpublish_selected_branches", "unschedule_selected_branches",)
+
     def _register_page_inline(self, model):
         """Registeres the given page inline with reversion."""
         if externals.reversion:
@@ -159,6 +170,13 @@ class PageAdmin(PageBaseAdmin):
         breadcrumbs.reverse()
         return breadcrumbs
 
+    def get_submitted_version(self, request):
+        """Returns the version of the page that the user started editing, or None."""
+        try:
+            return int(request.POST[PAGE_VERSION_PARAMETER])
+        except (KeyError, ValueError):
+            return None
+
     def get_form(self, request, obj=None, **kwargs):
         """Adds the template area fields to the form."""
         content_cls = self.get_page_content_cls(request, obj)
@@ -183,6 +201,15 @@ class PageAdmin(PageBaseAdmin):
                 )
             # Store the field.
             form_attrs[field.name] = form_field
+        # Check that nobody else has saved the page since it was loaded.
+        if obj and getattr(settings, "PAGES_OPTIMISTIC_LOCKING", False):
+            def clean(form):
+                cleaned_data = forms.ModelForm.clean(form)
+                version = self.get_submitted_version(request)
+                if getattr(request, "_page_conflict", False) or (version is not None and Page.objects.filter(id=obj.id).exclude(version=version).exists()):
+                    raise forms.ValidationError(PAGE_CONFLICT_MESSAGE)
+                return cleaned_data
+            form_attrs["clean"] = clean
         ContentForm = type("%sForm" % self.__class__.__name__, (forms.ModelForm,), form_attrs)
         defaults = {"form": ContentForm}
         defaults.update(kwargs)
@@ -229,7 +256,11 @@ class PageAdmin(PageBaseAdmin):
             if field.name == "page":
                 continue
             setattr(content_obj, field.name, form.cleaned_data[field.name])
-        # Save the model.
+        # Save the model, checking against the version of the page that was edited.
+        if change:
+            version = self.get_submitted_version(request)
+            if version is not None:
+                obj.version = version
         super(PageAdmin, self).save_model(request, obj, form, change)
         # Save the page content.
         content_obj.page = obj
@@ -241,6 +272,28 @@ class PageAdmin(PageBaseAdmin):
 
         obj.content = content_obj
 
+    # Custom admin actions.
+
+    def _update_selected_branches(self, request, queryset, **values):
+        """Updates the selected pages and all of their descendants."""
+        page_ids = Page.objects.update_branches(queryset, **values)
+        self.message_user(request, "{count} page(s) were updated.".format(count=len(page_ids)))
+
+    def publish_selected_branches(self, request, queryset):
+        """Publishes the selected pages and all of their descendants."""
+        self._update_selected_branches(request, queryset, is_online=True)
+    publish_selected_branches.short_description = "Place selected %(verbose_name_plural)s and their subpages online"
+
+    def unpublish_selected_branches(self, request, queryset):
+        """Unpublishes the selected pages and all of their descendants."""
+        self._update_selected_branches(request, queryset, is_online=False)
+    unpublish_selected_branches.short_description = "Take selected %(verbose_name_plural)s and their subpages offline"
+
+    def unschedule_selected_branches(self, request, queryset):
+        """Clears the publication and expiry dates of the selected pages and all of their descendants."""
+        self._update_selected_branches(request, queryset, publication_date=None, expiry_date=None)
+    unschedule_selected_branches.short_description = "Clear publication dates of selected %(verbose_name_plural)s and their subpages"
+
     # Permissions.
 
     def has_add_content_permission(self, request, model):
@@ -306,7 +359,13 @@ class PageAdmin(PageBaseAdmin):
         page = get_object_or_404(self.model, id=object_id)
         request._admin_change_obj = page
         # Call the change view.
-        return super(PageAdmin, self).change_view(request, object_id, *args, **kwargs)
+        try:
+            return super(PageAdmin, self).change_view(request, object_id, *args, **kwargs)
+        except PageConflictError:
+            # The page was saved elsewhere after the form was validated, so
+            # show the form again with the conflict as an error.
+            request._page_conflict = True
+            return super(PageAdmin, self).change_view(request, object_id, *args, **kwargs)
 
     def revision_view(self, request, object_id, *args, **kwargs):
         """Load up the correct content inlines."""
@@ -417,18 +476,10 @@ class PageAdmin(PageBaseAdmin):
         # Check that the user has permission to move pages.
         if not self.has_change_permission(request):
             return HttpResponseForbidden("You do not have permission to move this page.")
-        # Lock entire table.
-        existing_pages_list = Page.objects.all().select_for_update().values("id", "parent_id", "left", "right", "title").order_by("left")
-        existing_pages = dict(
-            (page["id"], page)
-            for page
-            in existing_pages_list
-        )
         # Get the page.
-        page = existing_pages[int(request.POST["page"])]
-        parent_id = page["parent_id"]
-        # Get all the siblings.
-        siblings = [s for s in existing_pages_list if s["parent_id"] == parent_id]
+        page = get_object_or_404(Page.objects.all().select_for_update().only("parent"), id=int(request.POST["page"]))
+        # Get all the siblings, in tree order.
+        siblings = list(Page.objects.filter(parent=page.parent_id).select_for_update().values("id", "left", "right", "path"))
         # Find the page to swap.
         direction = request.POST["direction"]
         if direction == "up":
@@ -439,33 +490,21 @@ class PageAdmin(PageBaseAdmin):
             raise ValueError("Direction should be 'up' or 'down'.")
         sibling_iter = iter(siblings)
         for sibling in sibling_iter:
-            if sibling["id"] == page["id"]:
+            if sibling["id"] == page.id:
                 break
         try:
             other_page = next(sibling_iter)
         except StopIteration:
             return HttpResponse("Page could not be moved, as nothing to swap with.")
-        # Put the pages in order.
-        first_page, second_page = sorted((page, other_page), key=lambda p: p["left"])
-        # Excise the first page.
-        Page.objects.filter(left__gte=first_page["left"], right__lte=first_page["right"]).update(
-            left = F("left") * -1,
-            right = F("right") * -1,
-        )
-        # Move the other page.
-        branch_width = first_page["right"] - first_page["left"] + 1
-        Page.objects.filter(left__gte=second_page["left"], right__lte=second_page["right"]).update(
-            left = F("left") - branch_width,
-            right = F("right") - branch_width,
-        )
-        # Put the page back in.
-        second_branch_width = second_page["right"] - second_page["left"] + 1
-        Page.objects.filter(left__lte=-first_page["left"], right__gte=-first_page["right"]).update(
-            left = (F("left") - second_branch_width) * -1,
-            right = (F("right") - second_branch_width) * -1,
-        )
+        # Put the pages in order, and swap them.
+        if direction == "up":
+            first_page, second_page = other_page, sibling
+        else:
+            first_page, second_page = sibling, other_page
+        tree_backend.swap_branches(Page, first_page, second_page)
+        invalidate_tree_version()
         # Report back.
-        return HttpResponse("Page #%s was moved %s." % (page["id"], direction))
+        return HttpResponse("Page #%s was moved %s." % (page.id, direction))
 
 
 admin.site.register(Page, PageAdmin)
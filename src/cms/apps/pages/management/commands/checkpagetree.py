@@ -0,0 +1,49 @@
+"""Checks the integrity of the page tree."""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from cms.apps.pages.models import Page, tree_backend
+from cms.apps.pages.tree import TreeError
+
+
+class Command(NoArgsCommand):
+    
+    help = "Checks the stored page tree against the page parents, optionally rebuilding it."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--rebuild",
+            action = "store_true",
+            default = False,
+            dest = "rebuild",
+            help = "Rebuild the stored page tree from the page parents if any problems are found.",
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        # Check the tree.
+        problem_count = 0
+        for problem in tree_backend.check(Page):
+            problem_count += 1
+            if verbosity >= 1:
+                self.stdout.write(problem.encode("utf-8") + "\n")
+        if not problem_count:
+            if verbosity >= 1:
+                self.stdout.write("The page tree is consistent.\n")
+            return
+        # Report the problems.
+        if not options["rebuild"]:
+            raise CommandError("Found {count} problem(s) in the page tree. Run with --rebuild to repair it.".format(
+                count = problem_count,
+            ))
+        # Rebuild the tree.
+        try:
+            updated_count = tree_backend.rebuild(Page)
+        except TreeError, ex:
+            raise CommandError(unicode(ex).encode("utf-8"))
+        if verbosity >= 1:
+            self.stdout.write("Rebuilt the page tree, updating {count} page(s).\n".format(
+                count = updated_count,
+            ))
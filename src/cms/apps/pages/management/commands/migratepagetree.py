@@ -0,0 +1,35 @@
+"""Populates the page tree columns of a different tree backend."""
+
+from django.core.management.base import LabelCommand, CommandError
+
+from cms.apps.pages.models import Page, tree_backend
+from cms.apps.pages.tree import load_tree_backend, TreeError
+
+
+class Command(LabelCommand):
+    
+    help = "Rebuilds the page tree for the given tree backend, keeping the sibling order of the current backend."
+    
+    args = "<backend_path>"
+    
+    label = "backend path"
+    
+    def handle_label(self, backend_name, **options):
+        verbosity = int(options.get("verbosity", 1))
+        try:
+            target_backend = load_tree_backend(backend_name)
+        except (ImportError, AttributeError), ex:
+            raise CommandError("Could not load the tree backend {name!r}: {ex}".format(
+                name = backend_name,
+                ex = ex,
+            ))
+        # Rebuild the tree.
+        try:
+            updated_count = target_backend.rebuild(Page, tree_backend.ordering)
+        except TreeError, ex:
+            raise CommandError(unicode(ex).encode("utf-8"))
+        if verbosity >= 1:
+            self.stdout.write("Rebuilt the page tree for {name}, updating {count} page(s).\n".format(
+                name = backend_name,
+                count = updated_count,
+            ))
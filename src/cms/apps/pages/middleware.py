@@ -11,6 +11,8 @@ from django.shortcuts import redirect
 from django.utils.functional import cached_property
 from django.template.response import SimpleTemplateResponse
 
+from cms.counters import count_view
+from cms.models import publication_manager
 from cms.apps.pages.models import Page
 
 
@@ -22,6 +24,7 @@ class RequestPageManager(object):
         """Initializes the RequestPageManager."""
         self._path = path
         self._path_info = path_info
+        self._default_pages = {}
         
     @cached_property
     def homepage(self):
@@ -31,6 +34,17 @@ class RequestPageManager(object):
         except Page.DoesNotExist:
             return None
         
+    def get_default_page(self, content_cls):
+        """
+        Returns the first page in the tree with the given content type, or
+        None. The page is only looked up once per request.
+        """
+        try:
+            return self._default_pages[content_cls]
+        except KeyError:
+            page = self._default_pages[content_cls] = Page.objects.get_default_page(content_cls)
+            return page
+        
     @property
     def is_homepage(self):
         """Whether the current request is for the site homepage."""
@@ -122,7 +136,10 @@ class PageMiddleware(object):
             if not response:
                 raise ValueError, "The view {0!r} didn't return an HttpResponse object.".format(callback.__name__)
             if isinstance(response, SimpleTemplateResponse):
-                return response.render()
+                response = response.render()
+            # Count views of the page itself, but not of previews.
+            if response.status_code == 200 and request.method == "GET" and request.pages.is_exact and publication_manager.select_published_active():
+                count_view(page)
             return response
         except Http404, ex:
             if settings.DEBUG:
@@ -1,15 +1,69 @@
 """Core models used by the CMS."""
 
+import operator
+import uuid
+
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core import urlresolvers
-from django.db import models, connection
-from django.db.models import Q, F
+from django.core.cache import cache
+from django.db import models, connection, transaction
+from django.db.models import Q
 from django.utils.functional import cached_property
 from django.utils import timezone
 
-from cms import sitemaps, externals
-from cms.models import PageBase, OnlineBaseManager, PageBaseSearchAdapter
+from cms import sitemaps, externals, permalinks
+from cms.models import PageBase, OnlineBaseManager, PageBaseSearchAdapter, ResolveUrlsQuerySet
 from cms.models.managers import publication_manager
+from cms.models.fields import rerender_html_references
+from cms.transactions import repeat_after_commit
+from cms.apps.pages.signals import branches_updated
+from cms.apps.pages.tree import load_tree_backend
+
+
+# The storage backend for the page tree.
+tree_backend = load_tree_backend()
+
+
+# Tree versioning.
+
+TREE_VERSION_CACHE_KEY = "cms.apps.pages.tree_version"
+
+# How long to remember the tree version. If the version is forgotten, a new one
+# is simply created, so this only affects the cache hit rate.
+TREE_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_tree_version():
+    """Returns the current version of the page tree, used to key cached tree lookups."""
+    version = cache.get(TREE_VERSION_CACHE_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(TREE_VERSION_CACHE_KEY, version, TREE_VERSION_TIMEOUT)
+        version = cache.get(TREE_VERSION_CACHE_KEY, version)
+    return version
+
+
+def _set_tree_version():
+    """Replaces the current version of the page tree."""
+    cache.set(TREE_VERSION_CACHE_KEY, uuid.uuid4().hex, TREE_VERSION_TIMEOUT)
+
+
+def invalidate_tree_version():
+    """
+    Invalidates all cached tree lookups, including cached permalink targets,
+    whose URLs can depend on the tree.
+    
+    During a request, they are invalidated again once the changes have been
+    committed, as other requests may have cached the old tree in the meantime.
+    """
+    repeat_after_commit(_set_tree_version)
+    permalinks.invalidate_all()
+
+
+class PageConflictError(Exception):
+    
+    """A page could not be saved, as it has been changed since it was loaded."""
 
 
 def get_default_page_parent():
@@ -20,6 +74,37 @@ def get_default_page_parent():
         return None
 
 
+def load_page_ancestors(pages):
+    """
+    Loads the ancestors of the given pages in a single query, and sets them as
+    their parents, so that get_absolute_url() needs no further queries.
+    """
+    ancestor_filters = [
+        tree_backend.get_ancestors_filter(page)
+        for page
+        in pages
+        if page.parent_id is not None
+    ]
+    if ancestor_filters:
+        all_pages = dict((page.id, page) for page in pages)
+        for page in Page.objects.filter(reduce(operator.or_, ancestor_filters)):
+            all_pages.setdefault(page.id, page)
+        for page in all_pages.itervalues():
+            parent = all_pages.get(page.parent_id)
+            if parent is not None:
+                page.parent = parent
+    return pages
+
+
+class PageQuerySet(ResolveUrlsQuerySet):
+    
+    """Queryset for Page models, able to load page ancestors in bulk."""
+    
+    def prepare_urls(self, pages):
+        """Loads the ancestors of the given pages in bulk."""
+        load_page_ancestors(pages)
+
+
 class PageManager(OnlineBaseManager):
     
     """Manager for Page objects."""
@@ -40,8 +125,7 @@ class PageManager(OnlineBaseManager):
                     SELECT *
                     FROM {pages_page} AS {ancestors}
                     WHERE
-                        {ancestors}.{left} < {page_alias}.{left} AND
-                        {ancestors}.{right} > {page_alias}.{right} AND (
+                        {is_ancestor} AND (
                             {ancestors}.{is_online} = FALSE OR
                             {ancestors}.{publication_date} > %s OR
                             {ancestors}.{expiry_date} <= %s
@@ -49,13 +133,12 @@ class PageManager(OnlineBaseManager):
                 )
             """.format(
                 page_alias = page_alias,
+                is_ancestor = tree_backend.get_ancestor_condition(quote_name("ancestors"), page_alias),
                 **dict(
                     (name, quote_name(name))
                     for name in (
                         "pages_page",
                         "ancestors",
-                        "left",
-                        "right",
                         "is_online",
                         "publication_date",
                         "expiry_date",
@@ -69,6 +152,84 @@ class PageManager(OnlineBaseManager):
     def get_homepage(self):
         """Returns the site homepage."""
         return self.prefetch_related("child_set__child_set").get(parent=None)
+    
+    def get_default_page(self, content_cls):
+        """
+        Returns the first page in the tree with the given content type, or None.
+        
+        The result is cached until the page tree changes. So that scheduled
+        publication is noticed, it also expires after the number of seconds in
+        the PAGES_DEFAULT_PAGE_CACHE_TIMEOUT setting.
+        """
+        content_type = ContentType.objects.get_for_model(content_cls)
+        cache_key = "cms.apps.pages.default_page:{content_type_id}:{published}:{version}".format(
+            content_type_id = content_type.id,
+            published = int(publication_manager.select_published_active()),
+            version = get_tree_version(),
+        )
+        pages = cache.get(cache_key)
+        if pages is None:
+            pages = list(self.filter(content_type=content_type)[:1])
+            cache.set(cache_key, pages, getattr(settings, "PAGES_DEFAULT_PAGE_CACHE_TIMEOUT", 60 * 5))
+        if pages:
+            return pages[0]
+        return None
+    
+    def get_query_set(self):
+        """Returns a PageQuerySet."""
+        return super(PageManager, self).get_query_set()._clone(klass=PageQuerySet)
+    
+    def resolve_urls(self):
+        """Returns a queryset that loads the ancestors of its pages in bulk."""
+        return self.get_query_set().resolve_urls()
+    
+    def get_with_ancestors(self, page_ids):
+        """
+        Returns a dictionary of the given pages, keyed by id.
+        
+        The ancestors of the pages are loaded in one extra query, and set as
+        their parents, so that get_absolute_url() needs no further queries.
+        """
+        return self.resolve_urls().in_bulk(page_ids)
+    
+    # Branch publication.
+    
+    BRANCH_FIELDS = ("is_online", "publication_date", "expiry_date",)
+    
+    def update_branches(self, pages, **values):
+        """
+        Updates the publication fields of the given pages and all of their
+        descendants in a single range update.
+        
+        Only the fields listed in BRANCH_FIELDS may be updated. A single
+        branches_updated signal is sent afterwards, listing every affected
+        page. Returns the list of affected page ids.
+        """
+        for name in values:
+            if not name in self.BRANCH_FIELDS:
+                raise ValueError("{name!r} cannot be updated on a whole branch.".format(name=name))
+        page_ids = [getattr(page, "pk", page) for page in pages]
+        if not page_ids or not values:
+            return []
+        with transaction.commit_on_success():
+            with publication_manager.select_published(False):
+                # Lock the selected pages, and read their current branch extents.
+                branches = list(Page.objects.filter(id__in=page_ids).select_for_update().only("left", "right", "path"))
+                if not branches:
+                    return []
+                queryset = Page.objects.filter(reduce(operator.or_, (
+                    tree_backend.get_branch_filter(branch)
+                    for branch in branches
+                )))
+                affected_ids = list(queryset.select_for_update().values_list("id", flat=True))
+                queryset.update(**values)
+        invalidate_tree_version()
+        branches_updated.send(
+            sender = self.model,
+            page_ids = affected_ids,
+            values = values,
+        )
+        return affected_ids
 
 
 class Page(PageBase):
@@ -87,12 +248,23 @@ class Page(PageBase):
         related_name = "child_set",
     )
 
+    # The nested set, only maintained by the nested set tree backend.
+    
     left = models.IntegerField(
+        null = True,
         editable = False,
         db_index = True,
     )
     
     right = models.IntegerField(
+        null = True,
+        editable = False,
+        db_index = True,
+    )
+    
+    path = models.CharField(
+        max_length = 255,
+        blank = True,
         editable = False,
         db_index = True,
     )
@@ -101,7 +273,7 @@ class Page(PageBase):
     def children(self):
         """The child pages for this page."""
         children = []
-        if self.right - self.left > 1:  # Optimization - don't fetch children we know aren't there!
+        if tree_backend.has_children(self):  # Optimization - don't fetch children we know aren't there!
             for child in self.child_set.all():
                 child.parent = self
                 children.append(child)
@@ -169,96 +341,83 @@ class Page(PageBase):
             return self.parent.get_absolute_url() + self.url_title + "/"
         return urlresolvers.get_script_prefix()
     
-    # Tree management.
+    # Concurrency control.
     
-    @property
-    def _branch_width(self):
-        return self.right - self.left + 1
-    
-    def _excise_branch(self):
-        """Excises this whole branch from the tree."""
-        branch_width = self._branch_width
-        Page.objects.filter(left__gte=self.left).update(
-            left = F("left") - branch_width,
-        )
-        Page.objects.filter(right__gte=self.left).update(
-            right = F("right") - branch_width,
-        )
+    version = models.PositiveIntegerField(
+        default = 0,
+        editable = False,
+    )
+    
+    # Popularity.
+    
+    view_count = models.PositiveIntegerField(
+        default = 0,
+        db_index = True,
+        editable = False,
+        help_text = "The number of times this page has been viewed. This is updated in batches by cms.counters.",
+    )
+    
+    def save(self, *args, **kwargs):
+        """
+        Saves the page.
         
-    def _insert_branch(self):
-        """Inserts this whole branch into the tree."""
-        branch_width = self._branch_width
-        Page.objects.filter(left__gte=self.left).update(
-            left = F("left") + branch_width,
-        )
-        Page.objects.filter(right__gte=self.left).update(
-            right = F("right") + branch_width,
-        )
+        Structural changes to the tree, i.e. inserting a page or moving it to
+        a new parent, are delegated to the tree backend, which locks whatever
+        it needs to. Other updates only lock the saved page, and increment its
+        version. If the PAGES_OPTIMISTIC_LOCKING setting is enabled, a
+        PageConflictError is raised when the page has been saved elsewhere
+        since it was loaded. The view count and position in the tree are
+        always taken from the locked row, so that views counted and changes
+        made to the tree since the page was loaded are kept.
         
-    def save(self, *args, **kwargs):
-        """Saves the page."""
-        # Lock entire table.
-        existing_pages = dict(
-            (page["id"], page)
-            for page
-            in Page.objects.all().select_for_update().values("id", "parent_id", "left", "right")
-        )
-        if self.left is None or self.right is None:
-            # This page is being inserted.
-            if existing_pages:
-                parent_right = existing_pages[self.parent_id]["right"]
-                # Set the model left and right.
-                self.left = parent_right
-                self.right = self.left + 1
-                # Update the whole tree structure.
-                self._insert_branch()
+        If the title or URL of the page changes, any pre-rendered HTML linking
+        to the page, or to its descendants if the URL changed, is re-rendered.
+        Cached tree lookups are only invalidated by changes to the structure,
+        URLs or publication of the tree, not by content-only edits.
+        """
+        linked_pages = ()
+        tree_changed = True
+        with publication_manager.select_published(False):
+            if tree_backend.is_new(self):
+                tree_backend.insert(self)
             else:
-                # This is the first page to be created, ever!
-                self.left = 1
-                self.right = 2
-        else:
-            # This is an update.
-            old_parent_id = existing_pages[self.id]["parent_id"]
-            if old_parent_id != self.parent_id:
-                # The page has moved.
-                branch_width = self.right - self.left + 1
-                # Disconnect child branch.
-                if branch_width > 2:
-                    Page.objects.filter(left__gt=self.left, right__lt=self.right).update(
-                        left = F("left") * -1,
-                        right = F("right") * -1,
-                    )
-                self._excise_branch()
-                # Store old left and right values.
-                old_left = self.left
-                old_right = self.right
-                # Put self into the tree.
-                parent_right = existing_pages[self.parent_id]["right"]
-                if parent_right > self.right:
-                    parent_right -= self._branch_width
-                self.left = parent_right
-                self.right = self.left + branch_width - 1
-                self._insert_branch()
-                # Put all children back into the tree.
-                if branch_width > 2:
-                    child_offset = self.left - old_left
-                    Page.objects.filter(left__lt=-old_left, right__gt=-old_right).update(
-                        left = (F("left") - child_offset) * -1,
-                        right = (F("right") - child_offset) * -1,
-                    )
-        # Now actually save it!
-        super(Page, self).save(*args, **kwargs)
+                # This is an update, so lock the page.
+                try:
+                    old_values = Page.objects.filter(id=self.id).select_for_update().values_list("parent_id", "url_title", "title", "version", "view_count", "left", "right", "path", *Page.objects.BRANCH_FIELDS)[0]
+                except IndexError:
+                    raise PageConflictError("Page #{id} has been deleted.".format(id=self.id))
+                old_parent_id, old_url_title, old_title, old_version, self.view_count, self.left, self.right, self.path = old_values[:8]
+                old_publication = old_values[8:]
+                if getattr(settings, "PAGES_OPTIMISTIC_LOCKING", False) and old_version != self.version:
+                    raise PageConflictError("Page #{id} has been changed since it was loaded.".format(id=self.id))
+                self.version = old_version + 1
+                if old_parent_id != self.parent_id:
+                    tree_backend.move(self)
+                if (old_parent_id, old_url_title) != (self.parent_id, self.url_title):
+                    linked_pages = Page.objects.filter(tree_backend.get_branch_filter(self)).only("id")
+                else:
+                    if old_title != self.title:
+                        linked_pages = (self,)
+                    tree_changed = old_publication != tuple(getattr(self, name) for name in Page.objects.BRANCH_FIELDS)
+            # Now actually save it!
+            super(Page, self).save(*args, **kwargs)
+            rerender_html_references(linked_pages)
+        if tree_changed:
+            invalidate_tree_version()
 
     def delete(self, *args, **kwargs):
-        """Deletes the page."""
-        list(Page.objects.all().select_for_update().values_list("left", "right"))  # Lock entire table.
-        super(Page, self).delete(*args, **kwargs)
-        # Update the entire tree.
-        self._excise_branch()
+        """Deletes the page, re-rendering any pre-rendered HTML linking to its branch."""
+        with publication_manager.select_published(False):
+            linked_pages = list(Page.objects.filter(tree_backend.get_branch_filter(self)).only("id"))
+            tree_backend.pre_delete(self)
+            super(Page, self).delete(*args, **kwargs)
+            tree_backend.post_delete(self)
+            rerender_html_references(linked_pages)
+        invalidate_tree_version()
 
     class Meta:
         unique_together = (("parent", "url_title",),)
-        ordering = ("left",)
+        ordering = (tree_backend.ordering,)
 
 
 externals.historylinks("register", Page)
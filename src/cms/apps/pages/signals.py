@@ -0,0 +1,8 @@
+"""Signals sent by the pages application."""
+
+from django.dispatch import Signal
+
+
+# Sent once after a bulk update of whole page branches. The page_ids argument
+# lists every affected page, and values contains the updated field values.
+branches_updated = Signal(providing_args=("page_ids", "values",))
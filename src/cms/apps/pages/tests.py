@@ -1,10 +1,21 @@
 """Tests for the pages app."""
 
+from django.contrib import admin
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 
 from cms import externals
-from cms.apps.pages.models import Page, ContentBase
+from cms.models.managers import publication_manager
+from cms.transactions import commit_hooks
+from cms.apps.pages import models as pages_models
+from cms.apps.pages.admin import PAGE_VERSION_PARAMETER, PAGE_CONFLICT_MESSAGE
+from cms.apps.pages.middleware import RequestPageManager
+from cms.apps.pages.models import Page, ContentBase, PageConflictError
+from cms.apps.pages.signals import branches_updated
+from cms.apps.pages.tree import check_nested_set, rebuild_nested_set, check_paths, rebuild_paths, PathTreeBackend
 
 
 class TestPageContent(ContentBase):
@@ -66,4 +77,210 @@ class PageEfficiencyTest(TestCase):
         self.assertEqual(subsubsection.title, "Subsubsection")
         with self.assertNumQueries(0):
             subsubsection = subsection.children[0]
-        self.assertEqual(subsubsection.title, "Subsubsection")
\ No newline at end of file
+        self.assertEqual(subsubsection.title, "Subsubsection")
+        
+    def testGetDefaultPage(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(Page.objects.get_default_page(TestPageContent).id, self.homepage.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(Page.objects.get_default_page(TestPageContent).id, self.homepage.id)
+        # Content-only edits keep the cached page.
+        self.homepage.title = "Home"
+        self.homepage.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(Page.objects.get_default_page(TestPageContent).id, self.homepage.id)
+        # Changing the publication of the tree invalidates the cached page.
+        self.homepage.is_online = False
+        self.homepage.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Page.objects.get_default_page(TestPageContent).id, self.homepage.id)
+        
+    def testGetDefaultPageCachedBeforeCommit(self):
+        commit_hooks.begin()
+        try:
+            self.homepage.is_online = False
+            self.homepage.save()
+            # Another request caches the page before the save is committed.
+            Page.objects.get_default_page(TestPageContent)
+        finally:
+            commit_hooks.flush()
+        with self.assertNumQueries(1):
+            Page.objects.get_default_page(TestPageContent)
+        
+    def testGetWithAncestors(self):
+        with self.assertNumQueries(2):
+            pages = Page.objects.get_with_ancestors([self.subsubsection.id, self.section.id])
+        self.assertEqual(sorted(pages), sorted([self.subsubsection.id, self.section.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual(pages[self.subsubsection.id].get_absolute_url(), self.subsubsection.get_absolute_url())
+            self.assertEqual(pages[self.section.id].get_absolute_url(), self.section.get_absolute_url())
+
+
+class PageTreeTestCase(TestCase):
+    
+    def setUp(self):
+        with externals.watson.context_manager("update_index")():
+            content_type = ContentType.objects.get_for_model(TestPageContent)
+            self.homepage = Page.objects.create(
+                title = "Homepage",
+                content_type = content_type,
+            )
+            self.section = Page.objects.create(
+                parent = self.homepage,
+                title = "Section",
+                url_title = "section",
+                content_type = content_type,
+            )
+            self.subsection = Page.objects.create(
+                parent = self.section,
+                title = "Subsection",
+                url_title = "subsection",
+                content_type = content_type,
+            )
+            self.other_section = Page.objects.create(
+                parent = self.homepage,
+                title = "Other section",
+                url_title = "other-section",
+                content_type = content_type,
+            )
+
+
+class PageBranchUpdateTest(PageTreeTestCase):
+    
+    def testUpdateBranches(self):
+        received = []
+        def receiver(sender, page_ids, values, **kwargs):
+            received.append((sorted(page_ids), values))
+        branches_updated.connect(receiver)
+        try:
+            with self.assertNumQueries(3):
+                page_ids = Page.objects.update_branches([self.section], is_online=False)
+        finally:
+            branches_updated.disconnect(receiver)
+        self.assertEqual(sorted(page_ids), sorted((self.section.id, self.subsection.id)))
+        self.assertEqual(received, [(sorted(page_ids), {"is_online": False})])
+        self.assertEqual(list(Page.objects.filter(is_online=False).order_by("left")), [self.section, self.subsection])
+        
+    def testUpdateBranchesRejectsOtherFields(self):
+        self.assertRaises(ValueError, lambda: Page.objects.update_branches([self.section], title="Foo"))
+
+
+class PageTreeMaintenanceTest(PageTreeTestCase):
+    
+    def getTree(self):
+        return list(Page.objects.order_by("left").values_list("id", "left", "right"))
+    
+    def testCheckConsistentTree(self):
+        self.assertEqual(list(check_nested_set(Page)), [])
+        self.assertEqual(rebuild_nested_set(Page), 0)
+        
+    def testRebuildDamagedTree(self):
+        tree = self.getTree()
+        Page.objects.filter(id=self.subsection.id).update(left=100, right=101)
+        Page.objects.filter(id=self.other_section.id).update(right=3)
+        self.assertTrue(list(check_nested_set(Page)))
+        self.assertEqual(rebuild_nested_set(Page), 2)
+        self.assertEqual(list(check_nested_set(Page)), [])
+        self.assertEqual(self.getTree(), tree)
+        
+    def testStaleContentUpdate(self):
+        # The stale section was loaded before a page was inserted before it.
+        with externals.watson.context_manager("update_index")():
+            Page.objects.create(
+                parent = self.homepage,
+                title = "New section",
+                url_title = "new-section",
+                content_type = self.section.content_type,
+            )
+            self.section.title = "Renamed section"
+            self.section.save()
+        self.assertEqual(list(check_nested_set(Page)), [])
+        
+    def testPathTreeBackend(self):
+        self.assertEqual(rebuild_paths(Page, "left"), 4)
+        self.assertEqual(list(check_paths(Page)), [])
+        self.assertEqual(list(Page.objects.order_by("path").values_list("id", flat=True)), [page_id for page_id, _, _ in self.getTree()])
+        nested_set_backend = pages_models.tree_backend
+        pages_models.tree_backend = PathTreeBackend()
+        try:
+            # Move the subsection, and swap the sections.
+            subsection = Page.objects.get(id=self.subsection.id)
+            subsection.parent = self.other_section
+            subsection.save()
+            pages_models.tree_backend.swap_branches(Page, *Page.objects.filter(parent=self.homepage).order_by("path").values("id", "path"))
+            self.assertEqual(list(check_paths(Page)), [])
+            self.assertEqual(list(Page.objects.order_by("path").values_list("id", flat=True)), [
+                self.homepage.id,
+                self.other_section.id,
+                self.subsection.id,
+                self.section.id,
+            ])
+            # Select a branch.
+            other_section = Page.objects.get(id=self.other_section.id)
+            self.assertEqual(Page.objects.filter(pages_models.tree_backend.get_branch_filter(other_section)).count(), 2)
+            subsection = Page.objects.get(id=self.subsection.id)
+            self.assertEqual(list(Page.objects.filter(pages_models.tree_backend.get_ancestors_filter(subsection)).order_by("path").values_list("id", flat=True)), [
+                self.homepage.id,
+                self.other_section.id,
+            ])
+            # New pages are not given nested set values.
+            with externals.watson.context_manager("update_index")():
+                new_page = Page.objects.create(
+                    parent = subsection,
+                    title = "New page",
+                    url_title = "new-page",
+                    content_type = subsection.content_type,
+                )
+            self.assertEqual((new_page.left, new_page.right), (None, None))
+            # Pages below an offline page are not published.
+            Page.objects.filter(id=self.other_section.id).update(is_online=False)
+            with publication_manager.select_published(True):
+                self.assertEqual(list(Page.objects.order_by("path").values_list("id", flat=True)), [
+                    self.homepage.id,
+                    self.section.id,
+                ])
+            # Delete a branch.
+            other_section.delete()
+            self.assertEqual(list(check_paths(Page)), [])
+        finally:
+            pages_models.tree_backend = nested_set_backend
+        # Switch back to the nested set.
+        self.assertEqual(rebuild_nested_set(Page, "path"), 2)
+        self.assertEqual(list(check_nested_set(Page)), [])
+
+
+class PageConcurrencyTest(TestCase):
+    
+    def setUp(self):
+        with externals.watson.context_manager("update_index")():
+            self.homepage = Page.objects.create(
+                title = "Homepage",
+                content_type = ContentType.objects.get_for_model(TestPageContent),
+            )
+    
+    def testContentUpdateDoesNotLockTree(self):
+        # Lock the page, then the standard Django existence check and update.
+        with self.assertNumQueries(3):
+            self.homepage.save()
+        self.assertEqual(self.homepage.version, 1)
+        
+    @override_settings(PAGES_OPTIMISTIC_LOCKING=True)
+    def testConflictingUpdate(self):
+        other_homepage = Page.objects.get(id=self.homepage.id)
+        other_homepage.title = "Other homepage"
+        other_homepage.save()
+        self.homepage.title = "Conflicting homepage"
+        self.assertRaises(PageConflictError, lambda: self.homepage.save())
+        self.assertEqual(Page.objects.get(id=self.homepage.id).title, "Other homepage")
+    
+    @override_settings(PAGES_OPTIMISTIC_LOCKING=True)
+    def testConflictingAdminUpdate(self):
+        request = RequestFactory().post("/", {PAGE_VERSION_PARAMETER: self.homepage.version})
+        request.pages = RequestPageManager("/", "/")
+        request.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        # A conflict found while saving is shown as a form error.
+        request._page_conflict = True
+        PageForm = admin.site._registry[Page].get_form(request, self.homepage)
+        form = PageForm(request.POST, instance=self.homepage)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), [PAGE_CONFLICT_MESSAGE])
@@ -0,0 +1,661 @@
+"""
+Storage backends and maintenance routines for the page tree.
+
+The position of every page in the tree is stored redundantly alongside its
+parent link, so that whole branches can be selected without recursive queries.
+Two representations are available, chosen by the PAGES_TREE_BACKEND setting:
+
+*   NestedSetTreeBackend (the default) stores left and right values. Selecting
+    a branch is a range query, but every structural change locks the whole
+    table and shifts the values of every page to the right of it.
+*   PathTreeBackend stores a materialized path. Selecting a branch is a prefix
+    query, and structural changes only lock and rewrite the affected branch.
+
+The stored tree can drift out of step with the parent links after interrupted
+transactions or manual SQL. The maintenance routines detect and repair such
+damage, streaming the tree so that memory use is bounded by the tree depth when
+checking, and by a few integers per page when rebuilding.
+"""
+
+from __future__ import with_statement
+
+import operator
+from array import array
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, F, Max
+
+from cms import loader
+from cms.models.managers import publication_manager
+
+
+class TreeError(Exception):
+
+    """Raised when the page tree cannot be rebuilt."""
+
+
+def _get_queryset(model):
+    """Returns an unfiltered queryset of all pages."""
+    with publication_manager.select_published(False):
+        return model._default_manager.all()
+
+
+def _load_tree(model, ordering):
+    """
+    Loads the tree of the given model, grouped by parent, with siblings sorted
+    by the given field. Every group of siblings becomes a contiguous range of the
+    returned arrays.
+
+    Returns the page ids, their current left and right values, stored as zero
+    where missing, and a dictionary mapping each parent id to the [start, end]
+    range of its children.
+    """
+    ids = array("l")
+    lefts = array("l")
+    rights = array("l")
+    child_ranges = {}
+    parent_column = u"{table}.{parent_id}".format(
+        table = model._meta.db_table,
+        parent_id = model._meta.get_field("parent").column,
+    )
+    rows = _get_queryset(model).select_for_update().extra(
+        order_by = (parent_column, ordering, "id"),
+    ).values_list("id", "parent_id", "left", "right").iterator()
+    for index, (page_id, parent_id, left, right) in enumerate(rows):
+        ids.append(page_id)
+        lefts.append(left or 0)
+        rights.append(right or 0)
+        child_range = child_ranges.get(parent_id)
+        if child_range is None:
+            child_ranges[parent_id] = [index, index + 1]
+        else:
+            child_range[1] = index + 1
+    return ids, lefts, rights, child_ranges
+
+
+def _walk_tree(ids, child_ranges):
+    """
+    Walks a loaded tree depth-first, without recursion.
+
+    Yields an (index, sibling_number) tuple on entering each page, and an
+    (index, None) tuple on leaving it. Raises a TreeError if any pages cannot be
+    reached from a root page.
+    """
+    visited = bytearray(len(ids))
+    start, end = child_ranges.get(None, (0, 0))
+    stack = [[start, start, end, None]]
+    while stack:
+        frame = stack[-1]
+        if frame[1] < frame[2]:
+            index = frame[1]
+            frame[1] += 1
+            visited[index] = 1
+            yield index, frame[1] - frame[0]
+            start, end = child_ranges.get(ids[index], (0, 0))
+            stack.append([start, start, end, index])
+        else:
+            stack.pop()
+            if frame[3] is not None:
+                yield frame[3], None
+    # Check that every page was reached from a root page.
+    if not all(visited):
+        unreachable_ids = [ids[index] for index in xrange(len(ids)) if not visited[index]]
+        raise TreeError(u"Some pages are not connected to a root page: {ids}".format(
+            ids = u", ".join(u"#{id}".format(id=page_id) for page_id in unreachable_ids),
+        ))
+
+
+def _write_pages(model, field_names, rows, batch_size=1000):
+    """
+    Writes the given field values to the pages of the given model in batches.
+
+    Each row contains the new field values, followed by the page id. Returns the
+    number of updated pages.
+    """
+    quote_name = connection.ops.quote_name
+    sql = u"UPDATE {table} SET {fields} WHERE {id} = %s".format(
+        table = quote_name(model._meta.db_table),
+        fields = u", ".join(
+            u"{column} = %s".format(column=quote_name(model._meta.get_field(field_name).column))
+            for field_name in field_names
+        ),
+        id = quote_name(model._meta.pk.column),
+    )
+    cursor = connection.cursor()
+    updated_count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            updated_count += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        updated_count += len(batch)
+    if updated_count:
+        transaction.set_dirty()
+    return updated_count
+
+
+# Nested sets.
+
+def check_nested_set(model):
+    """
+    Checks the nested set values of the given tree model against its parent
+    links, in a single streaming pass over the table in left order.
+
+    Yields a description of every problem found.
+    """
+    stack = []  # The (id, right) of each open ancestor of the current page.
+    expected = 1  # The next value that should appear in the nested set.
+    roots = 0
+    rows = _get_queryset(model).order_by("left", "id").values_list("id", "parent_id", "left", "right").iterator()
+    for page_id, parent_id, left, right in rows:
+        # Close all branches that end before this page.
+        while stack and stack[-1][1] < left:
+            branch_id, branch_right = stack.pop()
+            if branch_right != expected:
+                yield u"Page #{id} has right {right}, expected {expected}.".format(
+                    id = branch_id,
+                    right = branch_right,
+                    expected = expected,
+                )
+            expected = branch_right + 1
+        # Check the position of the page.
+        if left != expected:
+            yield u"Page #{id} has left {left}, expected {expected}.".format(
+                id = page_id,
+                left = left,
+                expected = expected,
+            )
+        if right <= left:
+            yield u"Page #{id} has right {right}, which is not greater than its left {left}.".format(
+                id = page_id,
+                left = left,
+                right = right,
+            )
+            right = left + 1
+        if stack and right >= stack[-1][1]:
+            yield u"Page #{id} overlaps the end of the branch of page #{parent_id}.".format(
+                id = page_id,
+                parent_id = stack[-1][0],
+            )
+            right = stack[-1][1] - 1
+        # Check the parent of the page.
+        expected_parent_id = stack[-1][0] if stack else None
+        if parent_id != expected_parent_id:
+            yield u"Page #{id} has parent #{parent_id}, but is positioned under #{expected_parent_id}.".format(
+                id = page_id,
+                parent_id = parent_id,
+                expected_parent_id = expected_parent_id,
+            )
+        if not stack:
+            roots += 1
+            if roots == 2:
+                yield u"Page #{id} is a second root page.".format(
+                    id = page_id,
+                )
+        stack.append((page_id, right))
+        expected = left + 1
+    # Close all remaining branches.
+    while stack:
+        branch_id, branch_right = stack.pop()
+        if branch_right != expected:
+            yield u"Page #{id} has right {right}, expected {expected}.".format(
+                id = branch_id,
+                right = branch_right,
+                expected = expected,
+            )
+        expected = branch_right + 1
+
+
+def rebuild_nested_set(model, ordering="left", batch_size=1000):
+    """
+    Rebuilds the nested set values of the given tree model from its parent links.
+
+    Siblings are ordered by the given field, which defaults to the existing left
+    values. The tree is walked with a linear depth-first search, and only pages
+    whose values have changed are updated. Returns the number of updated pages.
+    """
+    with transaction.commit_on_success():
+        ids, old_lefts, old_rights, child_ranges = _load_tree(model, ordering)
+        page_count = len(ids)
+        new_lefts = array("l", [0]) * page_count
+        new_rights = array("l", [0]) * page_count
+        counter = 0
+        for index, sibling_number in _walk_tree(ids, child_ranges):
+            counter += 1
+            if sibling_number is None:
+                new_rights[index] = counter
+            else:
+                new_lefts[index] = counter
+        return _write_pages(model, ("left", "right",), (
+            (new_lefts[index], new_rights[index], ids[index])
+            for index in xrange(page_count)
+            if new_lefts[index] != old_lefts[index] or new_rights[index] != old_rights[index]
+        ), batch_size)
+
+
+# Materialized paths.
+
+PATH_STEP_LENGTH = 4
+
+PATH_STEP_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def encode_path_step(sibling_number):
+    """Encodes the given one-based sibling number as a fixed-width path step."""
+    digits = []
+    while sibling_number:
+        sibling_number, digit = divmod(sibling_number, len(PATH_STEP_DIGITS))
+        digits.append(PATH_STEP_DIGITS[digit])
+    if len(digits) > PATH_STEP_LENGTH:
+        raise TreeError(u"A page cannot have more than {count} children.".format(
+            count = len(PATH_STEP_DIGITS) ** PATH_STEP_LENGTH - 1,
+        ))
+    digits.reverse()
+    return u"".join(digits).rjust(PATH_STEP_LENGTH, u"0")
+
+
+def check_paths(model):
+    """
+    Checks the materialized paths of the given tree model against its parent
+    links, in a single streaming pass over the table in path order.
+
+    Yields a description of every problem found.
+    """
+    stack = []  # The (path, id) of each open ancestor of the current page.
+    previous_path = None
+    roots = 0
+    rows = _get_queryset(model).order_by("path", "id").values_list("id", "parent_id", "path").iterator()
+    for page_id, parent_id, path in rows:
+        if not path or len(path) % PATH_STEP_LENGTH:
+            yield u"Page #{id} has an invalid path {path!r}.".format(
+                id = page_id,
+                path = path,
+            )
+            continue
+        if path == previous_path:
+            yield u"Page #{id} has the same path as another page.".format(
+                id = page_id,
+            )
+        previous_path = path
+        # Close all branches that do not contain this page.
+        while stack and not path.startswith(stack[-1][0]):
+            stack.pop()
+        # Check the parent of the page.
+        parent_path = path[:-PATH_STEP_LENGTH]
+        if not parent_path:
+            expected_parent_id = None
+            roots += 1
+            if roots == 2:
+                yield u"Page #{id} is a second root page.".format(
+                    id = page_id,
+                )
+        elif stack and stack[-1][0] == parent_path:
+            expected_parent_id = stack[-1][1]
+        else:
+            yield u"Page #{id} has the path {path!r}, but no page has the path of its parent.".format(
+                id = page_id,
+                path = path,
+            )
+            expected_parent_id = parent_id
+        if parent_id != expected_parent_id:
+            yield u"Page #{id} has parent #{parent_id}, but is positioned under #{expected_parent_id}.".format(
+                id = page_id,
+                parent_id = parent_id,
+                expected_parent_id = expected_parent_id,
+            )
+        stack.append((path, page_id))
+
+
+def rebuild_paths(model, ordering="path", batch_size=1000):
+    """
+    Rebuilds the materialized paths of the given tree model from its parent links.
+
+    Siblings are ordered by the given field, which defaults to the existing
+    paths. Returns the number of updated pages.
+    """
+    with transaction.commit_on_success():
+        ids, _, _, child_ranges = _load_tree(model, ordering)
+        def do_rebuild_paths():
+            stack = [u""]
+            for index, sibling_number in _walk_tree(ids, child_ranges):
+                if sibling_number is None:
+                    stack.pop()
+                else:
+                    path = stack[-1] + encode_path_step(sibling_number)
+                    stack.append(path)
+                    yield path, ids[index]
+        return _write_pages(model, ("path",), do_rebuild_paths(), batch_size)
+
+
+# Tree backends.
+
+class TreeBackend(object):
+
+    """
+    Base class for page tree storage backends.
+
+    Backends are always called from within a transaction, and are responsible
+    for locking the rows that they change.
+    """
+
+    # The field that orders pages depth-first.
+    ordering = None
+
+    def is_new(self, page):
+        """Returns whether the given page has not yet been placed in the tree."""
+        raise NotImplementedError
+
+    def insert(self, page):
+        """Places the given unsaved page in the tree, as the last child of its parent."""
+        raise NotImplementedError
+
+    def move(self, page):
+        """Moves the given page and its descendants to the end of its new parent."""
+        raise NotImplementedError
+
+    def pre_delete(self, page):
+        """Prepares the tree for the deletion of the given page and its descendants."""
+
+    def post_delete(self, page):
+        """Tidies the tree after the deletion of the given page and its descendants."""
+
+    def swap_branches(self, model, first_page, second_page):
+        """
+        Swaps the positions of two adjacent sibling pages, given as dictionaries
+        of their field values. The first page must come before the second.
+        """
+        raise NotImplementedError
+
+    def has_children(self, page):
+        """Returns False if the given page is known to have no children."""
+        return True
+
+    def get_branch_filter(self, page):
+        """Returns a Q object selecting the given page and its descendants."""
+        raise NotImplementedError
+
+    def get_ancestors_filter(self, page):
+        """Returns a Q object selecting the strict ancestors of the given page."""
+        raise NotImplementedError
+
+    def get_ancestor_condition(self, ancestor_alias, page_alias):
+        """
+        Returns an SQL condition that holds when the row aliased as
+        ancestor_alias is a strict ancestor of the row aliased as page_alias.
+        """
+        raise NotImplementedError
+
+    def check(self, model):
+        """Yields a description of every problem found in the stored tree."""
+        raise NotImplementedError
+
+    def rebuild(self, model, ordering=None):
+        """
+        Rebuilds the stored tree from the page parents, ordering siblings by the
+        given field. Returns the number of updated pages.
+        """
+        raise NotImplementedError
+
+
+class NestedSetTreeBackend(TreeBackend):
+
+    """Stores the page tree as nested set of left and right values."""
+
+    ordering = "left"
+
+    def _lock_tree(self, model):
+        """Locks the entire page table, returning the current tree structure."""
+        return dict(
+            (page["id"], page)
+            for page
+            in _get_queryset(model).select_for_update().values("id", "parent_id", "left", "right")
+        )
+
+    def _excise_branch(self, model, left, branch_width):
+        """Closes the gap left by a branch removed from the given position."""
+        _get_queryset(model).filter(left__gte=left).update(
+            left = F("left") - branch_width,
+        )
+        _get_queryset(model).filter(right__gte=left).update(
+            right = F("right") - branch_width,
+        )
+
+    def _insert_branch(self, model, left, branch_width):
+        """Opens a gap for a branch to be inserted at the given position."""
+        _get_queryset(model).filter(left__gte=left).update(
+            left = F("left") + branch_width,
+        )
+        _get_queryset(model).filter(right__gte=left).update(
+            right = F("right") + branch_width,
+        )
+
+    def is_new(self, page):
+        """Returns whether the given page has not yet been placed in the tree."""
+        return page.left is None or page.right is None
+
+    def insert(self, page):
+        """Places the given unsaved page in the tree, as the last child of its parent."""
+        model = page.__class__
+        existing_pages = self._lock_tree(model)
+        if existing_pages:
+            parent_right = existing_pages[page.parent_id]["right"]
+            # Set the model left and right.
+            page.left = parent_right
+            page.right = page.left + 1
+            # Update the whole tree structure.
+            self._insert_branch(model, page.left, 2)
+        else:
+            # This is the first page to be created, ever!
+            page.left = 1
+            page.right = 2
+
+    def move(self, page):
+        """Moves the given page and its descendants to the end of its new parent."""
+        model = page.__class__
+        queryset = _get_queryset(model)
+        existing_pages = self._lock_tree(model)
+        # Use the current position of the page, as it may have been moved by
+        # other changes to the tree since it was loaded.
+        page.left = existing_pages[page.id]["left"]
+        page.right = existing_pages[page.id]["right"]
+        branch_width = page.right - page.left + 1
+        # Disconnect child branch.
+        if branch_width > 2:
+            queryset.filter(left__gt=page.left, right__lt=page.right).update(
+                left = F("left") * -1,
+                right = F("right") * -1,
+            )
+        self._excise_branch(model, page.left, branch_width)
+        # Store old left and right values.
+        old_left = page.left
+        old_right = page.right
+        # Put self into the tree.
+        parent_right = existing_pages[page.parent_id]["right"]
+        if parent_right > page.right:
+            parent_right -= branch_width
+        page.left = parent_right
+        page.right = page.left + branch_width - 1
+        self._insert_branch(model, page.left, branch_width)
+        # Put all children back into the tree.
+        if branch_width > 2:
+            child_offset = page.left - old_left
+            queryset.filter(left__lt=-old_left, right__gt=-old_right).update(
+                left = (F("left") - child_offset) * -1,
+                right = (F("right") - child_offset) * -1,
+            )
+
+    def pre_delete(self, page):
+        """Locks the entire page table, and refreshes the position of the page."""
+        existing_pages = self._lock_tree(page.__class__)
+        page.left = existing_pages[page.id]["left"]
+        page.right = existing_pages[page.id]["right"]
+
+    def post_delete(self, page):
+        """Closes the gap left by the deleted branch."""
+        self._excise_branch(page.__class__, page.left, page.right - page.left + 1)
+
+    def swap_branches(self, model, first_page, second_page):
+        """Swaps the positions of two adjacent sibling pages."""
+        queryset = _get_queryset(model)
+        self._lock_tree(model)
+        # Excise the first page.
+        queryset.filter(left__gte=first_page["left"], right__lte=first_page["right"]).update(
+            left = F("left") * -1,
+            right = F("right") * -1,
+        )
+        # Move the second page.
+        branch_width = first_page["right"] - first_page["left"] + 1
+        queryset.filter(left__gte=second_page["left"], right__lte=second_page["right"]).update(
+            left = F("left") - branch_width,
+            right = F("right") - branch_width,
+        )
+        # Put the first page back in.
+        second_branch_width = second_page["right"] - second_page["left"] + 1
+        queryset.filter(left__lte=-first_page["left"], right__gte=-first_page["right"]).update(
+            left = (F("left") - second_branch_width) * -1,
+            right = (F("right") - second_branch_width) * -1,
+        )
+
+    def has_children(self, page):
+        """Returns False if the given page is known to have no children."""
+        return page.right - page.left > 1
+
+    def get_branch_filter(self, page):
+        """Returns a Q object selecting the given page and its descendants."""
+        return Q(left__gte=page.left, right__lte=page.right)
+
+    def get_ancestors_filter(self, page):
+        """Returns a Q object selecting the strict ancestors of the given page."""
+        return Q(left__lt=page.left, right__gt=page.right)
+
+    def get_ancestor_condition(self, ancestor_alias, page_alias):
+        """Returns an SQL condition selecting the strict ancestors of a page."""
+        quote_name = connection.ops.quote_name
+        return u"{ancestor}.{left} < {page}.{left} AND {ancestor}.{right} > {page}.{right}".format(
+            ancestor = ancestor_alias,
+            page = page_alias,
+            left = quote_name("left"),
+            right = quote_name("right"),
+        )
+
+    def check(self, model):
+        """Yields a description of every problem found in the nested set."""
+        return check_nested_set(model)
+
+    def rebuild(self, model, ordering=None):
+        """Rebuilds the nested set from the page parents."""
+        return rebuild_nested_set(model, ordering or self.ordering)
+
+
+class PathTreeBackend(TreeBackend):
+
+    """
+    Stores the page tree as materialized paths.
+
+    The path of each page is the path of its parent, followed by a fixed-width
+    step encoding its position among its siblings. The left and right values
+    are not maintained by this backend, and are left empty for new pages.
+    """
+
+    ordering = "path"
+
+    def _get_next_path(self, model, parent_id):
+        """Returns the path for a new last child of the given parent."""
+        queryset = _get_queryset(model)
+        if parent_id is None:
+            parent_path = u""
+        else:
+            # Locking the parent serializes the creation of its children.
+            parent_path = queryset.filter(id=parent_id).select_for_update().values_list("path", flat=True)[0]
+        last_path = queryset.filter(parent=parent_id).aggregate(path=Max("path"))["path"]
+        if last_path:
+            sibling_number = int(last_path[-PATH_STEP_LENGTH:], len(PATH_STEP_DIGITS)) + 1
+        else:
+            sibling_number = 1
+        return parent_path + encode_path_step(sibling_number)
+
+    def _replace_prefixes(self, model, replacements):
+        """
+        Replaces the prefixes of the paths of all pages in the given branches,
+        given as a sequence of (old_prefix, new_prefix) pairs.
+        """
+        rows = _get_queryset(model).filter(reduce(operator.or_, (
+            Q(path__startswith=old_prefix)
+            for old_prefix, _ in replacements
+        ))).select_for_update().values_list("id", "path")
+        def do_replace_prefixes():
+            for page_id, path in rows:
+                for old_prefix, new_prefix in replacements:
+                    if path.startswith(old_prefix):
+                        yield new_prefix + path[len(old_prefix):], page_id
+                        break
+        _write_pages(model, ("path",), do_replace_prefixes())
+
+    def is_new(self, page):
+        """Returns whether the given page has not yet been placed in the tree."""
+        return not page.path
+
+    def insert(self, page):
+        """Places the given unsaved page in the tree, as the last child of its parent."""
+        page.path = self._get_next_path(page.__class__, page.parent_id)
+
+    def move(self, page):
+        """Moves the given page and its descendants to the end of its new parent."""
+        model = page.__class__
+        old_path = _get_queryset(model).filter(id=page.id).values_list("path", flat=True)[0]
+        page.path = self._get_next_path(model, page.parent_id)
+        self._replace_prefixes(model, ((old_path, page.path),))
+
+    def swap_branches(self, model, first_page, second_page):
+        """Swaps the positions of two adjacent sibling pages."""
+        self._replace_prefixes(model, (
+            (first_page["path"], second_page["path"]),
+            (second_page["path"], first_page["path"]),
+        ))
+
+    def get_branch_filter(self, page):
+        """Returns a Q object selecting the given page and its descendants."""
+        return Q(path__startswith=page.path)
+
+    def get_ancestors_filter(self, page):
+        """Returns a Q object selecting the strict ancestors of the given page."""
+        return Q(path__in=[
+            page.path[:end]
+            for end
+            in xrange(PATH_STEP_LENGTH, len(page.path), PATH_STEP_LENGTH)
+        ])
+
+    def get_ancestor_condition(self, ancestor_alias, page_alias):
+        """
+        Returns an SQL condition selecting the strict ancestors of a page, as
+        the shorter paths that prefix its path. The percent sign is doubled, as
+        the condition is used with query parameters.
+        """
+        return u"{page}.{path} LIKE {ancestor}.{path} || '%%' AND {ancestor}.{path} < {page}.{path}".format(
+            ancestor = ancestor_alias,
+            page = page_alias,
+            path = connection.ops.quote_name("path"),
+        )
+
+    def check(self, model):
+        """Yields a description of every problem found in the paths."""
+        return check_paths(model)
+
+    def rebuild(self, model, ordering=None):
+        """Rebuilds the paths from the page parents."""
+        return rebuild_paths(model, ordering or self.ordering)
+
+
+def load_tree_backend(name=None):
+    """
+    Loads the tree backend with the given dotted path, defaulting to the
+    PAGES_TREE_BACKEND setting.
+    """
+    if name is None:
+        name = getattr(settings, "PAGES_TREE_BACKEND", "cms.apps.pages.tree.NestedSetTreeBackend")
+    return loader.load_object(name)()
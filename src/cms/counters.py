@@ -0,0 +1,174 @@
+"""
+Write-behind view counters.
+
+Writing to the database on every view would serialize busy pages on their row
+locks. Instead, views are counted in memory by each worker process, and
+periodically flushed to the view_count columns of the counted models, using a
+single UPDATE for each group of rows with the same number of new views.
+
+Counts held in memory are lost if a worker process is killed, so the totals are
+a close approximation rather than an exact audit.
+"""
+
+from __future__ import with_statement
+
+import atexit, logging, threading, time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F
+
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter(object):
+    
+    """
+    Buffers view counts in memory, and flushes them to the database in batches.
+    
+    Counts are flushed once the response that counted them has been sent, in
+    their own transactions, so that counting never holds up or fails a request,
+    and is not rolled back along with it.
+    """
+    
+    # The number of failed flushes after which the views of an object are dropped.
+    max_failures = 3
+    
+    def __init__(self, flush_interval=None, max_pending=None):
+        """Initializes the ViewCounter."""
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._failures = defaultdict(int)
+        self._last_flush = time.time()
+        self._retry_after = 0
+    
+    def get_flush_interval(self):
+        """Returns the number of seconds between flushes."""
+        if self.flush_interval is None:
+            return getattr(settings, "CMS_VIEW_COUNT_FLUSH_INTERVAL", 60)
+        return self.flush_interval
+    
+    def get_max_pending(self):
+        """Returns the number of counted objects that forces an early flush."""
+        if self.max_pending is None:
+            return getattr(settings, "CMS_VIEW_COUNT_MAX_PENDING", 1000)
+        return self.max_pending
+    
+    def count(self, obj, views=1):
+        """Counts views of the given object."""
+        with self._lock:
+            self._pending[(obj._meta.concrete_model, obj.pk)] += views
+    
+    def is_due(self):
+        """
+        Returns whether the pending counts are due to be written. After a failed
+        flush, nothing is due until the flush interval has passed.
+        """
+        now = time.time()
+        with self._lock:
+            if not self._pending or now < self._retry_after:
+                return False
+            return (
+                len(self._pending) >= self.get_max_pending() or
+                now - self._last_flush >= self.get_flush_interval()
+            )
+    
+    def get_pending(self, obj):
+        """Returns the number of views of the given object not yet written."""
+        with self._lock:
+            return self._pending.get((obj._meta.concrete_model, obj.pk), 0)
+    
+    def discard(self):
+        """Forgets all pending view counts, without writing them."""
+        with self._lock:
+            self._pending = defaultdict(int)
+            self._failures = defaultdict(int)
+            self._last_flush = time.time()
+            self._retry_after = 0
+    
+    def flush(self):
+        """
+        Writes all pending view counts to the database, committing each batch
+        separately. Returns the number of updated objects.
+        
+        A batch that fails is logged, and kept for a later flush, so that one
+        failing object does not hold back the rest. The views of an object that
+        fails max_failures times are dropped.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(int)
+            self._last_flush = time.time()
+        if not pending:
+            return 0
+        # Group the objects by model and number of new views.
+        batches = defaultdict(list)
+        for (model, pk), views in pending.iteritems():
+            batches[(model, views)].append(pk)
+        updated_count = 0
+        failed_keys = []
+        for (model, views), pks in batches.iteritems():
+            try:
+                with transaction.commit_on_success():
+                    model._base_manager.filter(pk__in=pks).update(
+                        view_count = F("view_count") + views,
+                    )
+            except DatabaseError:
+                logger.exception("Could not write the view counts of %s %s object(s).", len(pks), model.__name__)
+                failed_keys.extend((model, pk) for pk in pks)
+            else:
+                updated_count += len(pks)
+        with self._lock:
+            for key in failed_keys:
+                self._failures[key] += 1
+                if self._failures[key] < self.max_failures:
+                    # Keep the counts for a later flush.
+                    self._pending[key] += pending[key]
+                else:
+                    del self._failures[key]
+            if failed_keys:
+                self._retry_after = time.time() + self.get_flush_interval()
+        return updated_count
+    
+    def flush_if_due(self):
+        """Writes the pending view counts, if they are due."""
+        if self.is_due():
+            self.flush()
+
+
+# A single, thread-safe view counter for each worker process.
+view_counter = ViewCounter()
+
+
+def count_view(obj):
+    """Counts a view of the given object."""
+    view_counter.count(obj)
+
+
+def request_finished_receiver(**kwargs):
+    """
+    Writes the pending view counts once a response has been sent, if they are
+    due. This normally runs after the request has closed its database
+    connection, so a new connection is opened, and closed again afterwards.
+    """
+    if view_counter.is_due():
+        connection_closed = connection.connection is None
+        try:
+            view_counter.flush()
+        finally:
+            if connection_closed:
+                connection.close()
+
+
+request_finished.connect(request_finished_receiver)
+
+
+@atexit.register
+def flush_views():
+    """Writes any pending view counts on shutdown."""
+    view_counter.flush()
@@ -1,81 +1,220 @@
-"""HTML processing routines."""
+"""
+HTML processing routines.
+
+The HTML is scanned by a small tokenizer, rather than matched by a single
+regular expression. Each character of the text is examined a bounded number of
+times, so processing stays linear even on large or malformed documents, and
+only the tags that are changed are rebuilt.
+"""
 
 
 import re
 
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.utils.html import escape
 
-import optimizations
+from cms import permalinks, thumbnails
+
+
+# The start of a processed tag.
+RE_TAG_START = re.compile(ur"<(img|a)(?=[\s/>])", re.IGNORECASE)
+
+# The tokens within a tag. Every character matches one of the alternatives, so
+# each step consumes at least one character. An unclosed quoted value runs to
+# the end of the text, as it would in a browser.
+RE_TAG_TOKEN = re.compile(ur"""
+    (?P<end>/?>)
+    |
+    (?P<name>[^\s"'<>/=]+)(?:\s*=\s*(?P<value>"[^"]*(?:"|\Z)|'[^']*(?:'|\Z)|[^\s"'<>=`]+))?
+    |
+    (?P<open><)
+    |
+    [\s/"'=]+
+""", re.VERBOSE)
+
+
+# The attribute of each processed tag that can contain a permalink.
+LINK_ATTRS = {
+    "a": "href",
+    "img": "src",
+}
+
+
+class Tag(object):
+    
+    """An <a/> or <img/> tag found in a HTML document."""
+    
+    def __init__(self, text, name, start):
+        """Initializes the Tag."""
+        self.text = text
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attrs_end = None
+        self.attrs = {}
+    
+    def get(self, name):
+        """Returns the unquoted value of the given attribute, or None."""
+        span = self.attrs.get(name)
+        if span is None or span[0] == span[1]:
+            return None
+        value = self.text[span[0]:span[1]]
+        if value[0] in u"\"'":
+            value = value[1:-1]
+        return value
+    
+    def get_size(self):
+        """Returns the integer width and height of the tag, or None."""
+        try:
+            return int(self.get("width")), int(self.get("height"))
+        except (ValueError, TypeError):
+            return None
+    
+    def render(self, changes):
+        """
+        Returns the tag with the given attributes changed, leaving the rest of
+        the tag exactly as written.
+        """
+        output = []
+        pos = self.start
+        new_attrs = []
+        replaced_attrs = []
+        for name, value in changes.iteritems():
+            value = u'"{value}"'.format(value=value)
+            if name in self.attrs:
+                value_start, value_end = self.attrs[name]
+                if value_start == value_end:
+                    value = u"=" + value
+                replaced_attrs.append((value_start, value_end, value))
+            else:
+                new_attrs.append(u" {name}={value}".format(name=name, value=value))
+        for value_start, value_end, value in sorted(replaced_attrs):
+            output.append(self.text[pos:value_start])
+            output.append(value)
+            pos = value_end
+        output.append(self.text[pos:self.attrs_end])
+        output.extend(sorted(new_attrs))
+        output.append(self.text[self.attrs_end:self.end])
+        return u"".join(output)
+
+
+def iter_tags(text):
+    """Yields each complete <a/> and <img/> tag in the text, in order."""
+    pos = 0
+    while True:
+        match = RE_TAG_START.search(text, pos)
+        if match is None:
+            return
+        tag = Tag(text, match.group(1).lower(), match.start())
+        pos = tag.attrs_end = match.end()
+        while True:
+            token = RE_TAG_TOKEN.match(text, pos)
+            if token is None:
+                # The tag is not closed before the end of the text.
+                return
+            if token.group("open"):
+                # Another tag starts before this one is closed, so skip it.
+                break
+            pos = token.end()
+            if token.group("end"):
+                tag.end = pos
+                yield tag
+                break
+            name = token.group("name")
+            if name:
+                if token.group("value") is None:
+                    span = (token.end("name"), token.end("name"))
+                else:
+                    span = token.span("value")
+                tag.attrs.setdefault(name.lower(), span)
+                tag.attrs_end = pos
 
-from cms import permalinks
 
+def find_permalinks(text):
+    """Returns the set of candidate permalinks in <a/> and <img/> tags."""
+    candidates = set()
+    for tag in iter_tags(text):
+        value = tag.get(LINK_ATTRS[tag.name])
+        if value:
+            candidates.add(value)
+    return candidates
 
-RE_TAG = re.compile(ur"<(img|a)(\s+.*?)(/?)>", re.IGNORECASE)
 
-RE_ATTR = re.compile(ur"\s([\w-]+)=(\".*?\"|'.*?')", re.IGNORECASE)
+def get_tag_changes(tag, targets, images, block=None):
+    """
+    Returns a dictionary of the attributes of the tag to change. If block is
+    False, missing thumbnails are generated in the background.
+    """
+    changes = {}
+    attr_name = LINK_ATTRS[tag.name]
+    value = tag.get(attr_name)
+    target = targets.get(value)
+    if not target:
+        return changes
+    # Add in the URL and title of the obj.
+    changes[attr_name] = escape(target.url)
+    if not "title" in tag.attrs:
+        changes["title"] = escape(target.title)
+    # Automagically thumbnail sized images. Other tags linking to the same image
+    # just get its URL.
+    obj = images.get(value)
+    size = tag.get_size()
+    if obj and tag.name == "img" and size:
+        width, height = size
+        # Images that store their dimensions need no thumbnail at their own size.
+        if (getattr(obj, "width", None), getattr(obj, "height", None)) == (width, height):
+            return changes
+        # Automagically detect a FileField.
+        fieldname = None
+        for field in obj._meta.fields:
+            if isinstance(field, models.FileField):
+                fieldname = field.name
+        # Generate the thumbnail.
+        if fieldname:
+            thumbnail = thumbnails.get_thumbnail(getattr(obj, fieldname), width, height, "resize", block=block)
+            if thumbnail:
+                changes["src"] = escape(thumbnail.url)
+                changes["width"] = thumbnail.width
+                changes["height"] = thumbnail.height
+    return changes
 
 
-def process(text):
+def process(text, block=None):
     """
     Expands permalinks in <a/> and <img/> tags.
     
     Images will also be automatically thumbnailed to fit their specified width
-    and height.
+    and height. If block is False, or block is None and the
+    CMS_THUMBNAIL_NON_BLOCKING setting is True, missing thumbnails are queued
+    for a background worker, and the original image is used until they are
+    ready.
+    
+    The URLs and titles of the linked objects are taken from the shared
+    permalink cache. Only images that need thumbnailing are loaded from the
+    database, in one query per content type.
     """
-    resolved_permalinks = {}
-    def sub_tag(match):
-        tagname = match.group(1)
-        attrs = dict(RE_ATTR.findall(match.group(2)))
-        def get_obj(attr_name):
-            if attr_name in attrs:
-                value = attrs[attr_name][1:-1]
-                if not value in resolved_permalinks:
-                    try:
-                        resolved_permalinks[value] = permalinks.resolve(value)
-                    except (permalinks.PermalinkError, ObjectDoesNotExist):
-                        resolved_permalinks[value] = None
-                obj = resolved_permalinks[value]
-                if obj:
-                    # Add in the URL of the obj.
-                    attrs[attr_name] = '"%s"' % escape(obj.get_absolute_url())
-                    # Add in the title of the obj.
-                    attrs.setdefault("title", u'"%s"' % escape(getattr(obj, "title", unicode(obj))))
-                return obj
-            return None
-        if tagname == "a":
-            # Process hyperlinks.
-            get_obj("href")
-        elif tagname == "img":
-            # Process images.            
-            obj = get_obj("src")
-            if obj:
-                try:
-                    width = int(attrs["width"][1:-1])
-                    height = int(attrs["height"][1:-1])
-                except (ValueError, KeyError, TypeError):
-                    pass
-                else:
-                    # Automagically detect a FileField.
-                    fieldname = None
-                    for field in obj._meta.fields:
-                        if isinstance(field, models.FileField):
-                            fieldname = field.name
-                    # Generate the thumbnail.
-                    if fieldname:
-                        try:
-                            thumbnail = optimizations.get_thumbnail(getattr(obj, fieldname), width, height, "resize")
-                        except IOError:
-                            pass
-                        else:
-                            attrs["src"] = '"%s"' % escape(thumbnail.url)
-                            attrs["width"] = '"%s"' % thumbnail.width
-                            attrs["height"] = '"%s"' % thumbnail.height
-        else:
-            assert False
-        # Regenerate the html tag.
-        attrs = u" ".join(u"%s=%s" % (key, value) for key, value in sorted(attrs.iteritems()))
-        return u"<%s %s%s>" % (tagname, attrs, match.group(3))
-    return RE_TAG.sub(sub_tag, text)
-
+    tags = list(iter_tags(text))
+    targets = permalinks.expand_many(
+        value
+        for value
+        in (tag.get(LINK_ATTRS[tag.name]) for tag in tags)
+        if value
+    )
+    if not targets:
+        return text
+    images = permalinks.resolve_many(
+        tag.get("src")
+        for tag
+        in tags
+        if tag.name == "img" and tag.get("src") in targets and tag.get_size()
+    )
+    output = []
+    pos = 0
+    for tag in tags:
+        changes = get_tag_changes(tag, targets, images, block)
+        if changes:
+            output.append(text[pos:tag.start])
+            output.append(tag.render(changes))
+            pos = tag.end
+    output.append(text[pos:])
+    return u"".join(output)
@@ -0,0 +1,30 @@
+"""Re-renders the stored HTML of all pre-rendered HtmlFields."""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from cms.models.fields import rerender_html_fields
+
+
+class Command(NoArgsCommand):
+    
+    help = "Re-renders the stored HTML of all pre-rendered HtmlFields, such as after a deployment or a bulk import."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size",
+            action = "store",
+            type = "int",
+            default = 100,
+            dest = "batch_size",
+            help = "The number of objects to re-render in each transaction.",
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        updated_count = rerender_html_fields(batch_size=options["batch_size"])
+        if verbosity >= 1:
+            self.stdout.write("Re-rendered {count} object(s).\n".format(
+                count = updated_count,
+            ))
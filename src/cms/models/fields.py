@@ -1,16 +1,128 @@
 """Fields used by the page management application."""
 
-import urlparse
+from __future__ import with_statement
 
+import logging, operator, re, threading, urlparse
+
+from django.core import urlresolvers
+from django.core.signals import request_started, request_finished
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Q
 
+from cms import permalinks
 from cms.forms import HtmlWidget
+from cms.html import process as process_html
+from cms.models.managers import publication_manager
+
+
+logger = logging.getLogger(__name__)
+
+
+class PrerenderedHtml(unicode):
+    
+    """HTML text from a pre-rendered HtmlField, carrying its processed HTML."""
+    
+    def __new__(cls, value, rendered=None):
+        """Creates the PrerenderedHtml."""
+        obj = super(PrerenderedHtml, cls).__new__(cls, value)
+        obj.rendered = rendered
+        return obj
+    
+    
+class PrerenderedHtmlDescriptor(object):
+    
+    """
+    Accessor for a pre-rendered HtmlField.
+    
+    The stored HTML is returned as PrerenderedHtml, until it is changed.
+    """
+    
+    def __init__(self, field):
+        """Initializes the PrerenderedHtmlDescriptor."""
+        self.field = field
+        
+    def __get__(self, instance, owner):
+        """Returns the HTML, with its rendered HTML if it is up to date."""
+        if instance is None:
+            return self
+        try:
+            value = instance.__dict__[self.field.attname]
+        except KeyError:
+            raise AttributeError(self.field.attname)
+        rendered = instance.__dict__.get(self.field.rendered_attname)
+        if value and rendered:
+            return PrerenderedHtml(value, rendered)
+        return value
+    
+    def __set__(self, instance, value):
+        """Sets the HTML, forgetting the rendered HTML if it has changed."""
+        if instance.__dict__.get(self.field.attname, value) != value:
+            instance.__dict__[self.field.rendered_attname] = None
+        instance.__dict__[self.field.attname] = value
+
+
+def render_html(value):
+    """Returns the processed HTML for storage, waiting for any thumbnails."""
+    if value:
+        return process_html(value, block=True)
+    return u""
+
+
+# The (model, source field names, rendered attname, render function) of every
+# stored rendering of HTML.
+prerendered_html = []
+
+
+def register_prerendered_html(model, source_names, rendered_attname, render=render_html):
+    """
+    Registers a column of the given model that stores HTML rendered from the
+    given source fields, so that it is re-rendered when the objects it links to
+    change. The render function is called with the values of the source fields.
+    """
+    prerendered_html.append((model, tuple(source_names), rendered_attname, render))
 
 
 class HtmlField(models.TextField):
     
-    """A field that contains HTML data."""
+    """
+    A field that contains HTML data.
+    
+    If prerender is True, the processed HTML is stored in a companion
+    <name>_rendered column when the model is saved, and used by the html
+    template filter instead of processing the HTML on every request.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        """Initializes the HtmlField."""
+        self.prerender = kwargs.pop("prerender", False)
+        super(HtmlField, self).__init__(*args, **kwargs)
+    
+    def contribute_to_class(self, cls, name):
+        """Adds in the column for the rendered HTML, if required."""
+        super(HtmlField, self).contribute_to_class(cls, name)
+        if self.prerender and not cls._meta.abstract:
+            self.rendered_attname = "{name}_rendered".format(name=name)
+            models.TextField(
+                blank = True,
+                editable = False,
+            ).contribute_to_class(cls, self.rendered_attname)
+            setattr(cls, self.attname, PrerenderedHtmlDescriptor(self))
+            register_prerendered_html(cls, (self.attname,), self.rendered_attname)
+    
+    def get_prep_value(self, value):
+        """Converts any PrerenderedHtml into plain text."""
+        value = super(HtmlField, self).get_prep_value(value)
+        if isinstance(value, PrerenderedHtml):
+            value = unicode(value)
+        return value
+    
+    def pre_save(self, model_instance, add):
+        """Renders the HTML, if required, waiting for any thumbnails."""
+        value = super(HtmlField, self).pre_save(model_instance, add)
+        if self.prerender:
+            setattr(model_instance, self.rendered_attname, render_html(value))
+        return value
     
     def formfield(self, **kwargs):
         """Returns a HtmlWidget."""
@@ -18,6 +130,150 @@ class HtmlField(models.TextField):
         return super(HtmlField, self).formfield(**kwargs)
 
 
+def _group_references(references):
+    """
+    Groups the given permalinks by the URL prefix shared by the permalinks of
+    their content type. Returns a dictionary mapping each prefix to a set of
+    permalinks.
+    """
+    codec = permalinks.get_codec()
+    grouped_references = {}
+    for reference in references:
+        content_type_id, _ = codec.decode(reference)
+        prefix = codec.encode(content_type_id, u"")
+        if codec.suffix:
+            prefix = prefix[:-len(codec.suffix)]
+        grouped_references.setdefault(prefix, set()).add(reference)
+    return grouped_references
+
+
+def _find_referencing_pks(model, source_names, references):
+    """
+    Returns the pks of the objects of the given model whose source fields
+    contain one of the given permalinks.
+    
+    Each content type is searched for by its permalink prefix, in a single
+    query, and the permalinks found are then matched against the references.
+    """
+    codec = permalinks.get_codec()
+    pks = set()
+    for prefix, prefix_references in _group_references(references).iteritems():
+        permalink_re = re.compile(u"{prefix}[^/\"'<>\\s]+{suffix}".format(
+            prefix = re.escape(prefix),
+            suffix = re.escape(codec.suffix),
+        ))
+        for values in model._base_manager.filter(reduce(operator.or_, (
+            Q(**{u"{name}__contains".format(name=name): prefix})
+            for name in source_names
+        ))).values_list("pk", *source_names).iterator():
+            for value in values[1:]:
+                if value and any(match.group() in prefix_references for match in permalink_re.finditer(value)):
+                    pks.add(values[0])
+                    break
+    return pks
+
+
+def rerender_html_fields(references=None, batch_size=100):
+    """
+    Re-renders all stored HTML renderings, such as pre-rendered HtmlFields.
+    
+    If a list of permalinks is given as references, only HTML containing one
+    of them is re-rendered. Objects are re-rendered batch_size at a time, each
+    batch in its own transaction. Returns the number of updated objects.
+    """
+    if references is not None:
+        references = set(references)
+        if not references:
+            return 0
+    updated_count = 0
+    with publication_manager.select_published(False):
+        for model, source_names, rendered_attname, render in prerendered_html:
+            if references is None:
+                pks = list(model._base_manager.values_list("pk", flat=True))
+            else:
+                pks = sorted(_find_referencing_pks(model, source_names, references))
+            for start in xrange(0, len(pks), batch_size):
+                with transaction.commit_on_success():
+                    for values in model._base_manager.filter(pk__in=pks[start:start+batch_size]).values_list("pk", rendered_attname, *source_names):
+                        pk, rendered = values[:2]
+                        new_rendered = render(*values[2:])
+                        if new_rendered != rendered:
+                            model._base_manager.filter(pk=pk).update(**{rendered_attname: new_rendered})
+                            updated_count += 1
+    return updated_count
+
+
+class RerenderQueue(threading.local):
+    
+    """
+    Collects the permalinks whose pre-rendered HTML needs re-rendering during a
+    request, and re-renders it once the response has been sent, after the
+    request transaction has been committed. Outside of a request, HTML is
+    re-rendered straight away.
+    """
+    
+    def __init__(self):
+        """Initializes the RerenderQueue."""
+        super(RerenderQueue, self).__init__()
+        self._references = None
+    
+    def begin(self, **kwargs):
+        """Starts collecting references for the current request."""
+        self._references = set()
+    
+    def queue(self, references):
+        """Re-renders the HTML containing the given references, or queues them."""
+        if self._references is None:
+            rerender_html_fields(references)
+        else:
+            self._references.update(references)
+    
+    def flush(self, **kwargs):
+        """
+        Re-renders the HTML containing the queued references.
+        
+        This normally runs after the request has closed its database
+        connection, so the re-rendering opens a new connection, in its own
+        transaction, which is closed again afterwards.
+        """
+        references = self._references
+        self._references = None
+        if references:
+            connection_closed = connection.connection is None
+            try:
+                with transaction.commit_on_success():
+                    rerender_html_fields(references)
+            except Exception:
+                # The response has already been sent, so just report the problem.
+                logger.exception("Could not re-render the HTML for %s permalink(s).", len(references))
+            finally:
+                if connection_closed:
+                    connection.close()
+
+
+# A single, thread-safe queue of HTML to re-render.
+rerender_queue = RerenderQueue()
+
+request_started.connect(rerender_queue.begin)
+
+request_finished.connect(rerender_queue.flush)
+
+
+def rerender_html_references(objs):
+    """
+    Re-renders the stored HTML that links to the given objects. During a
+    request, this happens after the response has been sent.
+    """
+    if not prerendered_html:
+        return
+    try:
+        references = permalinks.create_many(objs)
+    except urlresolvers.NoReverseMatch:
+        # Permalinks are not enabled for this site.
+        return
+    rerender_queue.queue(references)
+
+
 class LinkResolutionError(Exception):
     
     """A link could not be resolved."""
@@ -4,8 +4,10 @@
 from __future__ import with_statement
 
 import threading, contextlib
+from itertools import islice
 
 from django.db import models
+from django.db.models.query import QuerySet
 
 
 class PublicationManagementError(Exception):
@@ -66,6 +68,63 @@ class PublicationManager(threading.local):
 publication_manager = PublicationManager()
 
 
+class ResolveUrlsQuerySet(QuerySet):
+    
+    """
+    Queryset that can prepare the absolute URLs of its objects in bulk, a
+    chunk at a time, as they are loaded.
+    
+    Subclasses should override prepare_urls().
+    """
+    
+    # The number of objects whose URLs are prepared together.
+    RESOLVE_URLS_CHUNK_SIZE = 100
+    
+    def __init__(self, *args, **kwargs):
+        """Initializes the ResolveUrlsQuerySet."""
+        super(ResolveUrlsQuerySet, self).__init__(*args, **kwargs)
+        self._resolve_urls = False
+    
+    def _clone(self, *args, **kwargs):
+        """Clones the queryset, keeping the URL resolution flag."""
+        clone = super(ResolveUrlsQuerySet, self)._clone(*args, **kwargs)
+        clone._resolve_urls = getattr(self, "_resolve_urls", False)
+        return clone
+    
+    def resolve_urls(self):
+        """
+        Returns a copy of this queryset that prepares the URLs of its objects
+        in bulk as they are loaded.
+        """
+        clone = self._clone()
+        clone._resolve_urls = True
+        return clone
+    
+    def prepare_urls(self, objs):
+        """
+        Prepares the given objects so that their get_absolute_url() methods
+        need no further queries.
+        """
+        raise NotImplementedError
+    
+    def iterator(self):
+        """Iterates over the objects, preparing their URLs if requested."""
+        iterator = super(ResolveUrlsQuerySet, self).iterator()
+        if not self._resolve_urls:
+            return iterator
+        return self._resolve_urls_iterator(iterator)
+    
+    def _resolve_urls_iterator(self, iterator):
+        """Prepares the URLs of the given objects, a chunk at a time."""
+        while True:
+            objs = list(islice(iterator, self.RESOLVE_URLS_CHUNK_SIZE))
+            if not objs:
+                break
+            self.prepare_urls(objs)
+            for obj in objs:
+                yield obj
+
+
 class PublishedBaseManager(models.Manager):
     
     """Manager that fetches published models."""
@@ -0,0 +1,164 @@
+"""
+Keyset pagination for large querysets.
+
+Offset pagination needs a COUNT query to number the pages, and gets slower the
+deeper a visitor reads, as the database must skip every preceding row. Cursor
+pagination instead filters the queryset on the ordering values of the last row
+seen, which is cheap at any depth given an index on the ordering fields. Pages
+are linked with opaque cursors rather than page numbers.
+"""
+
+import base64, operator
+
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from django.utils import simplejson as json
+
+
+class InvalidCursor(InvalidPage):
+
+    """Raised when a cursor cannot be decoded."""
+
+
+# Cursor directions.
+NEXT = "n"
+PREVIOUS = "p"
+
+
+class CursorPage(object):
+
+    """A page of items from a cursor paginator."""
+
+    def __init__(self, object_list, paginator, next_cursor, previous_cursor):
+        """Initializes the CursorPage."""
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.cursor_key = paginator.cursor_key
+
+    def __repr__(self):
+        return u"<Page after {cursor!r}>".format(cursor=self.previous_cursor)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        """Returns whether there is a page after this one."""
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        """Returns whether there is a page before this one."""
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        """Returns whether there are any other pages."""
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator(object):
+
+    """
+    Paginates a queryset by keyset on the given ordering fields.
+
+    The ordering fields should uniquely identify each row, so should usually
+    end with the primary key. No COUNT query is performed, so the number of
+    pages is never known.
+    """
+
+    def __init__(self, queryset, per_page, ordering, cursor_key="cursor"):
+        """Initializes the CursorPaginator."""
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.cursor_key = cursor_key
+        self._fields = [
+            (queryset.model._meta.get_field(name.lstrip("-")), name.startswith("-"))
+            for name in ordering
+        ]
+
+    def _encode_cursor(self, direction, obj):
+        """Returns an opaque cursor pointing to the given object."""
+        data = [direction] + [
+            field.value_to_string(obj)
+            for field, _ in self._fields
+        ]
+        return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":"))).rstrip("=")
+
+    def _decode_cursor(self, cursor):
+        """Returns the direction and ordering values of the given cursor."""
+        try:
+            data = json.loads(base64.urlsafe_b64decode(str(cursor) + "=" * (-len(cursor) % 4)))
+            direction = data[0]
+            values = data[1:]
+            if not direction in (NEXT, PREVIOUS) or len(values) != len(self._fields):
+                raise ValueError
+            return direction, [
+                field.to_python(value)
+                for (field, _), value
+                in zip(self._fields, values)
+            ]
+        except Exception:
+            raise InvalidCursor(u"Invalid cursor {cursor!r}.".format(cursor=cursor))
+
+    def _get_keyset_filter(self, values, reverse):
+        """Returns a Q object selecting the rows after the given ordering values."""
+        filters = []
+        for index, ((field, descending), value) in enumerate(zip(self._fields, values)):
+            lookup = "lt" if descending != reverse else "gt"
+            conditions = dict(
+                (previous_field.name, previous_value)
+                for (previous_field, _), previous_value
+                in zip(self._fields[:index], values[:index])
+            )
+            conditions[u"{name}__{lookup}".format(name=field.name, lookup=lookup)] = value
+            filters.append(Q(**conditions))
+        return reduce(operator.or_, filters)
+
+    def page(self, cursor=None):
+        """
+        Returns the page of items for the given cursor, or the first page if
+        no cursor is given.
+        """
+        queryset = self.queryset
+        if cursor:
+            direction, values = self._decode_cursor(cursor)
+        else:
+            direction, values = NEXT, None
+        reverse = direction == PREVIOUS
+        # Apply the ordering.
+        if reverse:
+            queryset = queryset.order_by(*[
+                name[1:] if name.startswith("-") else "-" + name
+                for name in self.ordering
+            ])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self._get_keyset_filter(values, reverse))
+        # Load one more item than needed, to see if there are more pages.
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if reverse:
+            object_list.reverse()
+            has_next = True
+            has_previous = has_more
+        else:
+            has_next = has_more
+            has_previous = values is not None
+        # Create the cursors.
+        next_cursor = None
+        previous_cursor = None
+        if object_list:
+            if has_next:
+                next_cursor = self._encode_cursor(NEXT, object_list[-1])
+            if has_previous:
+                previous_cursor = self._encode_cursor(PREVIOUS, object_list[0])
+        return CursorPage(object_list, self, next_cursor, previous_cursor)
@@ -5,14 +5,21 @@ A permalink is a model and object id encoded into a URL.  It allows the model to
 change it's absolute URL without breaking links.
 """
 
+import re, uuid
+from collections import defaultdict, namedtuple
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.contenttypes.views import shortcut
 from django.core import urlresolvers
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist, ValidationError
+from django.db.models.signals import post_save, post_delete
+from django.utils.encoding import iri_to_uri
 
+from cms.transactions import repeat_after_commit
 
-__all__ = ("PermalinkError", "create", "resolve", "expand",)
+
+__all__ = ("PermalinkError", "PermalinkTarget", "PermalinkCodec", "get_codec", "create", "create_many", "resolve", "resolve_many", "get_targets", "expand", "expand_many", "invalidate", "invalidate_all",)
 
 
 class PermalinkError(Exception):
@@ -20,16 +27,114 @@ class PermalinkError(Exception):
     """Exception thrown when an error occurs with a permalink."""
 
 
+# Placeholder ids, used to find where the ids go in a permalink URL.
+CONTENT_TYPE_ID_PLACEHOLDER = "1357924680"
+
+OBJECT_ID_PLACEHOLDER = "2468013579"
+
+
+class PermalinkCodec(object):
+    
+    """
+    Encodes and decodes the permalinks of a URLconf.
+    
+    The permalink_redirect URL is reversed once, and the resulting template is
+    used to create and parse permalinks directly, without calling the URL
+    resolver for each one.
+    """
+    
+    def __init__(self, urlconf=None):
+        """Initializes the PermalinkCodec."""
+        url = urlresolvers.reverse("permalink_redirect", urlconf=urlconf, prefix="/", kwargs={
+            "content_type_id": CONTENT_TYPE_ID_PLACEHOLDER,
+            "object_id": OBJECT_ID_PLACEHOLDER,
+        })
+        try:
+            self.prefix, rest = url.split(CONTENT_TYPE_ID_PLACEHOLDER)
+            self.separator, self.suffix = rest.split(OBJECT_ID_PLACEHOLDER)
+        except ValueError:
+            raise ImproperlyConfigured, "The permalink_redirect view should be configured using keyword arguments."
+        self.regex = re.compile(ur"^{prefix}(?P<content_type_id>\d+){separator}(?P<object_id>[^/]+){suffix}$".format(
+            prefix = re.escape(self.prefix),
+            separator = re.escape(self.separator),
+            suffix = re.escape(self.suffix),
+        ))
+    
+    def encode(self, content_type_id, object_id):
+        """Returns the permalink for the given content type id and object id."""
+        return u"".join((
+            urlresolvers.get_script_prefix(),
+            self.prefix[1:],
+            unicode(content_type_id),
+            self.separator,
+            iri_to_uri(unicode(object_id)),
+            self.suffix,
+        ))
+    
+    def decode(self, permalink):
+        """
+        Returns the content type id and object id encoded in the given permalink.
+        
+        Raises a PermalinkError if the URL is not a valid permalink.
+        """
+        try:
+            path = permalink
+            script_prefix = urlresolvers.get_script_prefix()
+            if path.startswith(script_prefix):
+                path = path[len(script_prefix)-1:]
+            match = self.regex.match(path)
+        except (AttributeError, TypeError):
+            match = None
+        if match is None:
+            raise PermalinkError, "'%s' is not a valid permalink." % permalink
+        return match.group("content_type_id"), match.group("object_id")
+
+
+# The permalink codec of each URLconf.
+_codecs = {}
+
+
+def get_codec():
+    """Returns the permalink codec for the current URLconf."""
+    urlconf = urlresolvers.get_urlconf()
+    codec = _codecs.get(urlconf)
+    if codec is None:
+        codec = _codecs[urlconf] = PermalinkCodec(urlconf)
+    return codec
+
+
 def create(obj):
     """Generates a permalink for the given object."""
     content_type = ContentType.objects.get_for_model(obj)
-    content_type_id = content_type.id
-    object_id = obj.pk
-    kwargs = {"content_type_id": content_type_id,
-              "object_id": object_id}
-    return urlresolvers.reverse("permalink_redirect", kwargs=kwargs)
-    
+    return get_codec().encode(content_type.id, obj.pk)
+
+
+def create_many(objs):
+    """
+    Generates permalinks for the given objects, looking up the content type of
+    each model only once. Returns a list of permalinks.
+    """
+    codec = get_codec()
+    content_type_ids = {}
+    permalinks = []
+    for obj in objs:
+        model = obj.__class__
+        content_type_id = content_type_ids.get(model)
+        if content_type_id is None:
+            content_type_id = content_type_ids[model] = ContentType.objects.get_for_model(obj).id
+        permalinks.append(codec.encode(content_type_id, obj.pk))
+    return permalinks
+
+
+def _parse(permalink):
+    """
+    Returns the content type id and object id encoded in the given permalink.
     
+    Raises a PermalinkError if the URL is not a valid permalink.
+    """
+    return get_codec().decode(permalink)
+
+
 def resolve(permalink):
     """
     Resolves the given permalink into an object.
@@ -37,26 +142,176 @@ def resolve(permalink):
     Raises a PermalinkError if the URL is not a valid permalink. Raises an
     ObjectDoesNotExist if the referenced object does not exist.
     """
-    # Attempt to resolve the URL.
-    try:
-        callback, _, callback_kwargs = urlresolvers.resolve(permalink)  # @UnusedVariable
-    except (urlresolvers.Resolver404, TypeError):
-        raise PermalinkError, "'%s' is not a valid permalink." % permalink
-    # Check if the URL refers to a permalink.
-    if callback != shortcut:
-        raise PermalinkError, "'%s' is not a valid permalink." % permalink
-    # Get the permalink attributes.
-    try:
-        content_type_id = callback_kwargs["content_type_id"]
-        object_id = callback_kwargs["object_id"]
-    except KeyError:
-        raise ImproperlyConfigured, "The permalink_redirect view should be configured using keyword arguments."
+    content_type_id, object_id = _parse(permalink)
     # Resolve the object. 
     content_type = ContentType.objects.get_for_id(content_type_id)
     obj = content_type.get_object_for_this_type(id=object_id)
     return obj
 
 
+def _get_model(content_type_id):
+    """Returns the model for the given content type id, or None."""
+    try:
+        return ContentType.objects.get_for_id(content_type_id).model_class()
+    except ContentType.DoesNotExist:
+        return None
+
+
+def _group_ids(ids):
+    """
+    Groups the given (content type id, object id) pairs by model.
+    
+    Returns a dictionary mapping each model to a dictionary of the given pairs
+    and their parsed object ids. Unknown models and invalid object ids are
+    left out.
+    """
+    grouped_ids = defaultdict(dict)
+    for content_type_id, object_id in ids:
+        model = _get_model(int(content_type_id))
+        if model is None:
+            continue
+        try:
+            grouped_ids[model][(content_type_id, object_id)] = model._meta.pk.to_python(object_id)
+        except ValidationError:
+            continue
+    return grouped_ids
+
+
+def _load_objects(model, object_ids):
+    """
+    Loads the objects of the given model, in a single query. If the base
+    manager of the model has a resolve_urls() method, it is used to load the
+    objects, so that their absolute URLs need no further queries.
+    """
+    manager = model._base_manager
+    if hasattr(manager, "resolve_urls"):
+        queryset = manager.resolve_urls()
+    else:
+        queryset = manager.all()
+    return queryset.in_bulk(object_ids)
+
+
+def resolve_many(permalinks):
+    """
+    Resolves the given permalinks into objects, loading the objects of each
+    content type in a single query.
+    
+    Returns a dictionary mapping each permalink to its object. Invalid
+    permalinks, and those whose objects do not exist, are left out.
+    """
+    ids = {}
+    for permalink in set(permalinks):
+        try:
+            ids[_parse(permalink)] = permalink
+        except PermalinkError:
+            continue
+    resolved_permalinks = {}
+    for model, object_ids in _group_ids(ids).iteritems():
+        objs = _load_objects(model, object_ids.values())
+        for key, object_id in object_ids.iteritems():
+            if object_id in objs:
+                resolved_permalinks[ids[key]] = objs[object_id]
+    return resolved_permalinks
+
+
+# Permalink target caching.
+
+PermalinkTarget = namedtuple("PermalinkTarget", ("url", "title",))
+
+PERMALINKS_VERSION_CACHE_KEY = "cms.permalinks.version"
+
+# How long to remember the version of the permalink cache. If the version is
+# forgotten, a new one is simply created, so this only affects the hit rate.
+PERMALINKS_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _get_version():
+    """Returns the current version of the permalink cache."""
+    version = cache.get(PERMALINKS_VERSION_CACHE_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(PERMALINKS_VERSION_CACHE_KEY, version, PERMALINKS_VERSION_TIMEOUT)
+        version = cache.get(PERMALINKS_VERSION_CACHE_KEY, version)
+    return version
+
+
+def _get_cache_key(version, published, model, object_id):
+    """Returns the cache key for the target of the given object."""
+    opts = model._meta.concrete_model._meta
+    return "cms.permalinks:{version}:{published}:{app_label}.{module_name}:{object_id}".format(
+        version = version,
+        published = int(published),
+        app_label = opts.app_label,
+        module_name = opts.module_name,
+        object_id = object_id,
+    )
+
+
+def get_targets(ids):
+    """
+    Returns the URLs and titles of the objects with the given (content type
+    id, object id) pairs, caching them between requests.
+    
+    Returns a dictionary mapping each pair to a PermalinkTarget. Pairs whose
+    objects do not exist, or have no absolute URL, are left out.
+    """
+    grouped_ids = _group_ids(set(ids))
+    if not grouped_ids:
+        return {}
+    # Imported here, as the cms models depend on this module.
+    from cms.models.managers import publication_manager
+    version = _get_version()
+    published = publication_manager.select_published_active()
+    cache_keys = {}
+    for model, object_ids in grouped_ids.iteritems():
+        for key, object_id in object_ids.iteritems():
+            cache_keys[key] = _get_cache_key(version, published, model, object_id)
+    cached_targets = cache.get_many(cache_keys.values())
+    targets = {}
+    new_targets = {}
+    for model, object_ids in grouped_ids.iteritems():
+        missing_object_ids = {}
+        for key, object_id in object_ids.iteritems():
+            target = cached_targets.get(cache_keys[key])
+            if target is None:
+                missing_object_ids[key] = object_id
+            else:
+                targets[key] = target
+        if not missing_object_ids:
+            continue
+        objs = _load_objects(model, missing_object_ids.values())
+        for key, object_id in missing_object_ids.iteritems():
+            obj = objs.get(object_id)
+            if obj is None or not hasattr(obj, "get_absolute_url"):
+                continue
+            target = targets[key] = PermalinkTarget(obj.get_absolute_url(), getattr(obj, "title", unicode(obj)))
+            new_targets[cache_keys[key]] = target
+    if new_targets:
+        cache.set_many(new_targets, getattr(settings, "PERMALINKS_CACHE_TIMEOUT", 60*5))
+    return targets
+
+
+def expand_many(permalinks):
+    """
+    Expands the given permalinks into their URLs and titles, using the shared
+    permalink cache.
+    
+    Returns a dictionary mapping each permalink to a PermalinkTarget. Invalid
+    permalinks, and those whose objects do not exist, are left out.
+    """
+    ids = {}
+    for permalink in set(permalinks):
+        try:
+            ids[_parse(permalink)] = permalink
+        except PermalinkError:
+            continue
+    return dict(
+        (ids[key], target)
+        for key, target
+        in get_targets(ids).iteritems()
+    )
+
+
 def expand(permalink):
     """
     Expands the given permalink into a full URL.
@@ -64,7 +319,59 @@ def expand(permalink):
     Raises a permalink error if the URL is not a valid permalink. Raises an
     ObjectDoesNotExist if the referenced object does not exist.
     """
-    obj = resolve(permalink)
-    return obj.get_absolute_url()
+    key = _parse(permalink)
+    try:
+        return get_targets((key,))[key].url
+    except KeyError:
+        raise ObjectDoesNotExist, "'%s' refers to an object that does not exist." % permalink
+
+
+def _delete_target(model, object_id):
+    """Removes the cached target of the object with the given model and id."""
+    version = _get_version()
+    cache.delete_many([
+        _get_cache_key(version, published, model, object_id)
+        for published
+        in (False, True)
+    ])
+
+
+def _set_version():
+    """Replaces the current version of the permalink cache."""
+    cache.set(PERMALINKS_VERSION_CACHE_KEY, uuid.uuid4().hex, PERMALINKS_VERSION_TIMEOUT)
+
+
+def invalidate(obj):
+    """
+    Removes the cached target of the given object.
+    
+    During a request, it is removed again once the changes have been
+    committed, as other requests may have cached the old target in the
+    meantime.
+    """
+    repeat_after_commit(_delete_target, obj._meta.concrete_model, obj.pk)
+
+
+def invalidate_all():
+    """
+    Removes all cached permalink targets, again once the changes have been
+    committed if called during a request.
+    """
+    repeat_after_commit(_set_version)
+
+
+def object_changed(sender, instance, **kwargs):
+    """
+    Removes the cached target of a saved or deleted object.
     
-    
\ No newline at end of file
+    Only objects with an absolute URL are ever cached as permalink targets, so
+    saves of other models, such as sessions, cost nothing.
+    """
+    if hasattr(sender, "get_absolute_url"):
+        invalidate(instance)
+
+
+post_save.connect(object_changed)
+
+post_delete.connect(object_changed)
+
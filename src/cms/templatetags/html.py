@@ -19,9 +19,15 @@ def html(text):
     The text is checked for permalinks embedded in <a> tags, expanding the
     permalinks to their referenced URL. Images containing a permalink source
     are checked for size and thumbnailed as appropriate.
+    
+    Text from a pre-rendered HtmlField is output as stored, without being
+    processed again.
     """
     if not text:
         return ""
+    rendered = getattr(text, "rendered", None)
+    if rendered is not None:
+        return mark_safe(rendered)
     text = process_html(text)
     return mark_safe(text)
 
@@ -51,4 +51,29 @@ def pagination_url(context, page_number):
         params.pop(context.get("pagination_key", "page"), None)
     if params:
         url += "?%s" % params.urlencode()
-    return escape(url)
\ No newline at end of file
+    return escape(url)
+
+
+@register.inclusion_tag("pagination/cursor_pagination.html", takes_context=True)
+def cursor_pagination(context, page_obj):
+    """Renders the next and previous links for the given page of a cursor paginator."""
+    return {
+        "request": context["request"],
+        "page_obj": page_obj,
+        "cursor_key": page_obj.cursor_key,
+    }
+
+
+@register.simple_tag(takes_context=True)
+def cursor_pagination_url(context, cursor):
+    """Renders the URL for the given cursor."""
+    request = context["request"]
+    url = request.path
+    params = request.GET.copy()
+    if cursor:
+        params[context.get("cursor_key", "cursor")] = cursor
+    else:
+        params.pop(context.get("cursor_key", "cursor"), None)
+    if params:
+        url += "?%s" % params.urlencode()
+    return escape(url)
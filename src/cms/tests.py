@@ -1,6 +1,33 @@
+import os, timeit
+from StringIO import StringIO
+
+from PIL import Image
+
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http import Http404
 from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
 
+from cms import permalinks, externals, thumbnails
+from cms.html import process, find_permalinks
+from cms.transactions import commit_hooks
+from cms.views import permalink_redirect
 from cms.models.fields import resolve_link, LinkResolutionError
+from cms.apps.pages.models import Page
+from cms.apps.media.models import File
+
+
+def get_thumbnail_paths():
+    """Returns the paths of all generated thumbnail files."""
+    return set(
+        os.path.join(dirpath, name)
+        for dirpath, _, names
+        in os.walk(default_storage.path("assets"))
+        for name in names
+    )
 
 
 class TestLinkField(TestCase):
@@ -10,4 +37,184 @@ class TestLinkField(TestCase):
         self.assertEqual(resolve_link("www.example.com/foo/"), "http://www.example.com/foo/")
         self.assertEqual(resolve_link("www.example.com"), "http://www.example.com/")
         self.assertEqual(resolve_link("/foo/"), "/foo/")
-        self.assertRaises(LinkResolutionError, lambda: resolve_link("foo/"))
\ No newline at end of file
+        self.assertRaises(LinkResolutionError, lambda: resolve_link("foo/"))
+
+
+class TestHtmlProcessing(TestCase):
+    
+    def setUp(self):
+        self.thumbnail_paths = get_thumbnail_paths()
+        with externals.watson.context_manager("update_index")():
+            content_type = ContentType.objects.get_for_model(Page)
+            self.homepage = Page.objects.create(
+                title = "Homepage",
+                content_type = content_type,
+            )
+            self.section = Page.objects.create(
+                parent = self.homepage,
+                title = "Section",
+                url_title = "section",
+                content_type = content_type,
+            )
+    
+    def tearDown(self):
+        thumbnails.thumbnail_queue.wait()
+        for path in get_thumbnail_paths() - self.thumbnail_paths:
+            os.unlink(path)
+    
+    def testBatchPermalinkResolution(self):
+        missing_permalink = permalinks.create(self.section).replace(str(self.section.id), "999")
+        text = u"".join(
+            u'<a href="{url}">Link</a>'.format(url=url)
+            for url
+            in (
+                permalinks.create(self.homepage),
+                permalinks.create(self.section),
+                permalinks.create(self.section),
+                missing_permalink,
+                "/other/",
+            )
+        )
+        # The pages are loaded in one query, and their ancestors in another.
+        with self.assertNumQueries(2):
+            processed_text = process(text)
+        self.assertEqual(processed_text, u"".join((
+            u'<a href="/" title="Homepage">Link</a>',
+            u'<a href="/section/" title="Section">Link</a>',
+            u'<a href="/section/" title="Section">Link</a>',
+            u'<a href="{url}">Link</a>'.format(url=missing_permalink),
+            u'<a href="/other/">Link</a>',
+        )))
+    
+    def testPermalinkCodec(self):
+        objs = [self.homepage, self.section] * 50
+        codec = permalinks.get_codec()
+        reverse, resolve = urlresolvers.reverse, urlresolvers.resolve
+        def resolver_called(*args, **kwargs):
+            raise AssertionError("The URL resolver was called.")
+        urlresolvers.reverse = urlresolvers.resolve = resolver_called
+        try:
+            with self.assertNumQueries(0):
+                links = permalinks.create_many(objs)
+                ids = [codec.decode(link) for link in links]
+        finally:
+            urlresolvers.reverse, urlresolvers.resolve = reverse, resolve
+        content_type_id = ContentType.objects.get_for_model(Page).id
+        self.assertEqual(links[1], reverse("permalink_redirect", kwargs={"content_type_id": content_type_id, "object_id": self.section.id}))
+        self.assertEqual(links[1], permalinks.create(self.section))
+        self.assertEqual(ids[1], (str(content_type_id), str(self.section.id)))
+        self.assertRaises(permalinks.PermalinkError, lambda: codec.decode(u"/r/x-1/"))
+        self.assertRaises(permalinks.PermalinkError, lambda: codec.decode(u"/other/r/1-1/"))
+    
+    def testPermalinkCache(self):
+        permalink = permalinks.create(self.section)
+        self.assertEqual(permalinks.expand(permalink), "/section/")
+        # The URL and title are now cached.
+        with self.assertNumQueries(0):
+            self.assertEqual(process(u'<a href="{url}">'.format(url=permalink)), u'<a href="/section/" title="Section">')
+        response = self.client.get(permalink)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "http://testserver/section/")
+        # Changing the page invalidates the cache.
+        with externals.watson.context_manager("update_index")():
+            self.section.url_title = "renamed"
+            self.section.save()
+        self.assertEqual(permalinks.expand(permalink), "/renamed/")
+        self.assertRaises(Http404, lambda: permalink_redirect(None, ContentType.objects.get_for_model(Page).id, "999"))
+    
+    def testPermalinkCachedBeforeCommit(self):
+        permalink = permalinks.create(self.section)
+        commit_hooks.begin()
+        try:
+            with externals.watson.context_manager("update_index")():
+                self.section.title = "Renamed"
+                self.section.save()
+            # Another request caches the old target before the save is committed.
+            cache.set(permalinks._get_cache_key(permalinks._get_version(), False, Page, self.section.id), permalinks.PermalinkTarget("/section/", "Section"))
+        finally:
+            commit_hooks.flush()
+        self.assertEqual(process(u'<a href="{url}">'.format(url=permalink)), u'<a href="/section/" title="Renamed">')
+    
+    def testUntouchedMarkup(self):
+        url = permalinks.create(self.section)
+        text = u"".join((
+            u"<IMG width=10 src='/static/a.png' alt=\"a > b\">",
+            u"<a\nclass='link' href='{url}' >Link</a>".format(url=url),
+            u"<a href=\"/other/\" title=\"Other\"/>",
+        ))
+        self.assertEqual(process(text), u"".join((
+            u"<IMG width=10 src='/static/a.png' alt=\"a > b\">",
+            u"<a\nclass='link' href=\"/section/\" title=\"Section\" >Link</a>",
+            u"<a href=\"/other/\" title=\"Other\"/>",
+        )))
+        # Malformed markup is left alone.
+        self.assertEqual(process(u"<a <a href='{url}'>".format(url=url)), u"<a <a href=\"/section/\" title=\"Section\">")
+        self.assertEqual(process(u"<a href='{url}".format(url=url)), u"<a href='{url}".format(url=url))
+    
+    def testNonBlockingThumbnails(self):
+        image_data = StringIO()
+        Image.new("RGB", (200, 100)).save(image_data, "PNG")
+        image = File(title="Image")
+        image.file.save("thumbnail-test.png", ContentFile(image_data.getvalue()))
+        try:
+            text = u'<img src="{url}" width="20" height="10">'.format(url=permalinks.create(image))
+            # The original image is used while the thumbnail is generated.
+            self.assertEqual(process(text, block=False), u'<img src="{url}" width="20" height="10" title="Image">'.format(url=image.file.url))
+            thumbnails.thumbnail_queue.wait()
+            thumbnail = thumbnails.get_thumbnail(image.file, 20, 10, block=False)
+            self.assertEqual((thumbnail.width, thumbnail.height), (20, 10))
+            self.assertEqual(process(text, block=False), u'<img src="{url}" width="20" height="10" title="Image">'.format(url=thumbnail.url))
+        finally:
+            image.file.delete()
+    
+    def testThumbnailFailure(self):
+        image = File(title="Broken image")
+        image.file.save("broken-thumbnail-test.png", ContentFile("Not an image"))
+        try:
+            self.assertEqual(thumbnails.get_thumbnail(image.file, 20, 10, block=True), None)
+            # The failure is cached.
+            self.assertEqual(cache.get(thumbnails.get_cache_key(image.file, 20, 10, "resize")), False)
+            self.assertEqual(process(u'<img src="{url}" width="20" height="10">'.format(url=permalinks.create(image))), u'<img src="{url}" width="20" height="10" title="Broken image">'.format(url=image.file.url))
+        finally:
+            image.file.delete()
+    
+    def testUnsizedLinksToThumbnailedImage(self):
+        image_data = StringIO()
+        Image.new("RGB", (200, 100)).save(image_data, "PNG")
+        image = File(title="Image")
+        image.file.save("thumbnail-test.png", ContentFile(image_data.getvalue()))
+        try:
+            url = permalinks.create(image)
+            thumbnail = thumbnails.get_thumbnail(image.file, 20, 10, block=True)
+            # A link to the same image.
+            self.assertEqual(process(u'<img src="{url}" width="20" height="10"><a href="{url}">'.format(url=url)), u'<img src="{thumbnail_url}" width="20" height="10" title="Image"><a href="{image_url}" title="Image">'.format(
+                thumbnail_url = thumbnail.url,
+                image_url = image.file.url,
+            ))
+            # An unsized copy of the same image.
+            self.assertEqual(process(u'<img src="{url}" width="20" height="10"><img src="{url}">'.format(url=url)), u'<img src="{thumbnail_url}" width="20" height="10" title="Image"><img src="{image_url}" title="Image">'.format(
+                thumbnail_url = thumbnail.url,
+                image_url = image.file.url,
+            ))
+        finally:
+            image.file.delete()
+    
+    def testLinearTime(self):
+        # Markup that made the old regular expressions backtrack.
+        pathological_texts = (
+            u"<a ",
+            u"<img x='",
+            u'<a href="" ',
+            u"<a href=x title=",
+        )
+        def get_time(text):
+            return min(timeit.repeat(lambda: find_permalinks(text), number=1, repeat=3))
+        for text in pathological_texts:
+            small_time = get_time(text * 2000)
+            large_time = get_time(text * 20000)
+            # A quadratic algorithm would take about 100 times as long.
+            self.assertTrue(large_time < small_time * 30 + 0.01, "{text!r} took {small_time:.4f}s, then {large_time:.4f}s".format(
+                text = text,
+                small_time = small_time,
+                large_time = large_time,
+            ))
@@ -0,0 +1,124 @@
+"""
+Thumbnail generation for images embedded in HTML.
+
+Resizing a large image can take long enough to hold up the request that first
+renders it. In non-blocking mode, a missing thumbnail is queued to a pool of
+background worker threads, and the render that found it missing uses the
+original image instead. Later renders pick up the generated thumbnail from the
+cache.
+"""
+
+from __future__ import with_statement
+
+import collections, hashlib, threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import cache
+
+import optimizations
+
+
+ThumbnailInfo = collections.namedtuple("ThumbnailInfo", ("url", "width", "height",))
+
+
+def get_cache_key(image, width, height, method):
+    """Returns the cache key for a thumbnail of the given image."""
+    return "cms.thumbnails:{name}:{width}x{height}:{method}".format(
+        name = hashlib.md5(image.name.encode("utf-8")).hexdigest(),
+        width = width,
+        height = height,
+        method = method,
+    )
+
+
+def generate_thumbnail(image, width, height, method):
+    """
+    Generates a thumbnail of the given image, and caches its URL and size.
+    Returns a ThumbnailInfo, or None if the image could not be thumbnailed.
+    """
+    cache_key = get_cache_key(image, width, height, method)
+    try:
+        thumbnail = optimizations.get_thumbnail(image, width, height, method)
+        thumbnail_info = ThumbnailInfo(thumbnail.url, thumbnail.width, thumbnail.height)
+    except IOError:
+        # Failures are cached too, so that broken images are not retried on
+        # every render, but only briefly, as the failure may be temporary.
+        cache.set(cache_key, False, getattr(settings, "CMS_THUMBNAIL_FAILURE_CACHE_TIMEOUT", 60*5))
+        return None
+    cache.set(cache_key, thumbnail_info, getattr(settings, "CMS_THUMBNAIL_CACHE_TIMEOUT", 60*60*24))
+    return thumbnail_info
+
+
+class ThumbnailQueue(object):
+    
+    """Generates thumbnails in a pool of background threads."""
+    
+    def __init__(self, workers=None):
+        """Initializes the ThumbnailQueue."""
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = set()
+    
+    def get_workers(self):
+        """Returns the number of worker threads."""
+        if self.workers is None:
+            return getattr(settings, "CMS_THUMBNAIL_WORKERS", 2)
+        return self.workers
+    
+    def _generate(self, key, image, width, height, method):
+        """Generates a queued thumbnail."""
+        try:
+            generate_thumbnail(image, width, height, method)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+    
+    def queue(self, image, width, height, method):
+        """
+        Queues a thumbnail to be generated, unless it is already queued.
+        Returns an AsyncResult, or None if the thumbnail was already queued.
+        """
+        key = get_cache_key(image, width, height, method)
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending.add(key)
+            if self._pool is None:
+                self._pool = ThreadPool(self.get_workers())
+            pool = self._pool
+        return pool.apply_async(self._generate, (key, image, width, height, method))
+    
+    def wait(self):
+        """Waits for all queued thumbnails to be generated."""
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+# A single thumbnail queue for each worker process.
+thumbnail_queue = ThumbnailQueue()
+
+
+def get_thumbnail(image, width, height, method="resize", block=None):
+    """
+    Returns a ThumbnailInfo for a thumbnail of the given image, or None if the
+    image could not be thumbnailed.
+    
+    If block is False, a thumbnail that has not yet been generated is queued
+    for a background worker, and None is returned. If block is None, the
+    CMS_THUMBNAIL_NON_BLOCKING setting decides.
+    """
+    if block is None:
+        block = not getattr(settings, "CMS_THUMBNAIL_NON_BLOCKING", False)
+    thumbnail_info = cache.get(get_cache_key(image, width, height, method))
+    if thumbnail_info is not None:
+        return thumbnail_info or None
+    if block:
+        return generate_thumbnail(image, width, height, method)
+    thumbnail_queue.queue(image, width, height, method)
+    return None
@@ -0,0 +1,89 @@
+"""
+Hooks run once the current request transaction has been committed.
+
+Cache invalidations made while saving an object run before the transaction
+that saved it is committed, so a concurrent request can fill the cache again
+with the old data. Repeating them after the commit removes anything cached in
+the meantime.
+"""
+
+import logging, threading
+
+from django.core.signals import request_started, request_finished
+
+
+logger = logging.getLogger(__name__)
+
+
+class CommitHooks(threading.local):
+    
+    """
+    Collects the functions to call once the response to the current request
+    has been sent, after the request transaction has been committed. Outside of
+    a request, changes are committed straight away, so functions are called
+    immediately.
+    """
+    
+    def __init__(self):
+        """Initializes the CommitHooks."""
+        super(CommitHooks, self).__init__()
+        self._hooks = None
+    
+    def begin(self, **kwargs):
+        """Starts collecting functions for the current request."""
+        self._hooks = []
+    
+    def add(self, func, *args):
+        """
+        Calls the given function with the given arguments after the commit.
+        Each distinct call is only made once.
+        """
+        if self._hooks is None:
+            func(*args)
+        elif not (func, args) in self._hooks:
+            self._hooks.append((func, args))
+    
+    def repeat(self, func, *args):
+        """
+        Calls the given function with the given arguments now and, during a
+        request, again after the commit.
+        """
+        func(*args)
+        if self._hooks is not None:
+            self.add(func, *args)
+    
+    def flush(self, **kwargs):
+        """Calls the collected functions."""
+        hooks = self._hooks
+        self._hooks = None
+        for func, args in hooks or ():
+            try:
+                func(*args)
+            except Exception:
+                # The response has already been sent, so just report the problem.
+                logger.exception("Could not run the commit hook %r.", func)
+
+
+# A single, thread-safe set of commit hooks.
+commit_hooks = CommitHooks()
+
+request_started.connect(commit_hooks.begin)
+
+request_finished.connect(commit_hooks.flush)
+
+
+def after_commit(func, *args):
+    """
+    Calls the given function with the given arguments once the current request
+    transaction has been committed, or straight away outside of a request.
+    """
+    commit_hooks.add(func, *args)
+
+
+def repeat_after_commit(func, *args):
+    """
+    Calls the given function with the given arguments now and, during a
+    request, again once the request transaction has been committed. Use it to
+    invalidate caches that may be filled with the old data before the commit.
+    """
+    commit_hooks.repeat(func, *args)
@@ -1,14 +1,30 @@
 """Views used by the CMS."""
 
+from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import render
 from django.views import generic
 
+from cms import permalinks
+
 
 def handler500(request):
     """Renders a pretty error page."""
     response = render(request, "500.html", {})
     response.status_code = 500
     return response
+
+
+def permalink_redirect(request, content_type_id, object_id):
+    """
+    Redirects to the URL of the object referenced by a permalink, using the
+    shared permalink cache.
+    """
+    key = (content_type_id, object_id)
+    try:
+        url = permalinks.get_targets((key,))[key].url
+    except KeyError:
+        raise Http404("The object referenced by this permalink does not exist.")
+    return HttpResponseRedirect(url)
     
     
 class TextTemplateView(generic.TemplateView):